@@ -0,0 +1,85 @@
+"""
+Asyncio-native ICMP pinger.
+
+Does the same job as pinger.Pinger but runs on an asyncio event loop instead
+of in its own thread. The raw socket is registered with loop.add_reader(),
+echo requests are sent from loop callbacks when the scheduler says they are
+due and the results are put directly into an asyncio.Queue. Replies are
+matched against the in-flight requests tracked by PingerBase.
+"""
+import asyncio
+import logging
+import time
+import sys
+
+from pinger import PingerBase, LATE_REPLY_WINDOW, MIN_TIMEOUT, MAX_TIMEOUT
+
+
+class AsyncPinger(PingerBase):
+    """ Pings hosts from callbacks on an asyncio event loop.
+
+    Call start() to begin pinging and stop() to end. Both must be called from
+    the thread running the event loop.
+    """
+
+    def __init__(self, destinations, loop: asyncio.AbstractEventLoop,
+                 timeout=500, packet_size=55, output=sys.stdout, own_id=None,
+                 source_address=False, late_window=LATE_REPLY_WINDOW,
+                 interval=1.0, max_rate=0, min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT,
+                 rcvbuf=0, sndbuf=0):
+        self.loop = loop
+        self.socket = None
+        super().__init__(destinations, timeout, packet_size, output, own_id,
+                         source_address, late_window, interval, max_rate,
+                         min_timeout, max_timeout, rcvbuf, sndbuf)
+        self.timer_handle = None  # handle for the callback sending, expiring and outputting
+
+    def start(self):
+        """ Open the raw socket and start sending from the loop. """
+        try:
+            self.socket = self.make_raw_socket()
+        except PermissionError:
+            logging.critical("Need root to make a raw socket. Shutting down...")
+            self.keep_going = False
+            return
+        self.socket.setblocking(False)
+        self.loop.add_reader(self.socket.fileno(), self.receive_pings)
+        self.timer_handle = self.loop.call_soon(self.run_timers)
+
+    def stop(self):
+        super().stop()
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+        if self.socket is not None:
+            self.loop.remove_reader(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+        logging.info("Stopped AsyncPinger")
+
+    def set_destinations(self, destinations, intervals=None, bursts=None):
+        super().set_destinations(destinations, intervals, bursts)
+        if self.socket is not None:
+            self.schedule_timer()  # start sending to new destinations right away
+
+    def run_timers(self):
+        """ Timer callback. Sends due requests, expires old ones and outputs results. """
+        if not self.keep_going:
+            return
+        self.send_due(self.socket, time.monotonic())
+        now = time.monotonic()
+        self.expire_echoes(now)
+        self.flush_output(now)
+        self.schedule_timer()
+
+    def schedule_timer(self):
+        """ Schedule run_timers() for the next time there is something to do. """
+        wake_time = self.wake_time()
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+        delay = max(wake_time - time.monotonic(), 0.0)
+        self.timer_handle = self.loop.call_later(delay, self.run_timers)
+
+    def receive_pings(self):
+        """ Reader callback. Reads every datagram waiting on the socket. """
+        if self.socket is not None:
+            super().receive_pings(self.socket)
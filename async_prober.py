@@ -0,0 +1,162 @@
+"""
+Base for probes that run as coroutines on the prober's asyncio event loop.
+
+Targets are scheduled with the same IntervalScheduler as ICMP echo requests.
+A single timer callback starts a task for each probe that is due, and the
+results are collected and output once per OUTPUT_INTERVAL like the pinger's.
+Subclasses implement probe() for their protocol.
+"""
+from typing import List, Optional, Tuple
+import asyncio
+import logging
+import time
+import sys
+
+from send_scheduler import IntervalScheduler
+from pinger import OUTPUT_INTERVAL
+
+DEFAULT_CONCURRENCY = 1000  # probes allowed in progress at once
+
+
+class AsyncProberBase(object):
+    """ Runs scheduled probes as tasks on an asyncio event loop.
+
+    Targets are strings identifying what to probe, e.g. 'ip:port'. At most
+    concurrency probes are in progress at once. A probe that is due while
+    the limit is reached is skipped and counted, so a slow or unreachable
+    set of targets cannot build an ever growing backlog.
+
+    start(), stop() and set_targets() must be called from the thread running
+    the event loop.
+    """
+    message_type = None  # 'type' of the output messages
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, output=sys.stdout, timeout=1000,
+                 interval=1.0, max_rate=0, concurrency=DEFAULT_CONCURRENCY):
+        """
+        :param loop: the event loop to run on
+        :param output: queue to put output messages on, or sys.stdout to print them
+        :param timeout: milliseconds to wait for each probe
+        :param interval: default seconds between probes of a target
+        :param max_rate: maximum probes started per second (0 for no cap)
+        :param concurrency: maximum probes in progress at once
+        """
+        self.loop = loop
+        self.output = output
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.scheduler = IntervalScheduler(interval, max_rate, start_time=time.monotonic())
+        self.keep_going = True
+        self.timer_handle = None
+        self.tasks = set()  # probes in progress
+        self.results = []  # result tuples to send with the next output
+        self.next_output_time = time.monotonic() + OUTPUT_INTERVAL
+        self.probe_count = 0
+        self.skipped_count = 0
+
+    def set_targets(self, targets: List[str], intervals: List[float] = None):
+        """ Set the targets to probe and optionally their intervals in seconds. """
+        self.scheduler.set_destinations(targets, intervals)
+        if self.timer_handle is not None:
+            self.schedule_timer()  # start probing new targets right away
+
+    def start(self):
+        self.timer_handle = self.loop.call_soon(self.run_timers)
+
+    def stop(self):
+        self.keep_going = False
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        for task in self.tasks:
+            task.cancel()
+        logging.info("Stopped %s", type(self).__name__)
+
+    def run_timers(self):
+        """ Timer callback. Starts the due probes and outputs results. """
+        if not self.keep_going:
+            return
+        now = time.monotonic()
+        for target, index in self.scheduler.pop_due(now):
+            if len(self.tasks) >= self.concurrency:
+                self.skipped_count += 1
+                continue
+            task = self.loop.create_task(self.run_probe(target))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        self.flush_output(time.monotonic())
+        self.schedule_timer()
+
+    def schedule_timer(self):
+        """ Schedule run_timers() for the next time there is something to do. """
+        wake_time = self.next_output_time
+        next_send_time = self.scheduler.next_send_time()
+        if next_send_time is not None:
+            wake_time = min(wake_time, next_send_time)
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+        delay = max(wake_time - time.monotonic(), 0.0)
+        self.timer_handle = self.loop.call_later(delay, self.run_timers)
+
+    async def run_probe(self, target: str):
+        self.probe_count += 1
+        try:
+            result = await self.probe(target)
+        except asyncio.CancelledError:
+            return
+        except Exception:
+            logging.exception("Probe of %s failed", target)
+            return
+        self.results.append(result)
+
+    async def probe(self, target: str) -> tuple:
+        """ Probe one target. Returns a result tuple for the output message.
+
+        Times in the tuple are on the monotonic clock; see to_unix_time().
+        """
+        raise NotImplementedError
+
+    def to_unix_time(self, result: tuple, offset: float) -> tuple:
+        """ Convert the monotonic times in result to UNIX time by adding offset. """
+        raise NotImplementedError
+
+    def flush_output(self, now):
+        """ Output the results collected since the last output, if it is time. """
+        if now < self.next_output_time:
+            return
+        self.next_output_time += OUTPUT_INTERVAL
+        if self.next_output_time <= now:
+            self.next_output_time = now + OUTPUT_INTERVAL
+        if self.skipped_count:
+            logging.warning("%s skipped %i probes at the concurrency limit of %i",
+                            type(self).__name__, self.skipped_count, self.concurrency)
+            self.skipped_count = 0
+        if not self.results:
+            return
+        offset = time.time() - time.monotonic()
+        results = [self.to_unix_time(_, offset) for _ in self.results]
+        self.results = []
+        self.handle_output(results)
+
+    def handle_output(self, results: List[tuple]):
+        if self.output == sys.stdout:
+            for result in results:
+                print(self.format_result(result))
+            return
+        data = {'type': self.message_type, 'send_time': min(self.send_time(_) for _ in results),
+                'replies': results}
+        self.output.put_nowait(data)
+
+    def send_time(self, result: tuple) -> float:
+        raise NotImplementedError
+
+    def format_result(self, result: tuple) -> str:
+        return str(result)
+
+
+def split_target(target: str) -> Tuple[str, Optional[int]]:
+    """ Split an 'address:port' target string. The port is None if there is none. """
+    address, _, port = target.rpartition(':')
+    if not address:
+        return port, None
+    return address, int(port)
@@ -9,9 +9,14 @@ import logging
 DEFAULTS = {
     'ws_address': '0.0.0.0',
     'ws_port': '8765',
+    'ws_compression': 'deflate',  # 'deflate' or 'none'
+    'ws_compression_level': '6',  # zlib level, 1 (fastest) to 9 (smallest)
+    'ws_compression_window_bits': '15',  # 9 to 15. smaller uses less memory per connection
     'collector_log_file': 'collector.log',
     'web_address': '0.0.0.0',
     'web_port': '5000',
+    'writer_batch_size': '5000',
+    'writer_flush_interval': '1.0',
 }
 
 
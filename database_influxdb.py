@@ -5,6 +5,7 @@ Database abstraction layer
 
 from influxdb import InfluxDBClient
 import operator
+import math
 import datetime
 import logging
 import time
@@ -23,6 +24,8 @@ TIMEOUT_VALUE = 127.0  # magic value indicating probe timed out
 LATENCY_PRECISION = 4  # number of decimals on the latency value (seconds)
                        #  4 means #.#### seconds is the latency precision
                        #  which is precise to 100us (0.1ms)
+TIME_PRECISION = 'ms'  # precision of the point timestamps written and read
+TIME_MULTIPLIER = 1000  # timestamp units per second at TIME_PRECISION
 
 src_dst_pairs = {}  # a dumb infinite cache of SrcDst pair IDs
 class_cache = TTLCache(maxsize=8192, ttl=60)
@@ -98,7 +101,7 @@ class DatabaseInfluxDB(Database):
             'dst_ip': dst_ip,
         }
         logging.debug("Querying: %s | %s", query, params)
-        result_set = self.client.query(query, bind_params=params, epoch='s')
+        result_set = self.client.query(query, bind_params=params, epoch=TIME_PRECISION)
         points = list(result_set.get_points())
         if not points:
             return 0
@@ -113,7 +116,8 @@ class DatabaseInfluxDB(Database):
 
             Returns a list of rows from the database.
             Each row is a list with two items: time and latency.
-            The time is integer UNIX time, unless convert_to_datetime is True.
+            The time is UNIX time in seconds with millisecond precision, unless
+            convert_to_datetime is True.
             The latency is the number of seconds latency (float).
             A latency value of None indicates a timeout.
         """
@@ -178,10 +182,20 @@ class DatabaseInfluxDB(Database):
         }
         return statistics
 
-    def record_poll_data(self, prober_name, dst_ip, send_time, receive_time) -> None:
-        """ Record results of a single poll in the database. """
-        if not self.client:
-            self._connect()
+    def make_poll_point(self, prober_name, dst_ip, send_time, receive_time, late=False,
+                        timeout=None, kernel_drop=False) -> dict:
+        """ Build the InfluxDB point for the results of a single poll.
+
+        A late reply arrived after the prober recorded a timeout. Its point has
+        the same time and tags as the timeout so it replaces the timeout.
+        timeout is the time (seconds) the prober waited for the reply, if known.
+        kernel_drop marks a timeout the prober's kernel may have caused by
+        dropping the reply, i.e. not a measurement of the network. The field
+        is always written so a late reply overwrites its timeout's flag;
+        InfluxDB merges the fields of points with the same time and tags.
+
+        Does not write anything to InfluxDB; see write_points().
+        """
         # do this to make sure there is a record created in the MySQL DB for this pair.
         pair_id = self.src_dst_id(prober_name, dst_ip)
         if receive_time is None:
@@ -195,12 +209,224 @@ class DatabaseInfluxDB(Database):
                 "prober_name": prober_name,
                 "dst_ip": dst_ip
             },
-            "time": int(send_time),
+            "time": int(round(send_time * TIME_MULTIPLIER)),
             "fields": {
                 "latency": latency
             }
         }
-        self.client.write_points([point], time_precision='s')
+        if late:
+            point["fields"]["late"] = True
+        if timeout is not None:
+            point["fields"]["timeout"] = round(timeout, LATENCY_PRECISION)
+        point["fields"]["kernel_drop"] = bool(kernel_drop and receive_time is None)
+        return point
+
+    def make_summary_point(self, prober_name, dst_ip, send_time, sent, received,
+                           minimum, average, maximum, jitter) -> dict:
+        """ Build the InfluxDB point for the summary of a burst of echo requests.
+
+        The point is in the same measurement as single polls. latency is the
+        average RTT, or TIMEOUT_VALUE if nothing replied, so graphs of single
+        polls work for bursts too. RTT values are in seconds.
+
+        Does not write anything to InfluxDB; see write_points().
+        """
+        self.src_dst_id(prober_name, dst_ip)
+        fields = {
+            "latency": TIMEOUT_VALUE if average is None else round(average, LATENCY_PRECISION),
+            "echoes": sent,
+            "loss": round(1 - received / sent, LATENCY_PRECISION) if sent else 1.0,
+        }
+        if received:
+            fields["minimum"] = round(minimum, LATENCY_PRECISION)
+            fields["maximum"] = round(maximum, LATENCY_PRECISION)
+            fields["jitter"] = round(jitter, LATENCY_PRECISION)
+        return {
+            "measurement": "icmp-echo",
+            "tags": {
+                "probe": "[unimplemented]",
+                "prober_name": prober_name,
+                "dst_ip": dst_ip
+            },
+            "time": int(round(send_time * TIME_MULTIPLIER)),
+            "fields": fields
+        }
+
+    def make_rollup_point(self, prober_name, start_time, period, buckets, dst_ip, count, lost,
+                          minimum, maximum, total, total_squares, histogram,
+                          kernel_dropped=0) -> dict:
+        """ Build the InfluxDB point for a prober's rollup of one target over one period.
+
+        Like burst summaries the point is in the icmp-echo measurement with
+        the mean latency as latency. The histogram counts are stored as
+        fields named after the upper bound of their bucket in milliseconds,
+        e.g. le_5ms, and le_inf for the last bucket. kernel_dropped counts the
+        lost requests the prober's kernel may have dropped the replies of.
+
+        Does not write anything to InfluxDB; see write_points().
+        """
+        self.src_dst_id(prober_name, dst_ip)
+        received = count - lost
+        fields = {
+            "latency": TIMEOUT_VALUE,
+            "echoes": count,
+            "loss": round(lost / count, LATENCY_PRECISION) if count else 1.0,
+            "period": period,
+            "kernel_dropped": kernel_dropped,
+        }
+        if received:
+            mean = total / received
+            variance = max(total_squares / received - mean * mean, 0.0)
+            fields["latency"] = round(mean, LATENCY_PRECISION)
+            fields["minimum"] = round(minimum, LATENCY_PRECISION)
+            fields["maximum"] = round(maximum, LATENCY_PRECISION)
+            fields["stddev"] = round(math.sqrt(variance), LATENCY_PRECISION)
+        for bound, bucket_count in zip(list(buckets) + ['inf'], histogram):
+            fields["le_" + str(bound) + ("" if bound == 'inf' else "ms")] = bucket_count
+        return {
+            "measurement": "icmp-echo",
+            "tags": {
+                # a series of its own so it never overwrites a raw reply sent at the period start
+                "probe": "rollup",
+                "prober_name": prober_name,
+                "dst_ip": dst_ip
+            },
+            "time": int(round(start_time * TIME_MULTIPLIER)),
+            "fields": fields
+        }
+
+    @staticmethod
+    def make_tcp_point(prober_name, dst_ip, dst_port, receive_time, send_time, timeout,
+                       error) -> dict:
+        """ Build the InfluxDB point for a single TCP connect probe.
+
+        latency is the time to establish (or be refused) the connection, or
+        TIMEOUT_VALUE if there was no answer. error is stored if the
+        connection was not established.
+
+        Does not write anything to InfluxDB; see write_points().
+        """
+        if receive_time is None:
+            latency = TIMEOUT_VALUE
+        else:
+            latency = round(receive_time - send_time, LATENCY_PRECISION)
+        fields = {"latency": latency, "timeout": round(timeout, LATENCY_PRECISION)}
+        if error:
+            fields["error"] = error
+        return {
+            "measurement": "tcp-connect",
+            "tags": {
+                "prober_name": prober_name,
+                "dst_ip": dst_ip,
+                "dst_port": str(dst_port)
+            },
+            "time": int(round(send_time * TIME_MULTIPLIER)),
+            "fields": fields
+        }
+
+    @staticmethod
+    def make_dns_point(prober_name, dst_ip, dst_port, query_name, receive_time, send_time,
+                       timeout, rcode, answers, error) -> dict:
+        """ Build the InfluxDB point for a single DNS query probe.
+
+        latency is the time until the server answered, or TIMEOUT_VALUE if it
+        did not. rcode and answers (the answer record count) are stored for
+        answers and error otherwise.
+
+        Does not write anything to InfluxDB; see write_points().
+        """
+        fields = {"latency": TIMEOUT_VALUE, "timeout": round(timeout, LATENCY_PRECISION)}
+        if receive_time is not None:
+            fields["latency"] = round(receive_time - send_time, LATENCY_PRECISION)
+            fields["rcode"] = rcode
+            fields["answers"] = answers
+        if error:
+            fields["error"] = error
+        return {
+            "measurement": "dns-query",
+            "tags": {
+                "prober_name": prober_name,
+                "dst_ip": dst_ip,
+                "dst_port": str(dst_port),
+                "query_name": query_name
+            },
+            "time": int(round(send_time * TIME_MULTIPLIER)),
+            "fields": fields
+        }
+
+    @staticmethod
+    def make_prober_stats_point(prober_name, message) -> dict:
+        """ Build the InfluxDB point for a prober_stats message (see Writer.store_prober_stats).
+
+        Counters and gauges are stored as fields of the same name. Each timing
+        is stored as <name>_count, <name>_mean and <name>_max (seconds) and its
+        histogram as <name>_le_<bound>ms fields like rollups.
+
+        Does not write anything to InfluxDB; see write_points().
+        """
+        fields = {"period": round(message['period'], LATENCY_PRECISION)}
+        fields.update(message['counters'])
+        fields.update(message.get('gauges', {}))
+        for name, timing in message['timings'].items():
+            fields[name + "_count"] = timing['count']
+            if timing['count']:
+                fields[name + "_mean"] = round(timing['total'] / timing['count'], 6)
+            fields[name + "_max"] = round(timing['max'], 6)
+            for bound, bucket_count in zip(list(message['buckets']) + ['inf'],
+                                           timing['histogram']):
+                fields[name + "_le_" + str(bound) + ("" if bound == 'inf' else "ms")] = bucket_count
+        return {
+            "measurement": "prober-stats",
+            "tags": {
+                "prober_name": prober_name,
+                "worker": str(message.get('worker', 0))
+            },
+            "time": int(round(message['send_time'] * TIME_MULTIPLIER)),
+            "fields": fields
+        }
+
+    @staticmethod
+    def make_connection_stats_point(prober_name, message) -> dict:
+        """ Build the InfluxDB point for a connection_stats message (see Writer.store_connection_stats).
+
+        The byte counts, queue and spool statistics are stored as fields of the same
+        name, with the compression ratio of each direction (raw bytes per wire
+        byte) if the connection is compressed.
+
+        Does not write anything to InfluxDB; see write_points().
+        """
+        fields = {"period": round(message['period'], LATENCY_PRECISION),
+                  "level": message['level'], "window_bits": message['window_bits']}
+        fields.update({_: value for _, value in message.items()
+                       if _.startswith('spool_') or _.startswith('queue_')})
+        for direction in ('sent', 'received'):
+            if direction + '_bytes' not in message:
+                continue
+            raw = message[direction + '_bytes']
+            wire = message[direction + '_wire_bytes']
+            fields[direction + '_bytes'] = raw
+            fields[direction + '_wire_bytes'] = wire
+            fields[direction + '_ratio'] = round(raw / wire, 3) if wire else 1.0
+        return {
+            "measurement": "prober-connection",
+            "tags": {
+                "prober_name": prober_name,
+                "compression": message['compression']
+            },
+            "time": int(round(message['send_time'] * TIME_MULTIPLIER)),
+            "fields": fields
+        }
+
+    def write_points(self, points: List[dict]) -> None:
+        """ Write a list of points built by make_poll_point() in one request. """
+        if not self.client:
+            self._connect()
+        self.client.write_points(points, time_precision=TIME_PRECISION)
+
+    def record_poll_data(self, prober_name, dst_ip, send_time, receive_time) -> None:
+        """ Record results of a single poll in the database. """
+        point = self.make_poll_point(prober_name, dst_ip, send_time, receive_time)
+        self.write_points([point])
 
     def last_poll_time_by_pair(self, prober_name, dst_ip) -> datetime.datetime:
         """ Get the last time a particular pair ID was polled.
@@ -216,14 +442,49 @@ class DatabaseInfluxDB(Database):
             'dst_ip': dst_ip,
         }
         logging.debug("Querying: %s | %s", query, params)
-        result_set = self.client.query(query, bind_params=params, epoch='s')
+        result_set = self.client.query(query, bind_params=params, epoch=TIME_PRECISION)
         points = list(result_set.get_points())
         if not points:
             dt = datetime.datetime.min
         else:
-            dt = datetime.datetime.fromtimestamp(points[0]['time'])
+            dt = datetime.datetime.fromtimestamp(points[0]['time'] / TIME_MULTIPLIER)
         return dt
 
+    def get_latest_prober_stats(self, max_age='1h') -> dict:
+        """ Get each prober's most recent self-instrumentation.
+
+        The latest stats of each worker of a prober are combined: counters are
+        summed and the maximum timings are the largest of any worker.
+
+        Returns a dict of prober name: {'time': datetime.datetime, 'period': seconds,
+        'sent': n, 'received': n, 'unmatched': n, 'errors': n, 'kernel_drops': n, 'in_flight': n,
+        'send_round_max': seconds, 'receive_loop_max': seconds, 'schedule_lag_max': seconds}
+        """
+        if not self.client:
+            self._connect()
+        query = 'SELECT LAST(*) FROM "prober-stats" WHERE time > now() - ' + max_age + \
+                ' GROUP BY "prober_name", "worker"'
+        logging.debug("Querying: %s", query)
+        result_set = self.client.query(query, epoch=TIME_PRECISION)
+        stats = {}
+        for (measurement, tags), points in result_set.items():
+            for point in points:
+                prober = stats.setdefault(tags['prober_name'], {
+                    'time': datetime.datetime.min, 'period': 0.0, 'sent': 0, 'received': 0,
+                    'unmatched': 0, 'errors': 0, 'kernel_drops': 0, 'in_flight': 0,
+                    'send_round_max': 0.0,
+                    'receive_loop_max': 0.0, 'schedule_lag_max': 0.0})
+                prober['time'] = max(prober['time'], datetime.datetime.fromtimestamp(
+                    point['time'] / TIME_MULTIPLIER))
+                prober['period'] = max(prober['period'], point.get('last_period') or 0.0)
+                for name in ('sent', 'received', 'unmatched', 'kernel_drops', 'in_flight'):
+                    prober[name] += point.get('last_' + name) or 0
+                prober['errors'] += (point.get('last_send_errors') or 0) + \
+                    (point.get('last_receive_errors') or 0)
+                for name in ('send_round_max', 'receive_loop_max', 'schedule_lag_max'):
+                    prober[name] = max(prober[name], point.get('last_' + name) or 0.0)
+        return stats
+
     def read_records(self, prober_name, dst_ip, start_time, end_time) -> List:
         """ Return the list of records from start to end times, inclusive.
 
@@ -235,16 +496,19 @@ class DatabaseInfluxDB(Database):
         """
         if not self.client:
             self._connect()
-        start_time = str(int(start_time.timestamp()))
-        end_time = str(int(end_time.timestamp()))
+        start_time = str(int(start_time.timestamp() * TIME_MULTIPLIER))
+        end_time = str(int(end_time.timestamp() * TIME_MULTIPLIER))
         query = 'SELECT "latency" FROM "icmp-echo" WHERE prober_name=$prober_name AND ' + \
-                'dst_ip=$dst_ip AND time>=' + start_time + 's AND time<=' + end_time + 's'
+                'dst_ip=$dst_ip AND time>=' + start_time + TIME_PRECISION + \
+                ' AND time<=' + end_time + TIME_PRECISION
         params = {
             'prober_name': prober_name,
             'dst_ip': dst_ip,
         }
         logging.debug("Querying: %s | %s", query, params)
-        result_set = self.client.query(query, bind_params=params, epoch='s')
+        result_set = self.client.query(query, bind_params=params, epoch=TIME_PRECISION)
         points = list(result_set.get_points())
+        for point in points:
+            point['time'] = point['time'] / TIME_MULTIPLIER
         logging.debug("Got %i records from %i to %i", len(points), start_time, end_time)
         return points
@@ -12,13 +12,20 @@ class Datafile(object):
     """ This class will be a factory.
 
         See file format documentation in file_formats.md.
+
+        Version 3 records hold the time as a 32-bit count of seconds.
+        Version 4 records hold a 64-bit count of milliseconds so more than one
+        record per second can be stored. Times passed to and returned from
+        the methods below are UNIX seconds for both versions.
     """
-    DEFAULT_VERSION = 3
+    DEFAULT_VERSION = 4
     DEFAULT_DATA_LENGTH = 2
     DEFAULT_OFFSET = 24
     DEFAULT_NUMBER_OF_RECORDS = 0
     DEFAULT_MAX_RECORDS = 86400 * 7
     STRUCT_U_8 = struct.Struct('Q')
+    RECORD_FORMATS = {3: 'IH', 4: 'QH'}  # version: record format
+    TIME_MULTIPLIERS = {3: 1, 4: 1000}  # version: stored time units per second
 
     def __init__(self, pid, path, version, data_length, offset,
                  number_of_records, max_records):
@@ -26,20 +33,39 @@ class Datafile(object):
         self.pid = pid  # database ID of the src-dst pair
         self.path = path  # path to data file on disk
         self.file = None  # file handle
-        self.version = version
         self.header_struct = struct.Struct('ccccBBxxQQ')
         self.header_length = self.header_struct.size
-        self.record_format = 'IH'
-        self.record_struct = struct.Struct('=' + self.record_format)
-        self.multiple_record_structs = {1: self.record_struct}
-        self.record_length = self.record_struct.size
         self.data_length = data_length
         self.offset = offset
         self.number_of_records = number_of_records
         self.max_records = max_records
-        self.max_data_area_bytes = (4 + data_length) * max_records
+        self.set_version(version)
+
+    def set_version(self, version):
+        """ Set up the record format and sizes for a file format version. """
+        if version not in Datafile.RECORD_FORMATS:
+            raise ValueError("Unsupported datafile version: %s" % version)
+        self.version = version
+        self.record_format = Datafile.RECORD_FORMATS[version]
+        self.time_multiplier = Datafile.TIME_MULTIPLIERS[version]
+        self.record_struct = struct.Struct('=' + self.record_format)
+        self.multiple_record_structs = {1: self.record_struct}
+        self.record_length = self.record_struct.size
+        self.max_data_area_bytes = self.record_length * self.max_records
         self.max_file_bytes = self.max_data_area_bytes + self.header_length
 
+    def encode_time(self, datum_time):
+        """ Convert UNIX seconds to the integer time stored in a record. """
+        if self.time_multiplier == 1:
+            return int(datum_time)
+        return int(round(datum_time * self.time_multiplier))
+
+    def decode_time(self, stored_time):
+        """ Convert the integer time stored in a record to UNIX seconds. """
+        if self.time_multiplier == 1:
+            return stored_time
+        return stored_time / self.time_multiplier
+
     def open_file(self, mode):
         """ Open the underlying file using the given mode. """
         self.file = open(self.path, mode)
@@ -74,10 +100,10 @@ class Datafile(object):
     def read_header(self):
         header_bytes = self.file.read(self.header_struct.size)
         header = self.header_struct.unpack(header_bytes)
-        self.version = header[4]
         self.data_length = header[5]
         self.offset = header[6]
         self.number_of_records = header[7]
+        self.set_version(header[4])
 
     def write_header(self):
         """ Write the entire data file header to the top of the data file. """
@@ -104,10 +130,10 @@ class Datafile(object):
             No seeking is done. No other fields are updated.
 
             Args:
-            datum_time: UNIX time (integer)
+            datum_time: UNIX time in seconds
             encoded_latency: integer 0..65535 representing latency in 0.0..1.0s
         """
-        self.file.write(self.record_struct.pack(datum_time, encoded_latency))
+        self.file.write(self.record_struct.pack(self.encode_time(datum_time), encoded_latency))
 
     def record_datum(self, datum_time, send_time, receive_time):
         """ Add an entry to the data file at the end of the data set.
@@ -116,7 +142,8 @@ class Datafile(object):
             number_of_records and offset (if needed).
 
             Arguments:
-            datum_time: UNIX time in seconds (integer)
+            datum_time: UNIX time in seconds. Version 3 files truncate it to
+                        whole seconds.
             send_time: precise time ping was sent (float)
             receive_time: precise time ping was received (float)
         """
@@ -139,7 +166,7 @@ class Datafile(object):
             self.write_offset()
             #if (self.offset - self.header_length) % (self.record_length * 10) == 0:
         self.file.flush()
-        logging.debug("Recorded datum for PID %i: %i %i Num: %i Offset: %i",
+        logging.debug("Recorded datum for PID %i: %.3f %i Num: %i Offset: %i",
                       self.pid, datum_time, encoded_latency,
                       self.number_of_records, self.offset)
 
@@ -166,7 +193,7 @@ class Datafile(object):
         record_bytes = self.file.read(self.record_length)
         record = self.record_struct.unpack(record_bytes)
         latency = Database.short_latency_to_seconds(record[1])
-        return [record[0], latency]
+        return [self.decode_time(record[0]), latency]
 
     def get_multiple_record_struct(self, n):
         """ Get (make if needed) to decode n records at once. """
@@ -197,7 +224,7 @@ class Datafile(object):
                                                       self.record_length)
         all_values = read_struct.unpack(data)
         for i in range(records_read):
-            epoch = all_values[i * 2]
+            epoch = self.decode_time(all_values[i * 2])
             latency = Database.short_latency_to_seconds(all_values[i * 2 + 1])
             records.append([epoch, latency])
         return records
@@ -233,7 +260,8 @@ class Datafile(object):
     def read_n_value_pairs(self, n):
         """ Read multiple value-pairs at the current position in the file.
 
-            Returns a list of interleaved timestamps and encoded latencies.
+            Returns a list of interleaved stored timestamps and encoded
+            latencies. The timestamps are not decoded; see decode_time().
         """
         data = self.file.read(self.record_length * n)
         if not data:
@@ -253,8 +281,8 @@ class Datafile(object):
     def read_all_values(self):
         """ Read all values from a file in order.
 
-            Returns: a list of timestamps interleaved with the encoded latency
-            values.
+            Returns: a list of stored timestamps interleaved with the encoded
+            latency values.
         """
         all_values = []
         self.file.seek(self.offset)
@@ -285,9 +313,11 @@ class Datafile(object):
             If there are no records within the time range, [] is returned.
 
             Sample return:
-                [(epoch-integer, 123), (epoch-integer+1, 65534), ...]
+                [(epoch, 0.0123), (epoch+1, None), ...]
         """
         values_list = self.read_all_values()
+        start_time = self.encode_time(start_time)
+        end_time = self.encode_time(end_time)
         if values_list[0] > end_time:
             logging.debug("First record (%i) was after end_time: %i",
                           values_list[0], end_time)
@@ -311,7 +341,7 @@ class Datafile(object):
         specific_records = []
         for i in range(first, last, 2):
             latency = Database.short_latency_to_seconds(values_list[i+1])
-            specific_records.append([values_list[i], latency])
+            specific_records.append([self.decode_time(values_list[i]), latency])
         logging.debug("Got %i specific records from %i to %i",
                       len(specific_records), start_time, end_time)
         return specific_records
@@ -0,0 +1,184 @@
+"""
+DNS query latency probe.
+
+Measures how long a DNS server takes to answer a query. The queries are
+built by hand and sent from a few UDP sockets opened as asyncio datagram
+endpoints, so thousands of outstanding queries share those sockets. Replies
+are matched to their queries by transaction ID, source address and question.
+"""
+from typing import Dict, List, Tuple
+import functools
+import asyncio
+import logging
+import random
+import struct
+import time
+import sys
+
+from async_prober import AsyncProberBase, split_target, DEFAULT_CONCURRENCY
+
+DNS_PORT = 53
+DNS_HEADER = struct.Struct('!HHHHHH')  # id, flags, question, answer, authority, additional
+FLAG_QR = 0x8000  # the message is a response
+FLAG_RD = 0x0100  # recursion desired
+QTYPE_A = 1
+QCLASS_IN = 1
+DEFAULT_SOCKETS = 4  # UDP sockets the queries are spread across
+
+
+def encode_question(query_name: str, qtype: int = QTYPE_A) -> bytes:
+    """ The question section asking for query_name. Raises ValueError for invalid names. """
+    encoded = b''
+    for label in query_name.rstrip('.').split('.'):
+        label = label.encode('idna')
+        if not 0 < len(label) < 64:
+            raise ValueError("Invalid DNS name: %s" % query_name)
+        encoded += bytes([len(label)]) + label
+    return encoded + b'\x00' + struct.pack('!HH', qtype, QCLASS_IN)
+
+
+def split_dns_target(target: str) -> Tuple[str, str, int]:
+    """ Split a 'query_name@address:port' target string. The port defaults to 53. """
+    query_name, _, server = target.rpartition('@')
+    address, port = split_target(server)
+    return query_name, address, port or DNS_PORT
+
+
+class DnsProtocol(asyncio.DatagramProtocol):
+    """ Hands the datagrams received on one of the DnsProber's sockets to the prober. """
+
+    def __init__(self, prober: 'DnsProber', index: int):
+        self.prober = prober
+        self.index = index
+
+    def datagram_received(self, data, addr):
+        self.prober.handle_response(self.index, data, addr, time.monotonic())
+
+    def error_received(self, exc):
+        logging.debug("DNS probe socket %i error: %s", self.index, str(exc))
+
+
+class DnsProber(AsyncProberBase):
+    """ Probes 'query_name@ip:port' targets with DNS queries on an asyncio event loop.
+
+    Each query asks for the A record of the query name with recursion
+    desired. Results are (ip, port, query_name, receive_time, send_time,
+    timeout, rcode, answers, error) tuples. receive_time, rcode and answers
+    are None if no reply arrived, in which case error is 'timeout' or why the
+    query could not be sent. Any reply counts, including NXDOMAIN and
+    SERVFAIL; rcode tells them apart. The results are output in
+    'dns_output' messages.
+    """
+    message_type = 'dns_output'
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, output=sys.stdout, timeout=1000,
+                 interval=1.0, max_rate=0, concurrency=DEFAULT_CONCURRENCY,
+                 sockets=DEFAULT_SOCKETS):
+        super().__init__(loop, output, timeout, interval, max_rate, concurrency)
+        self.sockets = sockets
+        self.transports = []
+        self.start_task = None
+        self.next_socket = 0
+        # outstanding queries keyed on (socket index, transaction id).
+        # values are (future, (ip, port), question)
+        self.pending: Dict[Tuple[int, int], tuple] = {}
+        self.questions: Dict[str, bytes] = {}  # query name: encoded question section
+        self.unmatched_count = 0
+        logging.debug("Initialized DnsProber. timeout: %i sockets: %i", timeout, sockets)
+
+    def set_targets(self, targets: List[str], intervals: List[float] = None):
+        super().set_targets(targets, intervals)
+        query_names = set(split_dns_target(_)[0] for _ in targets)
+        self.questions = {_: q for _, q in self.questions.items() if _ in query_names}
+
+    def start(self):
+        self.start_task = self.loop.create_task(self.open_sockets())
+
+    async def open_sockets(self):
+        """ Open the datagram endpoints and then start probing. """
+        for index in range(self.sockets):
+            transport, protocol = await self.loop.create_datagram_endpoint(
+                functools.partial(DnsProtocol, self, index), local_addr=('0.0.0.0', 0))
+            self.transports.append(transport)
+        logging.info("Opened %i DNS probe sockets", len(self.transports))
+        super().start()
+
+    def stop(self):
+        super().stop()
+        if self.start_task is not None:
+            self.start_task.cancel()
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    def question_for(self, query_name: str) -> bytes:
+        question = self.questions.get(query_name)
+        if question is None:
+            question = self.questions[query_name] = encode_question(query_name)
+        return question
+
+    def new_query_id(self, index: int) -> int:
+        """ A random transaction ID that is not outstanding on socket index. """
+        while True:
+            query_id = random.getrandbits(16)
+            if (index, query_id) not in self.pending:
+                return query_id
+
+    async def probe(self, target: str) -> tuple:
+        query_name, ip, port = split_dns_target(target)
+        timeout = self.timeout / 1000.0
+        try:
+            question = self.question_for(query_name)
+        except (ValueError, UnicodeError):
+            return ip, port, query_name, None, time.monotonic(), timeout, None, None, 'bad name'
+        index = self.next_socket
+        self.next_socket = (index + 1) % len(self.transports)
+        query_id = self.new_query_id(index)
+        future = self.loop.create_future()
+        key = (index, query_id)
+        self.pending[key] = (future, (ip, port), question)
+        send_time = time.monotonic()
+        try:
+            self.transports[index].sendto(DNS_HEADER.pack(query_id, FLAG_RD, 1, 0, 0, 0) +
+                                          question, (ip, port))
+            receive_time, rcode, answers = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return ip, port, query_name, None, send_time, timeout, None, None, 'timeout'
+        except OSError as e:
+            return ip, port, query_name, None, send_time, timeout, None, None, str(e)
+        finally:
+            self.pending.pop(key, None)
+        return ip, port, query_name, receive_time, send_time, timeout, rcode, answers, None
+
+    def handle_response(self, index: int, data: bytes, addr: tuple, receive_time: float):
+        """ Complete the query a datagram received on socket index answers, if any. """
+        if len(data) < DNS_HEADER.size:
+            self.unmatched_count += 1
+            return
+        query_id, flags, questions, answers, authority, additional = DNS_HEADER.unpack_from(data)
+        request = self.pending.get((index, query_id))
+        if request is None or not flags & FLAG_QR or tuple(addr[:2]) != request[1] \
+                or data[DNS_HEADER.size:DNS_HEADER.size + len(request[2])].lower() != \
+                request[2].lower():
+            self.unmatched_count += 1
+            logging.debug("Received DNS response from %s that we are not waiting for", addr)
+            return
+        future = request[0]
+        if not future.done():
+            future.set_result((receive_time, flags & 0x000F, answers))
+
+    def to_unix_time(self, result: tuple, offset: float) -> tuple:
+        ip, port, query_name, receive_time, send_time = result[:5]
+        return (ip, port, query_name, None if receive_time is None else receive_time + offset,
+                send_time + offset) + result[5:]
+
+    def send_time(self, result: tuple) -> float:
+        return result[4]
+
+    def format_result(self, result: tuple) -> str:
+        ip, port, query_name, receive_time, send_time, timeout, rcode, answers, error = result
+        if receive_time is None:
+            return "no answer from {0}:{1} for {2} ({3})".format(ip, port, query_name, error)
+        millis = (receive_time - send_time) * 1000
+        return "answer from {0}:{1} for {2} in {3:.1f} ms rcode: {4} answers: {5}".format(
+            ip, port, query_name, millis, rcode, answers)
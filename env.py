@@ -24,6 +24,37 @@ DEFAULTS = {
     'PROBER_WS_URL': 'ws://collector:8765',
     'PROBER_LOG_FILE': 'probe.log',
     'PROBER_NAME': 'prober1',
+    'PROBER_ENGINE': 'thread',
+    'PROBER_MAX_PPS': '0',
+    'PROBER_WORKERS': '1',
+    'PROBER_DNS_TTL': '300',
+    'PROBER_DNS_WORKERS': '32',
+    'PROBER_TIMEOUT': '500',
+    'PROBER_MIN_TIMEOUT': '20',
+    'PROBER_MAX_TIMEOUT': '2000',
+    'PROBER_BATCH_MAX_MESSAGES': '100',
+    'PROBER_BATCH_MAX_DELAY': '0.05',
+    'PROBER_BINARY_OUTPUT': '1',
+    'PROBER_WS_COMPRESSION': 'deflate',
+    'PROBER_WS_COMPRESSION_LEVEL': '6',
+    'PROBER_WS_COMPRESSION_WINDOW_BITS': '15',
+    'PROBER_DB_FILE': './prober_db.sqlite3',
+    'PROBER_SPOOL_MAX_BYTES': '1073741824',
+    'PROBER_QUEUE_MAX_MESSAGES': '1000',
+    'PROBER_QUEUE_OVERFLOW': 'spill',
+    'PROBER_SPOOL_DRAIN_RATE': '200',
+    'PROBER_RCVBUF': '4194304',
+    'PROBER_SNDBUF': '0',
+    'PROBER_TCP_TIMEOUT': '1000',
+    'PROBER_TCP_CONCURRENCY': '1000',
+    'PROBER_TCP_MAX_RATE': '0',
+    'PROBER_DNS_QUERY_TIMEOUT': '1000',
+    'PROBER_DNS_QUERY_CONCURRENCY': '10000',
+    'PROBER_DNS_QUERY_SOCKETS': '4',
+    'PROBER_DNS_QUERY_MAX_RATE': '0',
+    'PROBER_ROLLUP_PERIOD': '0',
+    'PROBER_ROLLUP_RAW_LOSS': '1',
+    'PROBER_ROLLUP_RAW_THRESHOLD': '0',
 }
 
 
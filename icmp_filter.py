@@ -0,0 +1,79 @@
+"""
+Classic BPF socket filters for the pinger's raw ICMP socket (Linux only).
+
+With a filter attached the kernel only queues the ICMP echo replies carrying
+our identifier on the socket instead of every ICMP packet the host receives.
+"""
+from typing import Optional
+import ctypes
+import socket
+import struct
+import sys
+
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)  # Linux value
+SO_DETACH_FILTER = getattr(socket, 'SO_DETACH_FILTER', 27)
+
+# BPF instruction classes, sizes and modes from linux/filter.h
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_IND = 0x40
+BPF_MSH = 0xa0
+BPF_JEQ = 0x10
+BPF_K = 0x00
+
+SOCK_FILTER = struct.Struct('=HBBI')  # struct sock_filter: code, jt, jf, k
+ACCEPT_LENGTH = 0xffff  # bytes of an accepted packet to keep
+
+
+def echo_reply_filter(packet_id: int) -> list:
+    """ BPF program accepting only ICMP echo replies with the given identifier.
+
+    Raw IPv4 sockets see the packet from the start of the IP header, so the
+    ICMP header offset is read from the IP header length.
+
+    :return: a list of (code, jt, jf, k) instructions
+    """
+    return [
+        (BPF_LDX | BPF_B | BPF_MSH, 0, 0, 0),      # X = IP header length
+        (BPF_LD | BPF_B | BPF_IND, 0, 0, 0),       # A = ICMP type
+        (BPF_JMP | BPF_JEQ | BPF_K, 0, 3, 0),      # echo reply? else reject
+        (BPF_LD | BPF_H | BPF_IND, 0, 0, 4),       # A = ICMP identifier
+        (BPF_JMP | BPF_JEQ | BPF_K, 0, 1, packet_id),  # ours? else reject
+        (BPF_RET | BPF_K, 0, 0, ACCEPT_LENGTH),
+        (BPF_RET | BPF_K, 0, 0, 0),
+    ]
+
+
+def attach_filter(current_socket: socket.socket, program: list) -> None:
+    """ Attach a BPF program to a socket. Raises OSError if that is not supported. """
+    if not sys.platform.startswith('linux'):
+        raise OSError("Socket filters are only supported on Linux")
+    code = b''.join(SOCK_FILTER.pack(*instruction) for instruction in program)
+    buffer = ctypes.create_string_buffer(code, len(code))
+    # struct sock_fprog: unsigned short len, struct sock_filter *filter
+    fprog = struct.pack('@HP', len(program), ctypes.addressof(buffer))
+    current_socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def read_icmp_in_msgs() -> Optional[int]:
+    """ The number of ICMP messages the host has received (Linux /proc/net/snmp).
+
+    :return: the InMsgs counter or None if it can not be read
+    """
+    try:
+        with open('/proc/net/snmp') as f:
+            icmp_lines = [_.split() for _ in f if _.startswith('Icmp:')]
+    except OSError:
+        return None
+    if len(icmp_lines) < 2 or 'InMsgs' not in icmp_lines[0]:
+        return None
+    return int(icmp_lines[1][icmp_lines[0].index('InMsgs')])
+
+
+def attach_echo_reply_filter(current_socket: socket.socket, packet_id: int) -> None:
+    """ Only let echo replies with identifier packet_id through to the socket. """
+    attach_filter(current_socket, echo_reply_filter(packet_id))
@@ -1,4 +1,5 @@
-from typing import List
+from typing import List, Optional, Tuple
+from collections import deque
 from threading import Thread
 import logging
 import select
@@ -8,36 +9,215 @@ import time
 import sys
 import os
 
+from icmp_filter import attach_echo_reply_filter, read_icmp_in_msgs
+from resolver import ResolverCache
+from send_scheduler import IntervalScheduler
+from timer_wheel import TimerWheel
+
 # ICMP parameters
 ICMP_ECHOREPLY = 0  # Echo reply (per RFC792)
 ICMP_ECHO = 8  # Echo request (per RFC792)
 ICMP_MAX_RECV = 2048  # Max size of incoming buffer
+RECV_BATCH = 256  # max packets read per wake-up so a flood can not hold up sending
+LATE_REPLY_WINDOW = 10.0  # seconds after timing out that a reply is still reported as late
+OUTPUT_INTERVAL = 1.0  # seconds between output messages
+STATS_LOG_INTERVAL = 60.0  # seconds between logging and outputting the pinger statistics
+# Linux socket option for nanosecond kernel receive timestamps. Python does not define it.
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)  # Linux: count of packets the socket dropped
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)  # Linux: SO_RCVBUF ignoring rmem_max
+SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)  # Linux: SO_SNDBUF ignoring wmem_max
+DROP_COUNTER = struct.Struct('@I')  # the uint32 sent with SO_RXQ_OVFL
+TIMESPEC = struct.Struct('@ll')  # struct timespec: tv_sec, tv_nsec
+# patches the checksum, id and sequence number of an echo request
+ECHO_PATCH = struct.Struct('!HHH')
+ICMP_HEADER = struct.Struct('!BBHHH')  # type, code, checksum, id, sequence number
+MAX_SEND_LAG = 1.0  # warn when sending falls this many seconds behind schedule
+# adaptive timeouts are computed like TCP's retransmission timeout (RFC 6298)
+MIN_TIMEOUT = 20  # default floor of the adaptive timeouts (milliseconds)
+MAX_TIMEOUT = 2000  # default ceiling of the adaptive timeouts (milliseconds)
+RTT_ALPHA = 0.125  # gain of the smoothed RTT
+RTT_BETA = 0.25  # gain of the RTT variance
+TIMEOUT_GRANULARITY = 0.001  # smallest variance term of a timeout (seconds)
+# upper bounds (milliseconds) of the buckets of the self-instrumentation timing histograms
+TIMING_BOUNDS = [0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000]
 
-class Pinger(Thread):
-    """ A wrapper class for a thread that pings hosts and adds results to a queue.
 
+class Burst(object):
+    """ Collects the results of one burst of echo requests to a destination. """
+    __slots__ = ('destination', 'count', 'send_time', 'sent', 'results', 'rtts')
+
+    def __init__(self, destination, count):
+        self.destination = destination
+        self.count = count  # requests in the burst
+        self.send_time = None  # when the first request was sent
+        self.sent = 0
+        self.results = 0  # replies and timeouts so far
+        self.rtts = []  # RTTs of the replies in the order they arrived
+
+    def add_result(self, rtt):
+        """ Record the RTT of a reply or None for a timeout. Returns True once every result is in. """
+        self.results += 1
+        if rtt is not None:
+            self.rtts.append(rtt)
+        return self.results >= self.count
+
+    def summary(self):
+        """ Returns (ip, send_time, sent, received, minimum, average, maximum, jitter).
+
+        Jitter is the mean difference between consecutive RTTs. The RTT
+        values are None if nothing replied.
+        """
+        rtts = self.rtts
+        if not rtts:
+            return self.destination, self.send_time, self.sent, 0, None, None, None, None
+        jitter = 0.0
+        if len(rtts) > 1:
+            jitter = sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) / (len(rtts) - 1)
+        return (self.destination, self.send_time, self.sent, len(rtts),
+                min(rtts), sum(rtts) / len(rtts), max(rtts), jitter)
+
+
+class TimingStats(object):
+    """ Count, total, maximum and histogram of the durations measured in one stats period. """
+    __slots__ = ('count', 'total', 'maximum', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0  # seconds
+        self.maximum = 0.0
+        self.histogram = [0] * (len(TIMING_BOUNDS) + 1)
+
+    def add(self, duration):
+        """ Add one duration in seconds. """
+        self.count += 1
+        self.total += duration
+        if duration > self.maximum:
+            self.maximum = duration
+        millis = duration * 1000
+        for i, bound in enumerate(TIMING_BOUNDS):
+            if millis <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.maximum,
+                'histogram': self.histogram}
+
+
+class PingerBase(object):
+    """ ICMP echo functionality shared by the threaded and asyncio pingers.
+
+    Subclasses decide how the sending and receiving is scheduled.
     Uses raw IP sockets so it requires root (or some other convoluted privileges).
+
+    Each destination's timeout is its smoothed RTT plus four times the RTT
+    variance, kept between min_timeout and max_timeout. timeout is used
+    until a destination has replied. A timeout doubles the destination's
+    timeout until the next reply.
+
+    Destinations can be sent a burst of several requests per interval. The
+    results of a burst are reduced to one summary (see Burst) that is output
+    in a 'summary' message instead of one reply per request.
+
+    All times are kept on the monotonic clock and converted to UNIX time when
+    they are output. Where the OS supports it, receive times come from kernel
+    timestamps so time spent waiting for this thread to run is not added to
+    the latency.
+
+    The socket's buffers can be enlarged with rcvbuf and sndbuf (bytes).
+    Where the OS supports it the kernel reports how many replies it dropped
+    because the receive buffer was full. Timeouts of requests that were in
+    flight when such drops happened are flagged, since the reply may have
+    arrived and been dropped by this host.
+
+    The pinger times its own send rounds, receive loops and how far sending
+    lags behind schedule. Those timings and its packet counters are output in
+    a 'prober_stats' message every STATS_LOG_INTERVAL seconds so the
+    collector can tell a starved prober from a lossy network.
     """
+    use_kernel_timestamps = True  # set False before starting to time receives in userspace
+    use_kernel_filter = True  # set False before starting to receive every ICMP packet
 
     def __init__(self, destinations, timeout=500, packet_size=55,
-                 output=sys.stdout, own_id=None, source_address=False):
-        super(Pinger, self).__init__()
-        logging.debug("Initialized Pinger. timeout: %i", timeout)
+                 output=sys.stdout, own_id=None, source_address=False,
+                 late_window=LATE_REPLY_WINDOW, interval=1.0, max_rate=0,
+                 min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT, rcvbuf=0, sndbuf=0):
+        """ interval is the default interval (seconds) for destinations set
+        without one. max_rate caps the packets sent per second (0 for no cap).
+        timeout, min_timeout and max_timeout are in milliseconds. rcvbuf and
+        sndbuf are the socket buffer sizes in bytes (0 for the OS default).
+        """
+        logging.debug("Initialized %s. timeout: %i", type(self).__name__, timeout)
         self.keep_going = True
+        self.resolver_cache = ResolverCache()
+        self.scheduler = IntervalScheduler(interval, max_rate, start_time=time.monotonic())
         self.set_destinations(destinations)
         self.output = output
         self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        # destination: (smoothed RTT, RTT variance, timeout), all in seconds
+        self.rtt_estimates = {}
         self.packet_size = packet_size
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
         if source_address is not False:
             self.source_address = socket.gethostbyname(source_address)
         if own_id is None:
             self.own_id = os.getpid() & 0xFFFF  # just the 2 low-order bytes
         else:
             self.own_id = own_id
+        self.make_packet_template()
 
-        self.seq_number = 0
+        self.seq_numbers = {}  # destination: next sequence number to send it
         self.send_count = 0
         self.receive_count = 0
+        self.late_count = 0
+        self.unmatched_count = 0
+        self.packet_count = 0  # every packet read from the socket
+        self.send_errors = 0
+        self.receive_errors = 0
+        self.kernel_drops = 0  # packets the kernel dropped from the socket's receive queue
+        self.kernel_drop_timeouts = 0  # timeouts that may have been kernel drops
+        self.drop_counter = False  # True once the socket reports drops with SO_RXQ_OVFL
+        # (start, end) monotonic times between which the kernel dropped replies
+        self.drop_windows = deque()
+        self.last_receive_time = time.monotonic()
+        self.worker = 0  # number of the worker process, for the stats of sharded pingers
+        # durations (seconds) measured since the last stats message
+        self.timings = {'send_round': TimingStats(), 'receive_loop': TimingStats(),
+                        'schedule_lag': TimingStats()}
+        self.published_counters = {}  # counters at the last stats message
+        self.last_stats_time = time.monotonic()
+        self.kernel_filter = False  # True once the socket has our BPF filter attached
+        self.icmp_in_start = None  # host ICMP InMsgs counter when the filter was attached
+        self.next_stats_time = time.monotonic() + STATS_LOG_INTERVAL
+
+        # echo requests waiting for a reply keyed on (destination, packet_id, seq_number).
+        # the values are (send_time, timeout, burst). burst is None for single requests.
+        self.in_flight = {}
+        self.timer_wheel = TimerWheel(start_time=time.monotonic())
+        # timed out requests keyed like in_flight. values are (send_time, forget_time, burst).
+        # insertion order is also expiry order so old entries are removed from the front.
+        self.expired = {}
+        self.late_window = late_window
+        self.late_replies = []  # (ip, receive_time, send_time) to send with the next output
+        # (ip, receive_time, send_time, timeout, kernel_drop) to send with the next output.
+        # receive_time is None for timeouts. kernel_drop is True for timeouts that may be
+        # replies dropped by the kernel.
+        self.replies = []
+        self.bursts = {}  # destination: Burst currently being sent
+        # (ip, send_time, sent, received, minimum, average, maximum, jitter) of
+        # completed bursts to send with the next output
+        self.summaries = []
+        self.next_output_time = time.monotonic() + OUTPUT_INTERVAL
+        self.kernel_timestamps = False  # True once the socket has kernel timestamps enabled
+        # every packet is read into this buffer so receiving does not allocate per packet
+        self.receive_buffer = bytearray(ICMP_MAX_RECV)
+        self.receive_view = memoryview(self.receive_buffer)
 
     def calculate_checksum(self, source_string):
         """
@@ -78,24 +258,40 @@ class Pinger(Thread):
 
         return answer
 
-    def set_destinations(self, destinations: List):
-        self.destinations = [socket.gethostbyname(_) for _ in destinations]
+    def set_destinations(self, destinations: List, intervals: List[float] = None,
+                         bursts: List[Tuple[int, float]] = None):
+        """ Set the destinations to ping and optionally their intervals in seconds
+        and bursts as (count, spacing in seconds) tuples.
+
+        Hostnames are resolved concurrently and this blocks until that is done. Use
+        resolver.TargetResolver to resolve them without blocking the caller.
+        Hostnames that do not resolve are skipped.
+        """
+        resolved = self.resolver_cache.resolve(destinations)
+        if intervals is None:
+            intervals = [self.scheduler.default_interval] * len(destinations)
+        if bursts is None:
+            bursts = [None] * len(destinations)
+        kept = [(resolved[_], interval, burst)
+                for _, interval, burst in zip(destinations, intervals, bursts)
+                if resolved[_] is not None]
+        self.destinations = [_[0] for _ in kept]
+        self.scheduler.set_destinations(self.destinations, [_[1] for _ in kept],
+                                        [_[2] for _ in kept])
 
     def stop(self):
         self.keep_going = False
 
-    def header2dict(self, names, struct_format, data):
-        """
-        unpack the raw received IP and ICMP header informations to a dict
-        """
-        unpacked_data = struct.unpack(struct_format, data)
-        return dict(zip(names, unpacked_data))
-
     def make_raw_socket(self):
         try:  # One could use UDP here, but it's obscure
             current_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW,
                                            socket.getprotobyname("icmp"))
             logging.info("Made raw socket")
+            self.enable_kernel_timestamps(current_socket)
+            self.size_buffers(current_socket)
+            self.enable_drop_counter(current_socket)
+            if self.use_kernel_filter:
+                self.enable_kernel_filter(current_socket)
             return current_socket
         except socket.error as e:
             if e.errno == 1:
@@ -110,154 +306,534 @@ class Pinger(Thread):
                 raise evalue
             raise  # raise the original error
 
-    def run(self):
-        """ send and receive pings """
-        start_time = time.time()
-        iteration = 0
+    def enable_kernel_timestamps(self, current_socket):
+        """ Ask the kernel to timestamp received packets (Linux only). """
+        self.kernel_timestamps = False
+        if not self.use_kernel_timestamps or not sys.platform.startswith('linux') \
+                or not hasattr(current_socket, 'recvmsg'):
+            logging.info("Using userspace receive timestamps")
+            return
         try:
-            current_socket = self.make_raw_socket()
-        except PermissionError:
-            logging.critical("Need root to make a raw socket. Shutting down...")
-            self.keep_going = False
+            current_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except OSError as e:
+            logging.warning("Could not enable kernel receive timestamps: %s", str(e))
+            return
+        self.kernel_timestamps = True
+        logging.info("Using kernel receive timestamps")
 
-        while self.keep_going:
-            logging.debug("Inside main loop")
-            iteration += 1
-            send_time = time.time()
-            for destination in self.destinations:
-                self.send_one_ping(current_socket, destination)
-
-            replies = self.receive_pings(current_socket, self.destinations)
-            self.handle_output(send_time, replies)
-
-            self.seq_number += 1
-            if self.seq_number > 65535:
-                self.seq_number -= 65536
-
-            # Pause for the remainder of the MAX_SLEEP period (if applicable)
-            time_left = start_time + iteration - time.time()
-            if time_left > 0:
-                time.sleep(time_left)
-            else:
-                msg = "Warning: iteration took longer than one second {:.2f}"
-                msg = msg.format(time_left * -1 + 1)
-                logging.warning(msg)
-        logging.info("Exited ping loop in Pinger:run()")
+    def size_buffers(self, current_socket):
+        """ Set the socket's receive and send buffer sizes if configured.
 
-    def send_one_ping(self, current_socket, destination):
+        Tries the Linux *BUFFORCE options first, which root may use to go past
+        the net.core.rmem_max and wmem_max limits.
         """
-        Send one ICMP ECHO_REQUEST
+        for size, force_option, option, name in (
+                (self.rcvbuf, SO_RCVBUFFORCE, socket.SO_RCVBUF, 'receive'),
+                (self.sndbuf, SO_SNDBUFFORCE, socket.SO_SNDBUF, 'send')):
+            if not size:
+                continue
+            try:
+                current_socket.setsockopt(socket.SOL_SOCKET, force_option, size)
+            except OSError:
+                try:
+                    current_socket.setsockopt(socket.SOL_SOCKET, option, size)
+                except OSError as e:
+                    logging.warning("Could not set %s buffer size: %s", name, str(e))
+                    continue
+            # Linux reports double the requested size (the extra is bookkeeping overhead)
+            logging.info("Socket %s buffer is %i bytes (requested %i)", name,
+                         current_socket.getsockopt(socket.SOL_SOCKET, option), size)
+
+    def enable_drop_counter(self, current_socket):
+        """ Ask the kernel to report the socket's drop counter with each packet (Linux only). """
+        self.drop_counter = False
+        if not sys.platform.startswith('linux') or not hasattr(current_socket, 'recvmsg'):
+            return
+        try:
+            current_socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError as e:
+            logging.warning("Could not enable kernel drop counter: %s", str(e))
+            return
+        self.drop_counter = True
+        logging.info("Using kernel drop counter")
+
+    def enable_kernel_filter(self, current_socket):
+        """ Attach a BPF filter so the socket only receives echo replies with our id. """
+        try:
+            attach_echo_reply_filter(current_socket, self.own_id)
+        except OSError as e:
+            logging.warning("Could not attach socket filter: %s", str(e))
+            return
+        self.kernel_filter = True
+        self.icmp_in_start = read_icmp_in_msgs()
+        self.packet_count = 0
+        logging.info("Attached socket filter for echo replies with id %i", self.own_id)
+
+    def receive_packet(self, current_socket, clock_offset):
+        """ Read one packet from the socket into receive_buffer.
+
+        Returns a tuple of (packet_length, receive_time). receive_time is on
+        the monotonic clock. It is the kernel timestamp if available.
+
+        :param clock_offset: UNIX time minus monotonic time, used to move kernel timestamps
+        """
+        if not self.kernel_timestamps and not self.drop_counter:
+            packet_length = current_socket.recv_into(self.receive_buffer)
+            self.packet_count += 1
+            return packet_length, time.monotonic()
+        packet_length, ancdata, flags, address = current_socket.recvmsg_into(
+            [self.receive_buffer],
+            socket.CMSG_SPACE(TIMESPEC.size) + socket.CMSG_SPACE(DROP_COUNTER.size))
+        self.packet_count += 1
+        receive_time = None
+        drops = None
+        for level, cmsg_type, cmsg_data in ancdata:
+            if level != socket.SOL_SOCKET:
+                continue
+            if cmsg_type == SO_TIMESTAMPNS:
+                seconds, nanoseconds = TIMESPEC.unpack_from(cmsg_data)
+                # the kernel timestamp is UNIX time. move it to the monotonic clock.
+                receive_time = seconds + nanoseconds / 1e9 - clock_offset
+            elif cmsg_type == SO_RXQ_OVFL:
+                drops = DROP_COUNTER.unpack_from(cmsg_data)[0]
+        if receive_time is None:
+            receive_time = time.monotonic()
+        if drops is not None and drops != self.kernel_drops:
+            self.note_kernel_drops(drops, receive_time)
+        self.last_receive_time = receive_time
+        return packet_length, receive_time
+
+    def note_kernel_drops(self, drops, receive_time):
+        """ Record that the kernel's drop counter for the socket went up to drops.
+
+        The counter is sent with a packet only once something was dropped and
+        it counts drops before that packet was queued, so the replies were
+        dropped after the previous packet arrived and before this one.
+        """
+        new_drops = (drops - self.kernel_drops) & 0xFFFFFFFF
+        self.kernel_drops = drops
+        self.drop_windows.append((self.last_receive_time, receive_time))
+        logging.warning("Kernel dropped %i packets from the socket's receive queue", new_drops)
+
+    def may_be_kernel_drop(self, send_time, expiry):
+        """ True if the kernel dropped packets while a request was waiting for its reply. """
+        return any(start < expiry and end > send_time for start, end in self.drop_windows)
+
+    def parse_echo_reply(self, packet_length):
+        """ Parse the IP packet containing an ICMP message in receive_buffer.
+
+        Returns a tuple of (source IP string, ICMP type, packet id, sequence
+        number) or None if the packet is too short.
+        """
+        header_length = (self.receive_buffer[0] & 0x0F) * 4
+        if packet_length < header_length + ICMP_HEADER.size:
+            return None
+        icmp_type, code, checksum, packet_id, seq_number = \
+            ICMP_HEADER.unpack_from(self.receive_buffer, header_length)
+        ip = socket.inet_ntoa(self.receive_view[12:16])
+        return ip, icmp_type, packet_id, seq_number
+
+    def receive_pings(self, current_socket):
+        """ Read and match every packet waiting on the non-blocking socket.
+
+        Stops after RECV_BATCH packets. The socket is still readable then, so
+        the caller comes straight back after doing its other work.
+        """
+        # one clock offset for the batch instead of reading both clocks per packet
+        start = time.monotonic()
+        clock_offset = time.time() - start
+        for _ in range(RECV_BATCH):
+            try:
+                packet_length, receive_time = self.receive_packet(current_socket, clock_offset)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.receive_errors += 1
+                logging.error("Error receiving from socket: %s", str(e))
+                break
+            reply = self.parse_echo_reply(packet_length)
+            if reply is None:
+                self.unmatched_count += 1
+                continue
+            ip, icmp_type, packet_id, seq_number = reply
+            self.handle_reply(ip, icmp_type, packet_id, seq_number, receive_time)
+        self.timings['receive_loop'].add(time.monotonic() - start)
+
+    def next_seq_number(self, destination):
+        """ Returns the next sequence number to use for destination. """
+        seq_number = self.seq_numbers.get(destination, 0)
+        self.seq_numbers[destination] = (seq_number + 1) & 0xFFFF
+        return seq_number
+
+    @staticmethod
+    def ones_complement_sum(data):
+        """ The 16-bit one's complement sum of data (big-endian words, zero padded). """
+        if len(data) % 2:
+            data = bytes(data) + b'\x00'
+        total = sum(struct.unpack('!%iH' % (len(data) // 2), data))
+        while total > 0xffff:
+            total = (total & 0xffff) + (total >> 16)
+        return total
+
+    def make_packet_template(self):
+        """ Build the echo request that send_one_ping() patches for each send.
+
+        The template has sequence number 0 and a zero checksum. Only the
+        sequence number changes between packets so the checksum can be
+        updated incrementally (RFC 1624) from the sum of the template.
         """
         # Header is type (8), code (8), checksum (16), id (16), sequence (16)
-        checksum = 0
-        # Make a dummy header with a 0 checksum.
-        header = struct.pack(
-            "!BBHHH", ICMP_ECHO, 0, checksum, self.own_id, self.seq_number
-        )
-        padBytes = []
+        header = struct.pack("!BBHHH", ICMP_ECHO, 0, 0, self.own_id, 0)
         startVal = 0x42
-        for i in range(startVal, startVal + (self.packet_size)):
-            padBytes += [(i & 0xff)]  # Keep chars in the 0-255 range
-        data = bytes(padBytes)
-
-        # Calculate the checksum on the data and the dummy header.
-        # Checksum is in network order
-        checksum = self.calculate_checksum(header + data)
-        # Now that we have the right checksum, we put that in. It's just easier
-        # to make up a new header than to stuff it into the dummy.
-        header = struct.pack(
-            "!BBHHH", ICMP_ECHO, 0, checksum, self.own_id, self.seq_number
-        )
+        data = bytes((i & 0xff) for i in range(startVal, startVal + self.packet_size))
+        self.packet = bytearray(header + data)
+        self.packet_sum = self.ones_complement_sum(self.packet)
 
-        packet = header + data
+    def send_one_ping(self, current_socket, destination, seq_number) -> bool:
+        """
+        Send one ICMP ECHO_REQUEST
 
+        Returns False if the socket did not accept the packet, e.g. with
+        EAGAIN or ENOBUFS from the non-blocking socket under load.
+        """
+        checksum = self.packet_sum + seq_number
+        checksum = ~((checksum & 0xffff) + (checksum >> 16)) & 0xffff
+        ECHO_PATCH.pack_into(self.packet, 2, checksum, self.own_id, seq_number)
         try:
             # Port number is irrelevant for ICMP
-            current_socket.sendto(packet, (destination, 1))
+            current_socket.sendto(self.packet, (destination, 1))
             logging.debug("Sent packet to %s", destination)
         except socket.error as e:
-            logging.error("General failure (%s)" % (e.args[1]))
-            return
+            self.send_errors += 1
+            logging.error("General failure (%s)" % str(e))
+            return False
         self.send_count += 1
+        return True
 
-    def receive_pings(self, current_socket, destinations):
-        # receive_time, packet_size, ip, ip_header, icmp_header =
-            # self.receive_one_ping(current_socket, destination)
-        max_time = self.timeout / 1000.0
-        timeout = max_time
-        start_time = time.time()
-        destinations_remaining = destinations[:]
-        replies = []
-        # print("receiving pings with seq_number", self.seq_number)
-        while True:
-            # call select() until we have received all pings or we time out
-            logging.debug("Calling select() to receive ping response with timeout: %f", timeout)
-            inputready, outputready, exceptready = \
-                select.select([current_socket], [], [], timeout)
-            if inputready == []:  # do not refactor this to "inputready is []"
-                # timeout
-                logging.debug("select() timed out")
-                break
-            receive_time = time.time()
-            packet_data, address = current_socket.recvfrom(ICMP_MAX_RECV)
-            logging.debug("Received packet from %s", address)
-            # print("packet from", address[0])
-            if address[0] in destinations_remaining:
-                icmp_header = self.header2dict(
-                    names=[
-                        "type", "code", "checksum",
-                        "packet_id", "seq_number"
-                    ],
-                    struct_format="!BBHHH",
-                    data=packet_data[20:28]
-                )
-
-                # print("receiving packet from", address[0],
-                #       "with seq_number", icmp_header["seq_number"],
-                #       "and own_id", icmp_header["packet_id"])
-                if icmp_header["packet_id"] == self.own_id and \
-                        icmp_header["seq_number"] == self.seq_number:
-                    # This is one of our packets
-                    ip_header = self.header2dict(
-                        names=[
-                            "version", "type", "length",
-                            "id", "flags", "ttl", "protocol",
-                            "checksum", "src_ip", "dest_ip"
-                        ],
-                        struct_format="!BBHHHBBHII",
-                        data=packet_data[:20]
-                    )
-                    ip = socket.inet_ntoa(struct.pack("!I",
-                                          ip_header["src_ip"]))
-                    replies.append((ip, receive_time))
-                    destinations_remaining.remove(ip)
-                else:
-                    logging.debug("Received ICMP message from valid "
-                                  "destination with invalid header.")
+    def send_due(self, current_socket, now):
+        """ Send the echo requests the scheduler says are due and track them as in flight. """
+        start = time.monotonic()
+        lag = self.scheduler.lag(now)
+        due = self.scheduler.pop_due(now)  # also applies new destinations
+        if not due:
+            return
+        lag = max(lag or 0.0, 0.0)
+        if lag > MAX_SEND_LAG:
+            logging.warning("Warning: sending is {:.2f} seconds behind schedule".format(lag))
+        self.timings['schedule_lag'].add(lag)
+        for destination, index in due:
+            burst = None
+            if index == 0:
+                self.end_burst(destination)
+                count = self.scheduler.burst_count(destination)
+                if count > 1:
+                    burst = self.bursts[destination] = Burst(destination, count)
             else:
-                logging.debug("Received ICMP packet from unexpected IP: %s", address[0])
-            timeout = max_time - (time.time() - start_time)
-            if timeout <= 0 or len(destinations_remaining) == 0:
+                burst = self.bursts.get(destination)
+            self.send_echo(current_socket, destination, burst)
+        self.timings['send_round'].add(time.monotonic() - start)
+
+    def send_echo(self, current_socket, destination, burst=None):
+        """ Send one echo request and add it to the in-flight table.
+
+        A request the socket did not accept is only counted in send_errors; it
+        is not tracked, so it is not reported as a timeout.
+        """
+        seq_number = self.next_seq_number(destination)
+        key = (destination, self.own_id, seq_number)
+        timeout = self.timeout_for(destination)
+        send_time = time.monotonic()
+        if not self.send_one_ping(current_socket, destination, seq_number):
+            return
+        self.in_flight[key] = (send_time, timeout, burst)
+        self.timer_wheel.add(send_time + timeout, key)
+        if burst is not None:
+            if not burst.sent:
+                burst.send_time = send_time
+            burst.sent += 1
+
+    def end_burst(self, destination):
+        """ Stop sending requests in destination's current burst.
+
+        A burst cut short by a schedule change is summarized with the
+        requests sent so far.
+        """
+        burst = self.bursts.pop(destination, None)
+        if burst is not None and burst.sent < burst.count:
+            burst.count = burst.sent
+            if burst.results >= burst.count:
+                self.summaries.append(burst.summary())
+
+    def timeout_for(self, destination):
+        """ The timeout (seconds) for the next echo request to destination. """
+        estimate = self.rtt_estimates.get(destination)
+        if estimate is None:
+            return self.clamp_timeout(self.timeout / 1000.0)
+        return estimate[2]
+
+    def clamp_timeout(self, timeout):
+        return min(max(timeout, self.min_timeout / 1000.0), self.max_timeout / 1000.0)
+
+    def update_rtt(self, destination, rtt):
+        """ Update destination's smoothed RTT, RTT variance and timeout with an RTT sample. """
+        estimate = self.rtt_estimates.get(destination)
+        if estimate is None:
+            srtt, rttvar = rtt, rtt / 2
+        else:
+            srtt, rttvar = estimate[0], estimate[1]
+            rttvar = (1 - RTT_BETA) * rttvar + RTT_BETA * abs(srtt - rtt)
+            srtt = (1 - RTT_ALPHA) * srtt + RTT_ALPHA * rtt
+        timeout = self.clamp_timeout(srtt + max(TIMEOUT_GRANULARITY, 4 * rttvar))
+        self.rtt_estimates[destination] = (srtt, rttvar, timeout)
+
+    def back_off_timeout(self, destination):
+        """ Double destination's timeout after a request to it timed out. """
+        estimate = self.rtt_estimates.get(destination)
+        if estimate is not None:
+            srtt, rttvar, timeout = estimate
+            self.rtt_estimates[destination] = (srtt, rttvar, self.clamp_timeout(timeout * 2))
+
+    def forget_old_destinations(self):
+        """ Drop the RTT estimates, sequence numbers and bursts of destinations that are no longer pinged. """
+        for destination in [_ for _ in self.rtt_estimates if _ not in self.scheduler.intervals]:
+            del self.rtt_estimates[destination]
+        for destination in [_ for _ in self.seq_numbers if _ not in self.scheduler.intervals]:
+            del self.seq_numbers[destination]
+        for destination in [_ for _ in self.bursts if _ not in self.scheduler.intervals]:
+            self.end_burst(destination)
+
+    def wake_time(self):
+        """ The next time something needs to be sent, expired or output. """
+        wake_time = self.next_output_time
+        next_send_time = self.scheduler.next_send_time()
+        if next_send_time is not None:
+            wake_time = min(wake_time, next_send_time)
+        next_expiry = self.timer_wheel.next_expiry()
+        if next_expiry is not None:
+            wake_time = min(wake_time, next_expiry)
+        return wake_time
+
+    def handle_reply(self, ip, icmp_type, packet_id, seq_number, receive_time):
+        """ Match a received echo reply against the in-flight requests. """
+        if icmp_type != ICMP_ECHOREPLY or packet_id != self.own_id:
+            logging.debug("Received ICMP message that is not a reply to us from %s", ip)
+            return
+        key = (ip, packet_id, seq_number)
+        request = self.in_flight.pop(key, None)
+        if request is not None:
+            send_time, timeout, burst = request
+            self.receive_count += 1
+            if burst is None:
+                self.replies.append((ip, receive_time, send_time, timeout, False))
+            elif burst.add_result(receive_time - send_time):
+                self.summaries.append(burst.summary())
+            self.update_rtt(ip, receive_time - send_time)
+        elif key in self.expired:
+            send_time, forget_time, burst = self.expired.pop(key)
+            logging.debug("Received late reply from %s after %.3fs", ip, receive_time - send_time)
+            self.late_count += 1
+            if burst is None:
+                # bursts are not reported. their summary already counted this as lost.
+                self.late_replies.append((ip, receive_time, send_time))
+            self.update_rtt(ip, receive_time - send_time)
+        else:
+            self.unmatched_count += 1
+            logging.debug("Received ICMP echo reply from %s that we are not waiting for", ip)
+
+    def expire_echoes(self, now):
+        """ Time out every in-flight request whose timer has expired. """
+        for key in self.timer_wheel.advance(now):
+            request = self.in_flight.pop(key, None)
+            if request is None:
+                continue  # already answered
+            send_time, timeout, burst = request
+            kernel_drop = bool(self.drop_windows) and \
+                self.may_be_kernel_drop(send_time, send_time + timeout)
+            if kernel_drop:
+                self.kernel_drop_timeouts += 1
+            if burst is None:
+                self.replies.append((key[0], None, send_time, timeout, kernel_drop))
+            elif burst.add_result(None):
+                self.summaries.append(burst.summary())
+            self.expired[key] = (send_time, now + self.late_window, burst)
+            self.back_off_timeout(key[0])
+        # forget drops older than every request still in flight. in_flight is in send order.
+        while self.drop_windows and (not self.in_flight or
+                                     next(iter(self.in_flight.values()))[0] > self.drop_windows[0][1]):
+            self.drop_windows.popleft()
+        # forget timed out requests that are too old to be reported as late
+        while self.expired:
+            key = next(iter(self.expired))
+            if self.expired[key][1] > now:
                 break
-        for ip in destinations_remaining:
-            replies.append((ip, None))
-        logging.debug("Returning %i replies", len(replies))
-        return replies
+            del self.expired[key]
+
+    def filtered_count(self) -> Optional[int]:
+        """ How many ICMP packets the socket filter kept from reaching this pinger.
+
+        Estimated from the host's ICMP InMsgs counter, so traffic for other
+        ICMP sockets on the host is counted as filtered too.
+
+        :return: the count or None if there is no filter or counter
+        """
+        if not self.kernel_filter or self.icmp_in_start is None:
+            return None
+        icmp_in = read_icmp_in_msgs()
+        if icmp_in is None:
+            return None
+        return max(icmp_in - self.icmp_in_start - self.packet_count, 0)
+
+    def log_stats(self):
+        filtered = self.filtered_count()
+        logging.info("Pinger stats: sent: %i received: %i late: %i unmatched: %i "
+                     "packets read: %i filtered in kernel: %s in flight: %i "
+                     "send errors: %i receive errors: %i kernel drops: %s",
+                     self.send_count, self.receive_count, self.late_count,
+                     self.unmatched_count, self.packet_count,
+                     'n/a' if filtered is None else filtered, len(self.in_flight),
+                     self.send_errors, self.receive_errors,
+                     self.kernel_drops if self.drop_counter else 'n/a')
+
+    def counters(self):
+        """ The packet and error counters since the pinger started. """
+        return {'sent': self.send_count, 'received': self.receive_count,
+                'late': self.late_count, 'unmatched': self.unmatched_count,
+                'packets': self.packet_count, 'send_errors': self.send_errors,
+                'receive_errors': self.receive_errors, 'kernel_drops': self.kernel_drops,
+                'kernel_drop_timeouts': self.kernel_drop_timeouts}
 
-    def handle_output(self, send_time, replies):
+    def output_stats(self, now):
+        """ Output the counters and timings since the last call as a 'prober_stats' message.
+
+        Counters are the increase since the last message. Timings are reset.
+        """
+        counters = self.counters()
+        deltas = {name: value - self.published_counters.get(name, 0)
+                  for name, value in counters.items()}
+        data = {'type': 'prober_stats', 'send_time': time.time(),
+                'period': now - self.last_stats_time, 'worker': self.worker,
+                'buckets': TIMING_BOUNDS, 'counters': deltas,
+                'gauges': {'in_flight': len(self.in_flight),
+                           'destinations': len(self.scheduler.intervals)},
+                'timings': {name: _.to_dict() for name, _ in self.timings.items()}}
+        self.published_counters = counters
+        self.last_stats_time = now
+        self.timings = {name: TimingStats() for name in self.timings}
+        if self.output != sys.stdout:
+            self.output.put_nowait(data)
+
+    def flush_output(self, now):
+        """ Output the replies and timeouts collected since the last output, if it is time. """
+        if now >= self.next_stats_time:
+            self.next_stats_time = now + STATS_LOG_INTERVAL
+            self.log_stats()
+            self.output_stats(now)
+            self.forget_old_destinations()
+        if now < self.next_output_time:
+            return
+        self.next_output_time += OUTPUT_INTERVAL
+        if self.next_output_time <= now:
+            self.next_output_time = now + OUTPUT_INTERVAL
+        if not self.replies and not self.late_replies and not self.summaries:
+            return
+        # convert from the monotonic clock to UNIX time. using one offset for the
+        # whole batch keeps each latency exactly as measured.
+        offset = time.time() - time.monotonic()
+        replies = [(ip, None if receive_time is None else receive_time + offset,
+                    send_time + offset, timeout, kernel_drop)
+                   for ip, receive_time, send_time, timeout, kernel_drop in self.replies]
+        late_replies = [(ip, receive_time + offset, send_time + offset)
+                        for ip, receive_time, send_time in self.late_replies]
+        summaries = [(_[0], _[1] + offset) + _[2:] for _ in self.summaries]
+        self.replies = []
+        self.late_replies = []
+        self.summaries = []
+        send_time = min(_[2] for _ in replies) if replies else now + offset
+        logging.debug("Returning %i replies and %i summaries", len(replies), len(summaries))
+        self.handle_output(send_time, replies, late_replies, summaries)
+
+    def handle_output(self, send_time, replies, late_replies=(), summaries=()):
         if self.output == sys.stdout:
-            self.print_output(send_time, replies)
-        else:
+            if replies or late_replies or not summaries:
+                self.print_output(send_time, replies)
+            for ip, receive_time, late_send_time in late_replies:
+                millis = (receive_time - late_send_time) * 1000
+                print("late reply from {0} in {1:.1f} ms".format(ip, millis))
+            for summary in summaries:
+                self.print_summary(summary)
+            return
+        # put_nowait() works for both queue.Queue and asyncio.Queue
+        if replies or late_replies:
             data = {'type': 'output', 'send_time': send_time,
                     'replies': replies}
-            self.output.put(data)
+            if late_replies:
+                data['late'] = late_replies
+            self.output.put_nowait(data)
+        if summaries:
+            data = {'type': 'summary', 'send_time': min(_[1] for _ in summaries),
+                    'summaries': summaries}
+            self.output.put_nowait(data)
 
     def print_output(self, send_time, replies):
         if len(replies) == 0:
             print("No replies")
         for reply in replies:
-            if reply[1] is None:
+            if reply[1] is None and reply[4]:
+                print("no reply from {0} (the kernel dropped replies meanwhile)".format(reply[0]))
+            elif reply[1] is None:
                 print("no reply from {0}".format(reply[0]))
             else:
-                millis = (reply[1] - send_time) * 1000
+                millis = (reply[1] - reply[2]) * 1000
                 print("reply from {0} in {1:.1f} ms".format(reply[0], millis))
+
+    def print_summary(self, summary):
+        ip, send_time, sent, received, minimum, average, maximum, jitter = summary
+        if not received:
+            print("burst to {0}: 0/{1} replies".format(ip, sent))
+            return
+        print("burst to {0}: {1}/{2} replies min/avg/max/jitter = "
+              "{3:.1f}/{4:.1f}/{5:.1f}/{6:.1f} ms".format(
+                  ip, received, sent, minimum * 1000, average * 1000, maximum * 1000, jitter * 1000))
+
+
+class Pinger(PingerBase, Thread):
+    """ A wrapper class for a thread that pings hosts and adds results to a queue.
+
+    Uses raw IP sockets so it requires root (or some other convoluted privileges).
+    """
+
+    def __init__(self, destinations, timeout=500, packet_size=55,
+                 output=sys.stdout, own_id=None, source_address=False,
+                 late_window=LATE_REPLY_WINDOW, interval=1.0, max_rate=0,
+                 min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT, rcvbuf=0, sndbuf=0):
+        Thread.__init__(self)
+        PingerBase.__init__(self, destinations, timeout, packet_size, output,
+                            own_id, source_address, late_window, interval, max_rate,
+                            min_timeout, max_timeout, rcvbuf, sndbuf)
+
+    def run(self):
+        """ send and receive pings
+
+        Echo requests are sent when the scheduler says they are due. Replies
+        are received continuously and matched against the in-flight requests.
+        Collected results are output once per OUTPUT_INTERVAL.
+        """
+        try:
+            current_socket = self.make_raw_socket()
+        except PermissionError:
+            logging.critical("Need root to make a raw socket. Shutting down...")
+            self.keep_going = False
+        else:
+            current_socket.setblocking(False)
+
+        while self.keep_going:
+            self.send_due(current_socket, time.monotonic())
+            timeout = max(self.wake_time() - time.monotonic(), 0.0)
+            inputready, outputready, exceptready = \
+                select.select([current_socket], [], [], timeout)
+            if inputready:
+                self.receive_pings(current_socket)
+            now = time.monotonic()
+            self.expire_echoes(now)
+            self.flush_output(now)
+        logging.info("Exited ping loop in Pinger:run()")
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:12
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingweb', '0014_collectormessage_read'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='probegroup',
+            name='interval',
+            field=models.PositiveIntegerField(default=1000, help_text='Milliseconds between probes of each target (100 - 60000)', validators=[django.core.validators.MinValueValidator(100), django.core.validators.MaxValueValidator(60000)]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:14
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingweb', '0015_probegroup_interval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='probegroup',
+            name='burst_count',
+            field=models.PositiveIntegerField(default=1, help_text='Echo requests sent to each target per interval (1 - 20). More than 1 stores one summary per burst.', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(20)]),
+        ),
+        migrations.AddField(
+            model_name='probegroup',
+            name='burst_spacing',
+            field=models.PositiveIntegerField(default=20, help_text='Milliseconds between the echo requests of a burst (1 - 1000)', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(1000)]),
+        ),
+    ]
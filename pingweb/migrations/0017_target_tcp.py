@@ -0,0 +1,24 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:25
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingweb', '0016_probegroup_burst'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='target',
+            name='port',
+            field=models.PositiveIntegerField(blank=True, help_text='Required for TCP connect targets', null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(65535)]),
+        ),
+        migrations.AlterField(
+            model_name='target',
+            name='type',
+            field=models.CharField(choices=[('icmp', 'ICMP'), ('tcp', 'TCP connect')], default='icmp', max_length=4),
+        ),
+    ]
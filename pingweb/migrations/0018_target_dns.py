@@ -0,0 +1,29 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:26
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingweb', '0017_target_tcp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='target',
+            name='query_name',
+            field=models.CharField(blank=True, default='', help_text='Name to look up for DNS query targets', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='target',
+            name='port',
+            field=models.PositiveIntegerField(blank=True, help_text='Required for TCP connect targets. DNS query targets default to 53.', null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(65535)]),
+        ),
+        migrations.AlterField(
+            model_name='target',
+            name='type',
+            field=models.CharField(choices=[('icmp', 'ICMP'), ('tcp', 'TCP connect'), ('dns', 'DNS query')], default='icmp', max_length=4),
+        ),
+    ]
@@ -1,7 +1,9 @@
 from django.forms import ModelForm, TextInput, CheckboxSelectMultiple
+from django.core.validators import MinValueValidator, MaxValueValidator
+from django.core.exceptions import ValidationError
 from django.db import models
 from enum import IntEnum
-from typing import List
+from typing import Dict, List
 
 
 class Prober(models.Model):
@@ -26,6 +28,28 @@ class Prober(models.Model):
             targets.update(group.targets.all())
         return targets
 
+    def get_target_settings(self) -> Dict['Target', Dict[str, int]]:
+        """ Get this prober's targets and how to probe each of them.
+
+        A target in more than one probe group uses the settings of the group
+        with the shortest interval. Of groups with the same interval, the one
+        with the largest burst is used.
+
+        :return: a dict of Target: {'interval': ms, 'burst_count': n, 'burst_spacing': ms}
+        """
+        settings = {}
+        for group in self.probegroup_set.all():
+            for target in group.targets.all():
+                old = settings.get(target)
+                if old is None or (group.interval, -group.burst_count) < \
+                        (old['interval'], -old['burst_count']):
+                    settings[target] = {
+                        'interval': group.interval,
+                        'burst_count': group.burst_count,
+                        'burst_spacing': group.burst_spacing,
+                    }
+        return settings
+
 
 class ProberForm(ModelForm):
     class Meta:
@@ -41,6 +65,8 @@ class Target(models.Model):
 
     class TargetType(models.TextChoices):
         ICMP = 'icmp', 'ICMP'
+        TCP = 'tcp', 'TCP connect'
+        DNS = 'dns', 'DNS query'
 
     id = models.BigAutoField(primary_key=True)
     name = models.CharField(max_length=128)
@@ -48,12 +74,23 @@ class Target(models.Model):
     ip = models.GenericIPAddressField(protocol='IPv4', verbose_name="IP Address")
     type = models.CharField(max_length=4, choices=TargetType.choices,
                             default=TargetType.ICMP)
-    port = models.PositiveIntegerField(blank=True, null=True)
+    port = models.PositiveIntegerField(blank=True, null=True,
+                                       validators=[MinValueValidator(1), MaxValueValidator(65535)],
+                                       help_text='Required for TCP connect targets. '
+                                                 'DNS query targets default to 53.')
+    query_name = models.CharField(max_length=255, blank=True, default='',
+                                  help_text='Name to look up for DNS query targets')
     added = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f'{self.name} - {self.ip} ({self.id})'
 
+    def clean(self):
+        if self.type == self.TargetType.TCP and not self.port:
+            raise ValidationError({'port': 'TCP connect targets need a port.'})
+        if self.type == self.TargetType.DNS and not self.query_name:
+            raise ValidationError({'query_name': 'DNS query targets need a name to look up.'})
+
     def get_absolute_url(self):
         return f"/configure/target/{self.id}"
 
@@ -77,6 +114,16 @@ class ProbeGroup(models.Model):
     description = models.TextField(blank=True, null=True)
     probers = models.ManyToManyField(Prober, blank=True)
     targets = models.ManyToManyField(Target, blank=True)
+    interval = models.PositiveIntegerField(
+        default=1000, validators=[MinValueValidator(100), MaxValueValidator(60000)],
+        help_text="Milliseconds between probes of each target (100 - 60000)")
+    burst_count = models.PositiveIntegerField(
+        default=1, validators=[MinValueValidator(1), MaxValueValidator(20)],
+        help_text="Echo requests sent to each target per interval (1 - 20). "
+                  "More than 1 stores one summary per burst.")
+    burst_spacing = models.PositiveIntegerField(
+        default=20, validators=[MinValueValidator(1), MaxValueValidator(1000)],
+        help_text="Milliseconds between the echo requests of a burst (1 - 1000)")
     added = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
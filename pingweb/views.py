@@ -178,7 +178,20 @@ def list_prober(request: HttpRequest):
             return redirect(request.path_info)
     else:
         form = ProberForm()
-    data = {'probers': probers, 'form': form}
+    error = ''
+    stats = {}
+    try:
+        stats = db.get_latest_prober_stats()
+    except Exception as e:
+        error = 'Error talking to InfluxDB: ' + str(e)
+    for prober in probers:
+        prober.stats = stats.get(prober.name)
+        if prober.stats:
+            period = prober.stats['period']
+            prober.stats['send_rate'] = prober.stats['sent'] / period if period else 0.0
+            for name in ('send_round_max', 'receive_loop_max', 'schedule_lag_max'):
+                prober.stats[name + '_ms'] = prober.stats[name] * 1000
+    data = {'probers': probers, 'form': form, 'error': error}
     return render(request, 'list_prober.html', data)
 
 
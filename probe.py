@@ -10,30 +10,59 @@ Note that ICMP messages can only be sent from processes running as root
 GNU GPL v2 license  -  see LICENSE
 """
 from websockets.client import WebSocketClientProtocol as WebSocket
-from queue import Queue as TQueue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
 import websockets
 import asyncio
 import logging
 import random
 import signal
-import socket
-import queue
 import json
 import time
 
+from resolver import ResolverCache, TargetResolver
+from probedb import ProberDatabase, ResultSpool
+from results_bridge import ResultsBridge
+import results_bridge
+from rollup import RollupOutput, ROLLUP_FLUSH_INTERVAL
+from sharded_pinger import ShardedPinger
+from tcp_prober import TcpProber
+from dns_prober import DnsProber
+from async_pinger import AsyncPinger
 from pinger import Pinger
+import ws_compression
+import wire_format
 import misc
 import env
 
 MAX_SLEEP = 1000
 MESSAGE_ACK_TIMEOUT = 5.0  # how long to wait (seconds) before re-queueing a message to transmit
+CONNECTION_STATS_INTERVAL = 60.0  # seconds between connection_stats messages
+SPOOL_INTERVAL = 1.0  # seconds between moving messages to or from the spool
 
-results_queue = None
+results_queue: ResultsBridge = None
 event_loop = None
 keep_going = True
-pinger: Pinger = None
-
-
+pinger: Union[Pinger, AsyncPinger, ShardedPinger] = None
+target_resolver: TargetResolver = None
+tcp_prober: TcpProber = None
+# id of the next message transmitted. ids are never reused, even across reconnects.
+next_message_id = random.randint(0, 2 ** 40)
+dns_prober: DnsProber = None
+# set when the collector accepted the binary output encoding (see wire_format.py).
+# target_index maps the ips of the last target_list to their index in it.
+binary_output = False
+target_index: Dict[str, int] = {}
+target_list_version = 0
+# on-disk spool of the messages that do not fit in memory. None if spooling is disabled.
+# It is only used from spool_executor's thread so SQLite does not stall the event loop.
+spool: Optional[ResultSpool] = None
+spool_executor: Optional[ThreadPoolExecutor] = None
+# spool_ids of spooled messages the collector acknowledged, deleted by spool_results()
+acked_spool_ids: List[int] = []
+# unconfirmed transmitted messages keyed on message id
+unconfirmed: Dict[int, dict] = {}
+rollup_output: Optional[RollupOutput] = None  # None unless the prober sends rollups
 
 
 def ping(timeout=500, packet_size=55, *args, **kwargs):
@@ -42,87 +71,363 @@ def ping(timeout=500, packet_size=55, *args, **kwargs):
     p.run()
 
 
-async def maintain_collector_connection(results_queue: TQueue,
-                                        unconfirmed_list: list):
+async def maintain_collector_connection(results_queue: ResultsBridge,
+                                        unconfirmed: Dict[int, dict]):
     """ Coroutine to connect to collector and re-connect if connection fails.
 
     Starts the other coroutines and restarts them if they stop.
 
-    :param results_queue: thread-safe queue of messages to transmit
-    :param unconfirmed_list: a list of unconfirmed transmitted messages
+    :param results_queue: queue of messages to transmit
+    :param unconfirmed: unconfirmed transmitted messages keyed on message id
     :return: None
     """
     global keep_going
     url = env.get_env_string('PROBER_WS_URL')
     name = env.get_env_string('PROBER_NAME')
+    compression = {'compression': env.get_env_string('PROBER_WS_COMPRESSION'),
+                   'level': int(env.get_env_string('PROBER_WS_COMPRESSION_LEVEL')),
+                   'window_bits': int(env.get_env_string('PROBER_WS_COMPRESSION_WINDOW_BITS'))}
+    extensions = ws_compression.client_extensions(**compression)
     transmit_task = None
     receive_task = None
     requeue_task = None
+    drain_task = None
+    if spool is not None:
+        drain_rate = int(env.get_env_string('PROBER_SPOOL_DRAIN_RATE'))
+        # spools while the collector is unreachable too, so it is started once
+        asyncio.ensure_future(spool_results(results_queue))
     while keep_going:
         logging.info("Connecting to websocket: %s", url)
         try:
-            websocket = await websockets.connect(url)
+            websocket = await websockets.connect(url, compression=None, extensions=extensions)
             logging.debug("Connected to websocket %s", url)
             auth_message = {'type': 'auth', 'name': name, }
+            if int(env.get_env_string('PROBER_BINARY_OUTPUT')):
+                auth_message['encodings'] = [wire_format.ENCODING]
+            set_binary_output(None)  # JSON until this collector's target_list says otherwise
             await websocket.send(json.dumps(auth_message))
         except OSError as e:
             logging.error("Error connecting to websocket: %s", str(e))
             await asyncio.sleep(1)
             continue
+        reported = {}
+        next_report_time = time.monotonic() + CONNECTION_STATS_INTERVAL
         while keep_going and websocket.open:
             if transmit_task is None or transmit_task.done():
-                transmit_task = asyncio.ensure_future(transmit_results(results_queue, websocket, unconfirmed_list))
+                transmit_task = asyncio.ensure_future(transmit_results(results_queue, websocket, unconfirmed))
             if receive_task is None or receive_task.done():
-                receive_task = asyncio.ensure_future(receive_messages(websocket, unconfirmed_list))
+                receive_task = asyncio.ensure_future(receive_messages(websocket, unconfirmed))
             if requeue_task is None or requeue_task.done():
-                requeue_task = asyncio.ensure_future(requeue_stale_messages(unconfirmed_list, results_queue))
+                requeue_task = asyncio.ensure_future(requeue_stale_messages(unconfirmed, results_queue))
+            if spool is not None and (drain_task is None or drain_task.done()):
+                drain_task = asyncio.ensure_future(drain_spool(websocket, results_queue, drain_rate))
+            if time.monotonic() >= next_report_time:
+                reported = report_connection_stats(websocket, results_queue, compression, reported)
+                next_report_time += CONNECTION_STATS_INTERVAL
             await asyncio.sleep(1)
+        ws_compression.log_byte_counts(websocket, "to " + url)
         logging.info("websocket died or keep_going is False")
     logging.info("keep_going is False in maintain_collector_connection()")
 
 
-async def transmit_results(results_queue: TQueue, websocket: WebSocket, unconfirmed_list: list):
+def report_connection_stats(websocket: WebSocket, results_queue: ResultsBridge,
+                            compression: dict, reported: dict) -> dict:
+    """ Queue a connection_stats message for the collector.
+
+    It has the results queue's gauges and counters, the connection's byte
+    counts if the connection is compressed and the spool's if spooling is
+    enabled. Counters are the increase since the last message; the byte
+    counts start at 0 with each connection.
+
+    :param compression: the compression settings
+    :param reported: the counters returned by the previous call for this connection
+    :return: the current counters
+    """
+    counts = ws_compression.get_byte_counts(websocket)
+    totals = {}
+    message = {'type': 'connection_stats', 'send_time': time.time(),
+               'period': CONNECTION_STATS_INTERVAL}
+    message.update(compression)
+    if counts is None:
+        message['compression'] = ws_compression.COMPRESSION_NONE
+    else:
+        totals.update(counts.to_dict())
+        logging.info("Websocket compression ratio: %.2f", counts.ratio())
+    stats = results_queue.stats()
+    message['queue_depth'] = stats.pop('queue_depth')
+    totals.update(stats)
+    if spool is not None:
+        stats = spool.stats()
+        message['spool_depth'] = stats.pop('spool_depth')
+        message['spool_bytes'] = stats.pop('spool_bytes')
+        totals.update(stats)
+    message.update({_: value - reported.get(_, 0) for _, value in totals.items()})
+    results_queue.put_nowait(message)
+    return totals
+
+
+def take_messages(results_queue: ResultsBridge, count: int) -> list:
+    """ Remove up to count messages from the front of the results queue without waiting. """
+    messages = []
+    while len(messages) < count:
+        try:
+            messages.append(results_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return messages
+
+
+def take_acked_spool_ids() -> List[int]:
+    """ Remove and return the spool_ids acknowledged since the last call. """
+    global acked_spool_ids
+    row_ids = acked_spool_ids
+    acked_spool_ids = []
+    return row_ids
+
+
+async def spool_results(results_queue: ResultsBridge):
+    """ Coroutine to move the messages spilled from the full results queue to the spool.
+
+    Runs whether or not the collector is connected, so a collector outage
+    fills the spool on disk instead of memory. The messages spilled in one
+    SPOOL_INTERVAL are written in one transaction, on spool_executor's
+    thread. Spooled messages the collector acknowledged are deleted from
+    the spool and spilled ones that came from the spool are given back to it.
+
+    :param results_queue: queue of messages to transmit
+    :return: None
+    """
+    global keep_going
+    loop = asyncio.get_event_loop()
+    while keep_going:
+        await asyncio.sleep(SPOOL_INTERVAL)
+        try:
+            await move_to_spool(results_queue, loop)
+        except Exception:
+            # this task is never restarted, so it must outlive any error
+            logging.exception("Error moving messages to or from the spool")
+
+
+async def move_to_spool(results_queue: ResultsBridge, loop: asyncio.AbstractEventLoop):
+    """ Delete the acknowledged messages from the spool and spool the spilled ones. See spool_results(). """
+    acked = take_acked_spool_ids()
+    if acked:
+        await loop.run_in_executor(spool_executor, spool.delete, acked)
+    messages = results_queue.take_overflow()
+    released = [_['spool_id'] for _ in messages if 'spool_id' in _]
+    if released:
+        # still in the spool, so they are read again instead of spooled twice
+        await loop.run_in_executor(spool_executor, spool.release, released)
+        messages = [_ for _ in messages if 'spool_id' not in _]
+    if messages:
+        await loop.run_in_executor(spool_executor, spool.push, messages)
+        logging.debug("Spooled %i messages. Spool depth: %i", len(messages), spool.depth)
+
+
+async def drain_spool(websocket: WebSocket, results_queue: ResultsBridge, rate: int):
+    """ Coroutine to move spooled messages back to results_queue while connected.
+
+    Moves up to rate messages per SPOOL_INTERVAL, and only while results_queue
+    is less than half full, so a backlog is sent in large batches without
+    crowding out new results. The messages stay in the spool until the
+    collector acknowledges them (see handle_output_ack()).
+
+    :param websocket: the connection to the collector. returns when it closes
+    :param results_queue: queue of messages to transmit
+    :param rate: maximum messages moved per SPOOL_INTERVAL
+    :return: None
+    """
+    global keep_going
+    loop = asyncio.get_event_loop()
+    while keep_going and websocket.open:
+        await asyncio.sleep(SPOOL_INTERVAL)
+        count = min(rate, results_queue.maxsize // 2 - results_queue.qsize())
+        if count <= 0 or not spool.unread():
+            continue
+        messages = await loop.run_in_executor(spool_executor, spool.read, count)
+        for message in messages:
+            results_queue.put_nowait(message)
+        logging.debug("Unspooled %i messages. Spool depth: %i", len(messages), spool.depth)
+
+
+async def flush_rollups(output: RollupOutput):
+    """ Coroutine to send the rollups of finished periods even when no output arrives.
+
+    :param output: the RollupOutput the pinger outputs to
+    :return: None
+    """
+    global keep_going
+    while keep_going:
+        await asyncio.sleep(ROLLUP_FLUSH_INTERVAL)
+        output.flush(time.time())
+
+
+def save_unsent_messages():
+    """ Move the queued and unconfirmed messages to the spool so they survive a restart.
+
+    Messages read from the spool are still in it and are not spooled again.
+    Waits for spool_executor to write them.
+    """
+    messages = list(unconfirmed.values()) + results_queue.take_overflow() + \
+        take_messages(results_queue, results_queue.qsize())
+    unconfirmed.clear()
+    messages = [_ for _ in messages if 'spool_id' not in _]
+    spool_executor.submit(spool.delete, take_acked_spool_ids()).result()
+    if messages:
+        spool_executor.submit(spool.push, messages).result()
+        logging.warning("Spooled %i unsent messages", len(messages))
+
+
+async def get_message(results_queue: ResultsBridge, timeout: float) -> Optional[dict]:
+    """ Get the next message from the results queue, waiting up to timeout seconds.
+
+    :return: the message or None if there was none before the timeout
+    """
+    try:
+        return await asyncio.wait_for(results_queue.get(), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def read_batch(results_queue: ResultsBridge, max_messages: int, max_delay: float) -> list:
+    """ Wait for a message and collect the messages following it into a batch.
+
+    Returns once the batch has max_messages messages or max_delay seconds
+    after the first message arrived. Returns an empty list if no message
+    arrived within a second.
+    """
+    data = await get_message(results_queue, 1.0)
+    if data is None:
+        return []
+    batch = [data]
+    deadline = time.monotonic() + max_delay
+    while len(batch) < max_messages:
+        data = await get_message(results_queue, deadline - time.monotonic())
+        if data is None:
+            break
+        batch.append(data)
+    return batch
+
+
+async def transmit_results(results_queue: ResultsBridge, websocket: WebSocket,
+                           unconfirmed: Dict[int, dict]):
     """ Coroutine to send ping results to collector (server) over a websocket.
 
-    JSON-dumps items from the queue and sends them over the websocket. Adds
-    each sent item to the unconfirmed_queue for some other task to verify.
+    Coalesces the messages from the queue into 'batch' frames (see
+    read_batch()) and sends them over the websocket. Each message gets the
+    next message id, so ids increase in transmit order and the messages of a
+    batch have consecutive ids. Sent messages are kept in unconfirmed until
+    the collector acknowledges them.
 
-    :param results_queue: thread-safe queue of messages to transmit
+    If the collector accepted the binary encoding, the output messages whose
+    targets are all in the last target list are sent in a binary frame
+    instead and the rest of the batch as JSON.
+
+    :param results_queue: queue of messages to transmit
     :param websocket: already connected websocket from websockets package
-    :param unconfirmed_list: a list of unconfirmed transmitted messages
+    :param unconfirmed: unconfirmed transmitted messages keyed on message id
     :return: None
     """
     global keep_going
-    nonce = random.randint(0, 2 ** 40)
+    global next_message_id
+    max_messages = int(env.get_env_string('PROBER_BATCH_MAX_MESSAGES'))
+    max_delay = float(env.get_env_string('PROBER_BATCH_MAX_DELAY'))
     while keep_going:
-        try:
-            data = results_queue.get(block=False)
-            logging.debug("Read data from output queue")
-        except queue.Empty:
-            await asyncio.sleep(1.0)
+        batch = await read_batch(results_queue, max_messages, max_delay)
+        if not batch:
             continue
-        data['id'] = nonce
-        data['message_transmit_time'] = time.time()
-        nonce += 1
-        await websocket.send(json.dumps(data))
-        unconfirmed_list.append(data)
+        logging.debug("Read %i messages from output queue", len(batch))
+        binary = []
+        if binary_output:
+            binary = [_ for _ in batch if wire_format.can_encode(_, target_index)]
+            if binary:
+                batch = [_ for _ in batch if not wire_format.can_encode(_, target_index)]
+        transmit_time = time.time()
+        first_id = next_message_id
+        for data in binary + batch:
+            data['id'] = next_message_id
+            data['message_transmit_time'] = transmit_time
+            next_message_id += 1
+            # before sending so the message is re-queued if the send fails
+            unconfirmed[data['id']] = data
+        if binary:
+            await websocket.send(wire_format.encode_frame(binary, target_index,
+                                                          target_list_version, first_id))
+        if batch:
+            # the collector has no use for spool_ids, so they are not sent
+            batch = [{key: value for key, value in _.items() if key != 'spool_id'}
+                     if 'spool_id' in _ else _ for _ in batch]
+            await websocket.send(json.dumps({'type': 'batch', 'messages': batch}))
+
+
+def set_binary_output(message: Optional[dict]):
+    """ Use the binary encoding if the target_list message says the collector accepts it. """
+    global binary_output
+    global target_index
+    global target_list_version
+    if message is None or message.get('encoding') != wire_format.ENCODING:
+        binary_output = False
+        target_index = {}
+        return
+    target_index = wire_format.make_target_index([_['ip'] for _ in message['targets']])
+    target_list_version = message['version']
+    binary_output = True
 
 
 def handle_target_list(message: dict):
-    """ Update the target list with the list from the target_list message. """
-    global pinger
-    target_dicts = message['targets']
+    """ Update the target lists of the probe engines with the list from the target_list message. """
+    global target_resolver
+    global tcp_prober
+    global dns_prober
+    target_dicts = [_ for _ in message['targets'] if _.get('type', 'icmp') == 'icmp']
     target_ips = [_['ip'] for _ in target_dicts]
-    # this is where we would do something complicated if we supported more than ICMP echo.
-    pinger.set_destinations(target_ips)
-    logging.debug("Updated target list")
+    # intervals are in milliseconds. older collectors do not send them.
+    intervals = [_.get('interval', 1000) / 1000.0 for _ in target_dicts]
+    # (count, spacing in seconds) for targets sent bursts of echo requests
+    bursts = [(_['burst_count'], _.get('burst_spacing', 20) / 1000.0)
+              if _.get('burst_count', 1) > 1 else None for _ in target_dicts]
+    # hostnames are resolved by the resolver thread which then updates the pinger
+    target_resolver.set_targets(target_ips, intervals, bursts)
+    tcp_dicts = [_ for _ in message['targets'] if _.get('type') == 'tcp' and _.get('port')]
+    tcp_prober.set_targets(['{}:{}'.format(_['ip'], _['port']) for _ in tcp_dicts],
+                           [_.get('interval', 1000) / 1000.0 for _ in tcp_dicts])
+    dns_dicts = [_ for _ in message['targets'] if _.get('type') == 'dns' and _.get('query_name')]
+    dns_prober.set_targets(['{}@{}:{}'.format(_['query_name'], _['ip'], _.get('port') or 53)
+                            for _ in dns_dicts],
+                           [_.get('interval', 1000) / 1000.0 for _ in dns_dicts])
+    set_binary_output(message)
+    logging.debug("Updated target list. ICMP targets: %i TCP targets: %i DNS targets: %i",
+                  len(target_dicts), len(tcp_dicts), len(dns_dicts))
+
+
+def handle_output_ack(message: dict, unconfirmed: Dict[int, dict]):
+    """ Forget the messages acknowledged by an output_ack message.
+
+    The collector acknowledges a range of consecutive ids with 'first' and
+    'last'. Older collectors acknowledge a single 'id'. The spool_ids of
+    acknowledged messages from the spool are kept for spool_results() to
+    delete.
+    """
+    if 'first' in message:
+        message_ids = range(message['first'], message['last'] + 1)
+    else:
+        message_ids = [message['id']]
+    confirmed = 0
+    for message_id in message_ids:
+        data = unconfirmed.pop(message_id, None)
+        if data is None:
+            continue
+        confirmed += 1
+        if 'spool_id' in data:
+            acked_spool_ids.append(data['spool_id'])
+    logging.debug("Confirmed %i messages. %i unconfirmed", confirmed, len(unconfirmed))
 
 
-async def receive_messages(websocket: WebSocket, unconfirmed_list: list):
+async def receive_messages(websocket: WebSocket, unconfirmed: Dict[int, dict]):
     """ Coroutine to receive any messages from collector and send to handlers.
 
     :param websocket: already connected websocket from websockets package
-    :param unconfirmed_list: a list of unconfirmed transmitted messages
+    :param unconfirmed: unconfirmed transmitted messages keyed on message id
     :return: None
     """
     global keep_going
@@ -131,12 +436,7 @@ async def receive_messages(websocket: WebSocket, unconfirmed_list: list):
         message = json.loads(message_string)
         try:
             if message['type'] == 'output_ack':
-                # this magic removes any messages in unconfirmed_list that have the same id
-                #  as the acknowledgement message we just received.
-                old_len = len(unconfirmed_list)
-                unconfirmed_list[:] = [_ for _ in unconfirmed_list if message['id'] != _['id']]
-                new_len = len(unconfirmed_list)
-                logging.debug("Confirmed %i messages in unconfirmed_list", old_len - new_len)
+                handle_output_ack(message, unconfirmed)
             elif message['type'] == 'target_list':
                 handle_target_list(message)
             else:
@@ -145,26 +445,28 @@ async def receive_messages(websocket: WebSocket, unconfirmed_list: list):
             logging.error("received websocket message without type: %s", message_string)
 
 
-async def requeue_stale_messages(unconfirmed_list: list, results_queue: TQueue):
-    """ Re-queue messages in unconfirmed_list if they are not acknowledged.
+async def requeue_stale_messages(unconfirmed: Dict[int, dict], results_queue: ResultsBridge):
+    """ Re-queue messages in unconfirmed if they are not acknowledged.
 
-     Waits MESSAGE_ACK_TIMEOUT seconds before re-queueing.
+     Waits MESSAGE_ACK_TIMEOUT seconds before re-queueing. unconfirmed is in
+     transmit order, so only the stale messages at its front are looked at.
 
-    :param unconfirmed_list: a list of unconfirmed transmitted messages
-    :param results_queue: thread-safe queue of messages to transmit
+    :param unconfirmed: unconfirmed transmitted messages keyed on message id
+    :param results_queue: queue of messages to transmit
     :return:
     """
     global keep_going
     while keep_going:
-        stale_cutoff_time = time.time() - MESSAGE_ACK_TIMEOUT
         await asyncio.sleep(1.0)
-        # it is critical that these two list comprehensions have opposite filters
-        stale_messages = [_ for _ in unconfirmed_list if _['message_transmit_time'] < stale_cutoff_time]
-        unconfirmed_list[:] = [_ for _ in unconfirmed_list if _['message_transmit_time'] >= stale_cutoff_time]
-        for message in stale_messages:
-            if stale_cutoff_time > message['message_transmit_time']:
-                logging.info("Re-enqueueing data that was not acknowledged. id: %s", message['id'])
-                results_queue.put(message)
+        stale_cutoff_time = time.time() - MESSAGE_ACK_TIMEOUT
+        stale_ids = []
+        for message_id, message in unconfirmed.items():
+            if message['message_transmit_time'] >= stale_cutoff_time:
+                break
+            stale_ids.append(message_id)
+        for message_id in stale_ids:
+            logging.info("Re-enqueueing data that was not acknowledged. id: %s", message_id)
+            results_queue.put_nowait(unconfirmed.pop(message_id))
 
 
 def signal_handler(signum, frame):
@@ -179,10 +481,20 @@ def shutdown():
     global keep_going
     global event_loop
     keep_going = False
+    results_queue.close()  # so a pinger thread waiting for room can stop
+    target_resolver.stop()
     pinger.stop()
+    tcp_prober.stop()
+    dns_prober.stop()
     sleep_time = 2
     logging.warning("Stopping event loop in %i seconds", sleep_time)
     time.sleep(sleep_time)
+    if rollup_output is not None:
+        # the current period and any still in their grace time
+        rollup_output.flush(time.time(), force=True)
+    if spool is not None:
+        save_unsent_messages()
+        spool_executor.shutdown()
     event_loop.stop()
     logging.warning("Probe shutting down with %i messages in transmit queue.",
                     results_queue.qsize())
@@ -207,14 +519,12 @@ def parse_args():
 def ping_targets_from_config(config):
     """ Read the ping targets from the config parser. Returns a list of IPs"""
     section = config['probe targets']
+    resolved = ResolverCache().resolve(list(section.keys()))
     addresses = []
-    for key in section.keys():
-        try:
-            addr = socket.gethostbyname(key)
+    for key, addr in resolved.items():
+        if addr is not None:
             logging.debug("Resolved probe target: %s => %s", key, addr)
             addresses.append(addr)
-        except socket.gaierror:
-            logging.error("Unable to resolve probe target: %s", key)
     return addresses
 
 
@@ -222,6 +532,12 @@ def main():
     global results_queue
     global event_loop
     global pinger
+    global target_resolver
+    global tcp_prober
+    global dns_prober
+    global spool
+    global spool_executor
+    global rollup_output
     args = parse_args()
     log_format = '%(asctime)s %(levelname)s:%(module)s:%(funcName)s# ' \
                  + '%(message)s'
@@ -232,15 +548,75 @@ def main():
         logging.basicConfig(filename=log_filename, format=log_format,
                             level=args.log_level)
     setup_signal_handler()
-    results_queue = TQueue()
-    unconfirmed_list = []
     hosts = []
-    logging.info("Starting ping thread")
-    pinger = Pinger(hosts, output=results_queue)
+    event_loop = asyncio.get_event_loop()
+    engine = env.get_env_string('PROBER_ENGINE')
+    max_rate = float(env.get_env_string('PROBER_MAX_PPS'))  # ICMP only, see default.env
+    workers = int(env.get_env_string('PROBER_WORKERS'))
+    timeouts = {'timeout': int(env.get_env_string('PROBER_TIMEOUT')),
+                'min_timeout': int(env.get_env_string('PROBER_MIN_TIMEOUT')),
+                'max_timeout': int(env.get_env_string('PROBER_MAX_TIMEOUT'))}
+    buffers = {'rcvbuf': int(env.get_env_string('PROBER_RCVBUF')),
+               'sndbuf': int(env.get_env_string('PROBER_SNDBUF'))}
+    spool_max_bytes = int(env.get_env_string('PROBER_SPOOL_MAX_BYTES'))
+    if spool_max_bytes > 0:
+        spool_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spool')
+        # opened on the executor's thread, the only one its sqlite connection may be used from
+        db_file = env.get_env_string('PROBER_DB_FILE')
+        spool = spool_executor.submit(
+            lambda: ResultSpool(ProberDatabase(db_file), spool_max_bytes)).result()
+    overflow_policy = env.get_env_string('PROBER_QUEUE_OVERFLOW')
+    if overflow_policy == results_bridge.SPILL and spool is None:
+        logging.warning("Spooling is disabled. Dropping the oldest results when the queue is full")
+        overflow_policy = results_bridge.DROP_OLDEST
+    results_queue = ResultsBridge(event_loop, int(env.get_env_string('PROBER_QUEUE_MAX_MESSAGES')),
+                                  overflow_policy)
+    output = results_queue
+    rollup_period = int(env.get_env_string('PROBER_ROLLUP_PERIOD'))
+    if rollup_period > 0:
+        raw_threshold = float(env.get_env_string('PROBER_ROLLUP_RAW_THRESHOLD'))
+        raw_loss = int(env.get_env_string('PROBER_ROLLUP_RAW_LOSS')) != 0
+        logging.info("Sending rollups every %i seconds instead of every reply", rollup_period)
+        rollup_output = RollupOutput(results_queue, rollup_period, raw_loss=raw_loss,
+                                     raw_threshold=raw_threshold / 1000.0 if raw_threshold > 0 else None)
+        output = rollup_output
+        event_loop.create_task(flush_rollups(rollup_output))
+    if workers > 1:
+        logging.info("Starting %i pinger worker processes", workers)
+        pinger = ShardedPinger(hosts, workers, output=output, max_rate=max_rate, **timeouts,
+                               **buffers)
+    elif engine == 'asyncio':
+        logging.info("Starting asyncio pinger")
+        pinger = AsyncPinger(hosts, event_loop, output=output, max_rate=max_rate, **timeouts,
+                             **buffers)
+    else:
+        logging.info("Starting ping thread")
+        pinger = Pinger(hosts, output=output, max_rate=max_rate, **timeouts, **buffers)
     pinger.start()
+    resolver_cache = ResolverCache(ttl=float(env.get_env_string('PROBER_DNS_TTL')),
+                                   workers=int(env.get_env_string('PROBER_DNS_WORKERS')))
+    if engine == 'asyncio' and workers <= 1:
+        # the AsyncPinger must only be touched from the event loop thread
+        def apply_destinations(addresses, intervals, bursts):
+            event_loop.call_soon_threadsafe(pinger.set_destinations, addresses, intervals, bursts)
+    else:
+        apply_destinations = pinger.set_destinations
+    target_resolver = TargetResolver(apply_destinations, resolver_cache)
+    target_resolver.start()
+    # runs on the event loop, so it puts its results straight on the results queue
+    tcp_prober = TcpProber(event_loop, output=results_queue,
+                           max_rate=float(env.get_env_string('PROBER_TCP_MAX_RATE')),
+                           timeout=int(env.get_env_string('PROBER_TCP_TIMEOUT')),
+                           concurrency=int(env.get_env_string('PROBER_TCP_CONCURRENCY')))
+    tcp_prober.start()
+    dns_prober = DnsProber(event_loop, output=results_queue,
+                           max_rate=float(env.get_env_string('PROBER_DNS_QUERY_MAX_RATE')),
+                           timeout=int(env.get_env_string('PROBER_DNS_QUERY_TIMEOUT')),
+                           concurrency=int(env.get_env_string('PROBER_DNS_QUERY_CONCURRENCY')),
+                           sockets=int(env.get_env_string('PROBER_DNS_QUERY_SOCKETS')))
+    dns_prober.start()
     logging.info("Starting event loop")
-    event_loop = asyncio.get_event_loop()
-    main_task = maintain_collector_connection(results_queue, unconfirmed_list)
+    main_task = maintain_collector_connection(results_queue, unconfirmed)
     try:
         event_loop.run_until_complete(main_task)
     except KeyboardInterrupt:
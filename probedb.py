@@ -3,14 +3,17 @@
 Database abstraction layer for prober and a CLI tool for management of the prober's DB.
 """
 
-from typing import List
+from typing import Dict, List
 import argparse
 import logging
 import sqlite3
+import json
+import zlib
 import sys
 
 
 DEFAULT_DB_PATH: str = './prober_db.sqlite3'
+SPOOL_COMPRESSION_LEVEL = 1  # zlib level of spooled messages. JSON shrinks about 5x even at 1
 
 
 class ProberDatabase(object):
@@ -20,23 +23,29 @@ class ProberDatabase(object):
         self.db_file_path: str = db_file_path
         self.connection: sqlite3.Connection = sqlite3.connect(self.db_file_path)
         self.cursor: sqlite3.Cursor = self.connection.cursor()
-        if 'target' not in self.get_tables():
+        # the write-ahead log lets the spool commit often without an fsync of the whole DB
+        self.execute("pragma journal_mode=wal")
+        self.execute("pragma synchronous=normal")
+        tables = self.get_tables()
+        if 'target' not in tables:
             logging.warning("Database (%s) empty. Initializing...", self.db_file_path)
             self.init_db()
+        if 'spool' not in tables:
+            self.init_spool()
 
-    def execute(self, query: str) -> None:
-        self.cursor.execute(query)
+    def execute(self, query: str, parameters=()) -> None:
+        self.cursor.execute(query, parameters)
 
-    def execute_commit(self, query: str) -> None:
-        self.cursor.execute(query)
+    def execute_commit(self, query: str, parameters=()) -> None:
+        self.cursor.execute(query, parameters)
         self.connection.commit()
 
-    def execute_fetch_all(self, query: str) -> List[tuple]:
+    def execute_fetch_all(self, query: str, parameters=()) -> List[tuple]:
         """ Executes the query and returns the output of cursor.fetchall()
 
         :return: a list (will be empty if there were no rows)
         """
-        self.execute(query)
+        self.execute(query, parameters)
         return self.cursor.fetchall()
 
     def get_tables(self) -> List[str]:
@@ -64,12 +73,157 @@ class ProberDatabase(object):
                    )"""
         self.execute_commit(query)
 
+    def init_spool(self) -> None:
+        """ Create the table of results waiting to be sent to the collector (see ResultSpool).
+
+        :return: None
+        """
+        query = """create table spool (
+                   id integer primary key autoincrement,
+                   size integer,
+                   data blob
+                   )"""
+        self.execute_commit(query)
+
     def get_targets(self) -> List[tuple]:
         """ Returns a list of all the targets in the database. """
         query = "select * from target"
         return self.execute_fetch_all(query)
 
 
+class ResultSpool(object):
+    """ Bounded on-disk FIFO of messages for the collector, in the prober DB's spool table.
+
+    Messages are stored as zlib compressed JSON. read() hands messages out
+    with their row id in 'spool_id' but leaves them in the table until
+    delete() is called with the ids the collector acknowledged, so messages
+    that were read but not acknowledged are read again after a restart.
+    push(), read() and delete() each commit once for any number of messages.
+    If the spool would grow beyond max_bytes the oldest messages are dropped
+    and counted.
+
+    The sqlite connection is bound to the thread that opened the DB, so a
+    spool must only be used from that thread. The counters may be read from
+    any thread.
+    """
+
+    def __init__(self, db: ProberDatabase, max_bytes: int):
+        """
+        :param db: the prober DB
+        :param max_bytes: maximum size of the spooled (compressed) messages
+        """
+        self.db = db
+        self.max_bytes = max_bytes
+        self.depth, self.bytes = db.execute_fetch_all(
+            "select count(*), coalesce(sum(size), 0) from spool")[0]
+        self.read_id = -1  # rows up to this id were read, except those given back by release()
+        self.unacked: Dict[int, int] = {}  # id: size of the rows read but not deleted
+        self.spooled = 0  # messages pushed
+        self.unspooled = 0  # messages deleted after the collector acknowledged them
+        self.dropped = 0  # messages dropped because the spool was full
+        self.dropped_bytes = 0
+        if self.depth:
+            logging.info("Spool has %i messages (%i bytes) from before", self.depth, self.bytes)
+
+    def push(self, messages: List[dict]) -> None:
+        """ Add messages to the end of the spool. """
+        rows = []
+        for message in messages:
+            data = zlib.compress(json.dumps(message).encode(), SPOOL_COMPRESSION_LEVEL)
+            rows.append((len(data), data))
+        self.db.cursor.executemany("insert into spool (size, data) values (?, ?)", rows)
+        self.depth += len(rows)
+        self.bytes += sum(_[0] for _ in rows)
+        self.spooled += len(rows)
+        if self.bytes > self.max_bytes:
+            self.drop_oldest(self.bytes - self.max_bytes)
+        self.db.connection.commit()
+
+    def drop_oldest(self, excess: int) -> None:
+        """ Delete the oldest messages until at least excess bytes are freed. Does not commit. """
+        freed = 0
+        count = 0
+        last_id = None
+        while freed < excess:
+            rows = self.db.execute_fetch_all(
+                "select id, size from spool where id > ? order by id limit 1000",
+                (last_id if last_id is not None else -1,))
+            if not rows:
+                break
+            for last_id, size in rows:
+                freed += size
+                count += 1
+                if freed >= excess:
+                    break
+        if last_id is None:
+            return
+        self.db.execute("delete from spool where id <= ?", (last_id,))
+        for row_id in [_ for _ in self.unacked if _ <= last_id]:
+            del self.unacked[row_id]
+        self.read_id = max(self.read_id, last_id)
+        self.depth -= count
+        self.bytes -= freed
+        self.dropped += count
+        self.dropped_bytes += freed
+        logging.warning("Spool full. Dropped the oldest %i messages (%i bytes)", count, freed)
+
+    def unread(self) -> int:
+        """ The number of messages that read() has not handed out. """
+        return self.depth - len(self.unacked)
+
+    def read(self, limit: int) -> List[dict]:
+        """ Return up to limit messages from the front of the spool that were not read yet.
+
+        Each message has its row id in 'spool_id'. It stays in the spool
+        until it is passed to delete() or release().
+        """
+        # rows from before the last release() that are still out
+        skip = sum(1 for _ in self.unacked if _ > self.read_id)
+        rows = self.db.execute_fetch_all(
+            "select id, size, data from spool where id > ? order by id limit ?",
+            (self.read_id, limit + skip))
+        rows = [_ for _ in rows if _[0] not in self.unacked][:limit]
+        if not rows:
+            return []
+        self.read_id = rows[-1][0]
+        messages = []
+        for row_id, size, data in rows:
+            self.unacked[row_id] = size
+            message = json.loads(zlib.decompress(data))
+            message['spool_id'] = row_id
+            messages.append(message)
+        return messages
+
+    def delete(self, row_ids: List[int]) -> None:
+        """ Delete the messages with these spool_ids, e.g. once the collector acknowledged them. """
+        # an id can be acknowledged twice if its message was sent twice
+        row_ids = [_ for _ in dict.fromkeys(row_ids) if _ in self.unacked]
+        if not row_ids:
+            return
+        self.db.cursor.executemany("delete from spool where id = ?", [(_,) for _ in row_ids])
+        self.db.connection.commit()
+        self.depth -= len(row_ids)
+        self.bytes -= sum(self.unacked.pop(_) for _ in row_ids)
+        self.unspooled += len(row_ids)
+
+    def release(self, row_ids: List[int]) -> None:
+        """ Let read() hand out the messages with these spool_ids again.
+
+        For read messages that were dropped from memory without being sent.
+        """
+        row_ids = [_ for _ in dict.fromkeys(row_ids) if _ in self.unacked]
+        for row_id in row_ids:
+            del self.unacked[row_id]
+        if row_ids:
+            self.read_id = min(self.read_id, min(row_ids) - 1)
+
+    def stats(self) -> dict:
+        """ The spool's gauges and counters, with spool_ prefixed names. """
+        return {'spool_depth': self.depth, 'spool_bytes': self.bytes,
+                'spool_spooled': self.spooled, 'spool_unspooled': self.unspooled,
+                'spool_dropped': self.dropped, 'spool_dropped_bytes': self.dropped_bytes}
+
+
 def parse_args(raw_args: List[str] = sys.argv[1:]) -> argparse.Namespace:
     """ Setup the argument parser and parse the args.
 
@@ -87,6 +241,8 @@ def parse_args(raw_args: List[str] = sys.argv[1:]) -> argparse.Namespace:
 def main():
     args = parse_args()
     db = ProberDatabase(db_file_path=args.db_file)
+    spool = ResultSpool(db, 0)
+    print("Spooled messages: %i (%i bytes)" % (spool.depth, spool.bytes))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,184 @@
+"""
+Concurrent, caching hostname resolution for the prober's targets.
+
+socket.getaddrinfo() blocks, so lookups are run concurrently on a thread pool.
+Results are cached for a fixed TTL because the system resolver does not tell
+us the record TTL. Failed lookups are cached for a shorter time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+import threading
+import logging
+import socket
+import time
+
+DEFAULT_TTL = 300.0  # seconds to cache a resolved address
+NEGATIVE_TTL = 30.0  # seconds to cache a failed lookup
+DEFAULT_WORKERS = 32  # concurrent lookups
+
+
+def is_ipv4_address(name: str) -> bool:
+    """ True if name is a dotted quad IPv4 address that needs no lookup. """
+    try:
+        return socket.inet_ntoa(socket.inet_aton(name)) == name
+    except OSError:
+        return False
+
+
+class ResolverCache(object):
+    """ Resolves hostnames to IPv4 addresses concurrently and caches the results.
+
+    Thread-safe. IPv4 address literals are returned as they are.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, negative_ttl: float = NEGATIVE_TTL,
+                 workers: int = DEFAULT_WORKERS):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.entries = {}  # name: (address or None, expiry time on the monotonic clock)
+        self.lock = threading.Lock()
+        self.lookup_count = 0
+        self.failure_count = 0
+
+    def lookup(self, name: str) -> Optional[str]:
+        """ Resolve one hostname, bypassing the cache. Returns None if it does not resolve. """
+        try:
+            info = socket.getaddrinfo(name, None, socket.AF_INET, socket.SOCK_RAW)
+        except (socket.gaierror, UnicodeError) as e:
+            logging.error("Unable to resolve probe target %s: %s", name, str(e))
+            return None
+        return info[0][4][0]
+
+    def resolve(self, names: List[str]) -> Dict[str, Optional[str]]:
+        """ Resolve hostnames, looking up the uncached or expired ones concurrently.
+
+        Blocks until every lookup is done. A name that fails to re-resolve
+        keeps its last address for negative_ttl seconds.
+
+        :param names: hostnames or IPv4 addresses
+        :return: dict of name: address, or name: None if it does not resolve
+        """
+        now = time.monotonic()
+        results = {}
+        missing = []
+        with self.lock:
+            for name in names:
+                if name in results:
+                    continue
+                if is_ipv4_address(name):
+                    results[name] = name
+                    continue
+                entry = self.entries.get(name)
+                if entry is not None and entry[1] > now:
+                    results[name] = entry[0]
+                else:
+                    results[name] = None
+                    missing.append(name)
+        if not missing:
+            return results
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(missing)),
+                                thread_name_prefix='resolver') as executor:
+            addresses = list(executor.map(self.lookup, missing))
+        now = time.monotonic()
+        with self.lock:
+            for name, address in zip(missing, addresses):
+                self.lookup_count += 1
+                if address is not None:
+                    self.entries[name] = (address, now + self.ttl)
+                    results[name] = address
+                    continue
+                self.failure_count += 1
+                old_address = self.entries.get(name, (None, 0))[0]
+                self.entries[name] = (old_address, now + self.negative_ttl)
+                results[name] = old_address
+            self.evict_expired(now)
+        logging.info("Resolved %i hostnames in %.3f seconds", len(missing), now - start)
+        return results
+
+    def next_expiry(self, names: List[str]) -> Optional[float]:
+        """ The earliest monotonic time any of the names' cache entries expire. """
+        with self.lock:
+            expiries = [self.entries[_][1] for _ in names if _ in self.entries]
+        return min(expiries) if expiries else None
+
+    def evict_expired(self, now: float) -> None:
+        """ Drop entries that expired more than a TTL ago. Call with the lock held. """
+        cutoff = now - self.ttl
+        for name in [_ for _, entry in self.entries.items() if entry[1] < cutoff]:
+            del self.entries[name]
+
+
+class TargetResolver(threading.Thread):
+    """ Thread keeping the pinger's destinations resolved.
+
+    set_targets() returns immediately. The thread resolves the names and then
+    hands the complete list of addresses and their settings to apply() in one call, so the
+    pinger switches to the new destinations at once. When cache entries
+    expire the names are resolved again and apply() is only called if an
+    address changed.
+    """
+
+    def __init__(self, apply: Callable[[List[str], List[float], List[tuple]], None],
+                 cache: ResolverCache = None):
+        """
+        :param apply: called with (addresses, intervals, bursts), e.g. pinger.set_destinations
+        :param cache: the ResolverCache to use. A new one if None.
+        """
+        super().__init__(name='resolver', daemon=True)
+        self.apply = apply
+        self.cache = cache or ResolverCache()
+        self.keep_going = True
+        self.wake = threading.Event()
+        self.targets = None  # (names, intervals, bursts) most recently given to set_targets()
+        self.applied = None  # (addresses, intervals, bursts) last given to apply()
+
+    def set_targets(self, names: List[str], intervals: List[float] = None,
+                    bursts: List[tuple] = None) -> None:
+        """ Set the hostnames to ping and optionally their intervals in seconds
+        and bursts as (count, spacing in seconds) tuples.
+        """
+        if intervals is None:
+            intervals = [None] * len(names)
+        if bursts is None:
+            bursts = [None] * len(names)
+        self.targets = (list(names), list(intervals), list(bursts))
+        self.wake.set()
+
+    def stop(self):
+        self.keep_going = False
+        self.wake.set()
+
+    def run(self):
+        while self.keep_going:
+            if self.targets is None:
+                self.wake.wait()
+                continue
+            self.wake.clear()
+            names, intervals, bursts = self.targets
+            self.update(names, intervals, bursts)
+            next_expiry = self.cache.next_expiry(names)
+            timeout = None if next_expiry is None else max(next_expiry - time.monotonic(), 1.0)
+            self.wake.wait(timeout)
+        logging.info("Stopped resolver thread")
+
+    def update(self, names: List[str], intervals: List[float], bursts: List[tuple]) -> None:
+        """ Resolve names and apply the addresses if they changed. """
+        resolved = self.cache.resolve(names)
+        addresses = []
+        address_intervals = []
+        address_bursts = []
+        for name, interval, burst in zip(names, intervals, bursts):
+            if resolved[name] is not None:
+                addresses.append(resolved[name])
+                address_intervals.append(interval)
+                address_bursts.append(burst)
+        if (addresses, address_intervals, address_bursts) == self.applied:
+            return
+        self.applied = (addresses, address_intervals, address_bursts)
+        if all(_ is None for _ in address_intervals):
+            address_intervals = None
+        logging.debug("Applying %i resolved destinations", len(addresses))
+        self.apply(addresses, address_intervals, address_bursts)
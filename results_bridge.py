@@ -0,0 +1,138 @@
+"""
+Hands results from the probe engines to the prober's asyncio event loop.
+
+Pinger threads and the ShardedPinger's merge thread call put_nowait() from
+their own threads. The message is handed to the event loop with
+call_soon_threadsafe(), which wakes the loop right away, so the transmit
+coroutine gets it without polling. Engines running on the event loop put
+messages on the queue directly.
+"""
+from typing import List
+import threading
+import asyncio
+import logging
+import time
+
+SPILL = 'spill'  # move the oldest message to the spool (see probe.spool_results())
+DROP_OLDEST = 'drop_oldest'  # discard the oldest message
+BLOCK = 'block'  # make the producer thread wait for room
+OVERFLOW_POLICIES = (SPILL, DROP_OLDEST, BLOCK)
+
+
+class ResultsBridge(object):
+    """ Bounded asyncio queue of messages for the collector, fed from any thread.
+
+    What happens when the queue is full depends on the overflow policy. With
+    SPILL or DROP_OLDEST the oldest message makes room for the new one and is
+    kept in overflow (see take_overflow()) or dropped. With BLOCK a producer
+    thread waits until the event loop has taken enough messages off the
+    queue. Messages put from the event loop thread itself can not wait, so
+    with BLOCK they are queued beyond the bound.
+
+    get(), get_nowait(), take_overflow() and qsize() must be called from the
+    event loop thread.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int, policy: str = SPILL):
+        """
+        :param loop: the event loop that consumes the messages. Must be created
+                     by the thread that runs it
+        :param maxsize: maximum messages in the queue
+        :param policy: SPILL, DROP_OLDEST or BLOCK
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown queue overflow policy %s. Use one of: %s" %
+                             (policy, ', '.join(OVERFLOW_POLICIES)))
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.maxsize = maxsize
+        self.policy = policy
+        # with BLOCK the bound is enforced by the producer threads waiting instead
+        self.queue = asyncio.Queue(maxsize=0 if policy == BLOCK else maxsize)
+        self.overflow: List[dict] = []  # oldest messages moved out of the way with SPILL
+        self.condition = threading.Condition()
+        self.in_transit = 0  # messages from producer threads not yet taken off the queue
+        self.closed = False
+        self.enqueued = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.blocked = 0  # times a producer thread had to wait
+        self.blocked_seconds = 0.0
+
+    def put_nowait(self, message: dict) -> None:
+        """ Queue a message. Safe to call from any thread. """
+        if threading.get_ident() == self.loop_thread:
+            self.put_in_loop(message, False)
+            return
+        if self.policy == BLOCK:
+            with self.condition:
+                if self.in_transit >= self.maxsize and not self.closed:
+                    self.blocked += 1
+                    start = time.monotonic()
+                    self.condition.wait_for(lambda: self.in_transit < self.maxsize or self.closed)
+                    self.blocked_seconds += time.monotonic() - start
+                self.in_transit += 1
+        try:
+            self.loop.call_soon_threadsafe(self.put_in_loop, message, self.policy == BLOCK)
+        except RuntimeError:
+            # the event loop is closed at shutdown
+            logging.debug("Discarding message put after the event loop closed")
+
+    def put_in_loop(self, message: dict, counted: bool) -> None:
+        """ Queue a message from the event loop thread, applying the overflow policy.
+
+        :param counted: the message is counted in in_transit
+        """
+        if self.queue.full():
+            oldest, oldest_counted = self.queue.get_nowait()
+            if oldest_counted:
+                self.release()
+            if self.policy == SPILL:
+                self.overflow.append(oldest)
+                self.spilled += 1
+            else:
+                self.dropped += 1
+        self.queue.put_nowait((message, counted))
+        self.enqueued += 1
+
+    def release(self) -> None:
+        """ Let a producer thread waiting for room continue. """
+        with self.condition:
+            self.in_transit -= 1
+            self.condition.notify()
+
+    async def get(self) -> dict:
+        """ Wait for the next message. """
+        message, counted = await self.queue.get()
+        if counted:
+            self.release()
+        return message
+
+    def get_nowait(self) -> dict:
+        """ The next message. Raises asyncio.QueueEmpty if there is none. """
+        message, counted = self.queue.get_nowait()
+        if counted:
+            self.release()
+        return message
+
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+    def take_overflow(self) -> List[dict]:
+        """ Remove and return the messages spilled since the last call. """
+        overflow = self.overflow
+        self.overflow = []
+        return overflow
+
+    def close(self) -> None:
+        """ Stop making producer threads wait, e.g. when shutting down. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        """ The queue's gauges and counters, with queue_ prefixed names. """
+        return {'queue_depth': self.qsize(), 'queue_enqueued': self.enqueued,
+                'queue_spilled': self.spilled, 'queue_dropped': self.dropped,
+                'queue_blocked': self.blocked,
+                'queue_blocked_seconds': round(self.blocked_seconds, 6)}
@@ -0,0 +1,143 @@
+"""
+Prober-side aggregation of ping results into periodic rollups.
+
+Instead of sending every reply to the collector the prober keeps running
+statistics for each target and sends one 'rollup' message per period. Raw
+replies can still be sent for timeouts and for replies slower than a
+threshold so individual events are not lost.
+"""
+from typing import Dict, Optional
+import threading
+import logging
+import math
+import time
+
+# upper bounds (milliseconds) of the latency histogram buckets. the last bucket has no bound.
+HISTOGRAM_BOUNDS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+ROLLUP_GRACE = 5.0  # seconds after a period ends before it is sent, for replies still in flight
+ROLLUP_FLUSH_INTERVAL = 5.0  # seconds between flush() calls that do not wait for output
+
+
+class TargetAggregate(object):
+    """ Streaming statistics of the replies from one target in one period. """
+    __slots__ = ('count', 'lost', 'minimum', 'maximum', 'total', 'total_squares', 'histogram',
+                 'kernel_dropped')
+
+    def __init__(self):
+        self.count = 0  # echo requests, including lost ones
+        self.lost = 0
+        self.minimum = math.inf
+        self.maximum = 0.0
+        self.total = 0.0  # sum of the latencies (seconds) of the replies
+        self.total_squares = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.kernel_dropped = 0  # lost requests whose replies the kernel may have dropped
+
+    def add(self, latency: Optional[float], kernel_drop: bool = False) -> None:
+        """ Add the latency (seconds) of a reply or None for a timeout. """
+        self.count += 1
+        if latency is None:
+            self.lost += 1
+            if kernel_drop:
+                self.kernel_dropped += 1
+            return
+        self.minimum = min(self.minimum, latency)
+        self.maximum = max(self.maximum, latency)
+        self.total += latency
+        self.total_squares += latency * latency
+        millis = latency * 1000
+        for i, bound in enumerate(HISTOGRAM_BOUNDS):
+            if millis <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def to_list(self, ip: str) -> list:
+        """ [ip, count, lost, minimum, maximum, total, total_squares, histogram, kernel_dropped]
+
+        minimum and maximum are None if every request was lost.
+        """
+        received = self.count - self.lost
+        return [ip, self.count, self.lost,
+                self.minimum if received else None, self.maximum if received else None,
+                self.total, self.total_squares, self.histogram, self.kernel_dropped]
+
+
+class RollupOutput(object):
+    """ Stands in for the pinger's output queue and sends rollups to the real one.
+
+    'output' messages are folded into per-target aggregates for the period
+    their requests were sent in. Once a period is over (plus ROLLUP_GRACE)
+    its aggregates are put on the output queue as a 'rollup' message. Other
+    messages, e.g. burst summaries, are passed through unchanged.
+
+    put_nowait() may be called from any one thread at a time. flush() is
+    also called on a timer (see probe.flush_rollups()) so the last periods
+    are sent when no more output arrives, and with force at shutdown.
+    """
+
+    def __init__(self, output, period: int = 60, raw_loss: bool = True,
+                 raw_threshold: Optional[float] = None):
+        """
+        :param output: the queue to put messages on
+        :param period: seconds covered by each rollup
+        :param raw_loss: also send timeouts (and their late replies) as raw replies
+        :param raw_threshold: also send replies slower than this many seconds as raw replies
+        """
+        self.output = output
+        self.period = period
+        self.raw_loss = raw_loss
+        self.raw_threshold = raw_threshold
+        self.periods: Dict[int, Dict[str, TargetAggregate]] = {}  # period start: ip: aggregate
+        self.lock = threading.Lock()  # guards periods between put_nowait() and flush()
+        self.replies_folded = 0
+        self.rollups_sent = 0
+
+    def qsize(self) -> int:
+        return self.output.qsize()
+
+    def put_nowait(self, message: dict) -> None:
+        if message.get('type') != 'output':
+            self.output.put_nowait(message)
+            return
+        raw_replies = []
+        with self.lock:
+            for reply in message['replies']:
+                ip, receive_time = reply[0], reply[1]
+                send_time = reply[2] if len(reply) > 2 else message['send_time']
+                latency = None if receive_time is None else receive_time - send_time
+                start = int(send_time // self.period * self.period)
+                aggregates = self.periods.setdefault(start, {})
+                aggregate = aggregates.get(ip)
+                if aggregate is None:
+                    aggregate = aggregates[ip] = TargetAggregate()
+                aggregate.add(latency, len(reply) > 4 and reply[4])
+                self.replies_folded += 1
+                if latency is None:
+                    if self.raw_loss:
+                        raw_replies.append(reply)
+                elif self.raw_threshold is not None and latency > self.raw_threshold:
+                    raw_replies.append(reply)
+        late_replies = message.get('late', []) if self.raw_loss else []
+        if raw_replies or late_replies:
+            data = {'type': 'output', 'send_time': message['send_time'], 'replies': raw_replies}
+            if late_replies:
+                data['late'] = late_replies
+            self.output.put_nowait(data)
+        self.flush(time.time())
+
+    def flush(self, now: float, force: bool = False) -> None:
+        """ Send the rollups of the periods that are over. force sends every period. """
+        with self.lock:
+            due = [_ for _ in sorted(self.periods)
+                   if force or _ + self.period + ROLLUP_GRACE <= now]
+            due = [(_, self.periods.pop(_)) for _ in due]
+        for start, aggregates in due:
+            data = {'type': 'rollup', 'send_time': start, 'period': self.period,
+                    'buckets': HISTOGRAM_BOUNDS,
+                    'targets': [_.to_list(ip) for ip, _ in aggregates.items()]}
+            self.output.put_nowait(data)
+            self.rollups_sent += 1
+            logging.debug("Sent rollup of %i targets for period starting %i",
+                          len(aggregates), start)
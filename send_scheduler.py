@@ -0,0 +1,178 @@
+"""
+Schedulers deciding when the pinger sends each echo request.
+"""
+from typing import Dict, List, Optional, Tuple
+import heapq
+import logging
+import math
+import zlib
+
+
+class IntervalScheduler(object):
+    """ Schedules echo requests for each destination at its own interval.
+
+    The next send time of every destination is kept in a heap so finding the
+    due destinations costs O(log n) per request no matter how many
+    destinations there are or how their intervals are mixed.
+
+    Every destination is sent at a stable phase offset within its interval.
+    Destinations sharing an interval have their offsets spread evenly across
+    it (ordered by a hash of the destination) so they are not sent in one
+    burst.
+
+    A destination can be sent a burst of several requests every interval.
+    The first request of a burst is sent at the destination's phase offset and
+    the rest follow at the burst spacing.
+
+    If max_rate (packets per second) is set and the destinations would need a
+    higher rate than that, every interval is stretched by the same factor.
+
+    set_destinations() may be called from another thread. The new
+    destinations are applied by the thread calling pop_due().
+    """
+
+    def __init__(self, default_interval: float = 1.0, max_rate: float = 0,
+                 start_time: float = 0.0):
+        self.default_interval = default_interval
+        self.max_rate = max_rate
+        self.epoch = start_time  # send times are epoch + offset + k * interval
+        self.intervals = {}  # destination: effective interval in seconds
+        self.offsets = {}  # destination: phase offset within its interval
+        self.generations = {}  # destination: generation of its valid heap entries
+        self.bursts = {}  # destination: (count, spacing) for destinations sent bursts
+        self.heap = []  # (send_time, generation, destination, index within the burst)
+        # dict of destination: (interval, burst count, burst spacing) to apply or None
+        self.new_destinations = None
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def set_destinations(self, destinations: List[str], intervals: List[float] = None,
+                         bursts: List[Tuple[int, float]] = None) -> None:
+        """ Set the destinations, their intervals (seconds) and bursts.
+
+        Destinations without an interval use default_interval. bursts are
+        (count, spacing in seconds) tuples; None sends one request per
+        interval. A destination listed more than once uses its shortest
+        interval. The spacing is reduced if a burst would not fit in its
+        interval.
+        """
+        if intervals is None:
+            intervals = [self.default_interval] * len(destinations)
+        if bursts is None:
+            bursts = [None] * len(destinations)
+        new_destinations = {}
+        for destination, interval, burst in zip(destinations, intervals, bursts):
+            count, spacing = burst if burst else (1, 0.0)
+            spacing = min(spacing, interval / count)
+            if destination not in new_destinations or interval < new_destinations[destination][0]:
+                new_destinations[destination] = (interval, count, spacing)
+        self.new_destinations = new_destinations
+
+    def apply_destinations(self, now: float) -> None:
+        """ Rebuild the schedule from the destinations given to set_destinations(). """
+        requested = self.new_destinations
+        self.new_destinations = None
+        scale = 1.0
+        if requested and self.max_rate:
+            rate = sum(count / interval for interval, count, spacing in requested.values())
+            if rate > self.max_rate:
+                scale = rate / self.max_rate
+                logging.warning("%i destinations need %.1f packets/s which exceeds max rate "
+                                "of %s packets/s. Stretching intervals by %.2fx.",
+                                len(requested), rate, self.max_rate, scale)
+
+        groups: Dict[float, List[str]] = {}
+        for destination, (interval, count, spacing) in requested.items():
+            groups.setdefault(interval * scale, []).append(destination)
+        offsets = {}
+        for interval, destinations in groups.items():
+            destinations.sort(key=lambda d: (zlib.crc32(d.encode()), d))
+            spacing = interval / len(destinations)
+            # shift each group a little so groups with related intervals do not line up
+            group_shift = zlib.crc32(repr(interval).encode()) / 2 ** 32 * spacing
+            for i, destination in enumerate(destinations):
+                offsets[destination] = group_shift + i * spacing
+
+        for destination in list(self.intervals):
+            if destination not in offsets:
+                del self.intervals[destination]
+                del self.offsets[destination]
+                del self.generations[destination]
+                self.bursts.pop(destination, None)
+        for destination, offset in offsets.items():
+            interval, count, spacing = requested[destination]
+            interval *= scale
+            burst = (count, spacing * scale) if count > 1 else None
+            if self.intervals.get(destination) == interval and self.offsets[destination] == offset \
+                    and self.bursts.get(destination) == burst:
+                continue
+            self.intervals[destination] = interval
+            self.offsets[destination] = offset
+            if burst:
+                self.bursts[destination] = burst
+            else:
+                self.bursts.pop(destination, None)
+            self.generations[destination] = self.generations.get(destination, -1) + 1
+            self.push(destination, self.first_send_time(destination, now))
+        # drop the entries of removed and rescheduled destinations
+        self.heap = [_ for _ in self.heap if self.generations.get(_[2]) == _[1]]
+        heapq.heapify(self.heap)
+
+    def first_send_time(self, destination: str, now: float) -> float:
+        """ The first send time of destination at its phase offset that is not before now. """
+        interval = self.intervals[destination]
+        base = self.epoch + self.offsets[destination]
+        periods = max(math.ceil((now - base) / interval), 0)
+        return base + periods * interval
+
+    def push(self, destination: str, send_time: float, index: int = 0) -> None:
+        heapq.heappush(self.heap, (send_time, self.generations[destination], destination, index))
+
+    def burst_count(self, destination: str) -> int:
+        """ The number of requests sent to destination each interval. """
+        burst = self.bursts.get(destination)
+        return burst[0] if burst else 1
+
+    def pop_due(self, now: float) -> List[Tuple[str, int]]:
+        """ Returns the requests due to be sent at time now and schedules their next send.
+
+        :return: a list of (destination, index within the burst). The index is
+                 0 for the first request of a burst and for single requests.
+        """
+        if self.new_destinations is not None:
+            self.apply_destinations(now)
+        due = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            send_time, generation, destination, index = heapq.heappop(heap)
+            if self.generations.get(destination) != generation:
+                continue
+            due.append((destination, index))
+            burst = self.bursts.get(destination)
+            if burst and index + 1 < burst[0]:
+                self.push(destination, send_time + burst[1], index + 1)
+            if index:
+                continue  # the first request of the burst schedules the next burst
+            next_send_time = send_time + self.intervals[destination]
+            if next_send_time <= now:
+                # more than a whole interval behind. skip the missed sends but keep the phase
+                next_send_time = self.first_send_time(destination, now)
+                if next_send_time <= now:
+                    next_send_time += self.intervals[destination]
+            self.push(destination, next_send_time)
+        return due
+
+    def next_send_time(self) -> Optional[float]:
+        """ The time the next echo request is due or None if there are no destinations. """
+        if self.new_destinations is not None:
+            return self.epoch  # apply them as soon as possible
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def lag(self, now: float) -> Optional[float]:
+        """ How far behind schedule (seconds) the next due request is at time now. """
+        if not self.heap:
+            return None
+        return now - self.heap[0][0]
@@ -6,7 +6,7 @@ Listens for connections from transmitters and saves ping output in DB.
 
 from websockets.server import WebSocketServerProtocol as Websocket
 from asgiref.sync import sync_to_async
-from typing import Optional, List, Set
+from typing import Optional, List, Dict
 from queue import Queue
 import websockets
 import argparse
@@ -18,15 +18,28 @@ import json
 import django_standalone  # need this. Don't delete because PyCharm thinks it is "unused"
 from pingweb.models import Prober, Target, CollectorMessage, CollectorMessageType
 from writer import Writer
+import ws_compression
+import wire_format
 import config
 import misc
 
 
 write_queue: Optional[Queue] = None  # queue of messages that need to be recorded.
+# types of the messages from probers that are acknowledged and recorded by the Writer
+OUTPUT_MESSAGE_TYPES = ('output', 'summary', 'rollup', 'prober_stats', 'tcp_output',
+                        'dns_output', 'connection_stats')
 clients: dict = {}  # all connected clients, keyed on client name.
+# names of the clients that send output in the binary encoding (see wire_format.py)
+binary_clients: set = set()
+# the targets of the recent target lists sent to each binary client, keyed on client
+# name and then target list version. a few are kept for frames sent before a new list arrived.
+client_target_lists: Dict[str, dict] = {}
+TARGET_LISTS_KEPT = 4
+next_target_list_version = 1
 
 
 def handle_output_message(remote_addr: tuple, client_name: str, message: dict):
+    """ Enqueue a results or prober_stats message from a prober for the Writer. """
     global write_queue
     if 'id' not in message:
         logging.warning("Output message from %s has no id. Discarding.", remote_addr)
@@ -37,17 +50,69 @@ def handle_output_message(remote_addr: tuple, client_name: str, message: dict):
     return message['id']
 
 
+def handle_batch_message(remote_addr: tuple, client_name: str, message: dict) -> List[int]:
+    """ Enqueue the messages of a batch frame from a prober for the Writer.
+
+    :return: the ids of the messages in the batch
+    """
+    message_ids = []
+    for inner in message['messages']:
+        if inner.get('type') in OUTPUT_MESSAGE_TYPES:
+            handle_output_message(remote_addr, client_name, inner)
+        else:
+            logging.error("Unknown message in batch from %s type: %s", remote_addr, inner.get('type'))
+        if 'id' in inner:
+            message_ids.append(inner['id'])
+    return message_ids
+
+
+def handle_binary_frame(remote_addr: tuple, client_name: str, data: bytes) -> List[int]:
+    """ Decode a binary output frame from a prober and enqueue its messages for the Writer.
+
+    Frames that refer to a target list the client no longer has, or that can
+    not be decoded, are not acknowledged so the prober sends them again.
+
+    :return: the ids of the messages in the frame
+    """
+    try:
+        version = wire_format.frame_list_version(data)
+        targets = client_target_lists.get(client_name, {}).get(version)
+        if targets is None:
+            logging.error("Binary frame from %s refers to unknown target list version %i",
+                          remote_addr, version)
+            return []
+        messages = wire_format.decode_frame(data, targets)
+    except wire_format.FrameError as e:
+        logging.error("Invalid binary frame from %s: %s", remote_addr, str(e))
+        return []
+    for message in messages:
+        handle_output_message(remote_addr, client_name, message)
+    return [_['id'] for _ in messages]
+
+
+def make_range_acks(message_ids: List[int]) -> List[dict]:
+    """ output_ack messages covering message_ids, one for each run of consecutive ids. """
+    acks = []
+    for message_id in message_ids:
+        if acks and acks[-1]['last'] + 1 == message_id:
+            acks[-1]['last'] = message_id
+        else:
+            acks.append({'type': 'output_ack', 'status': 'enqueued',
+                         'first': message_id, 'last': message_id})
+    return acks
+
+
 def get_target_list(name: str):
-    """ Get the set of targets for this client/prober.
+    """ Get the targets for this client/prober and their probing settings.
 
-    :return: the set() of targets returned by the model or an empty set.
+    :return: a dict of Target: settings dict (see Prober.get_target_settings) or an empty dict.
     """
     try:
         prober = Prober.objects.get(name=name)
     except Prober.DoesNotExist:
         logging.error(f"Cannot get targets for unknown prober {name}")
-        return set()
-    targets = prober.get_unique_targets()
+        return {}
+    targets = prober.get_target_settings()
     return targets
 get_target_list_async = sync_to_async(get_target_list, thread_sensitive=True)
 
@@ -70,25 +135,41 @@ get_prober_by_name_async = sync_to_async(get_prober_by_name, thread_sensitive=Tr
 async def send_target_list(name: str, websocket: Websocket) -> int:
     """ Send target list to prober with given name and websocket.
 
-    Disconnect clients with empty target list.
+    Disconnect clients with empty target list. Clients that send binary
+    output get a versioned list and the version's targets are kept to decode
+    their frames.
 
     :return: number of targets sent to this client
     """
-    targets: Set = await get_target_list_async(name)
+    global next_target_list_version
+    targets: Dict = await get_target_list_async(name)
     if not targets:
         logging.error(f"No targets for prober {name}. Disconnecting client.")
         await websocket.close()
         return 0
     target_dicts = []
-    for target in targets:
+    for target, settings in targets.items():
         d = {
             'ip': target.ip,
             'type': target.type,
             'port': target.port,
+            'query_name': target.query_name,
+            'interval': settings['interval'],
+            'burst_count': settings['burst_count'],
+            'burst_spacing': settings['burst_spacing'],
         }
         target_dicts.append(d)
-    message = json.dumps({'type': 'target_list', 'targets': target_dicts})
-    await websocket.send(message)
+    message = {'type': 'target_list', 'targets': target_dicts}
+    if name in binary_clients:
+        version = next_target_list_version
+        next_target_list_version += 1
+        target_lists = client_target_lists.setdefault(name, {})
+        target_lists[version] = wire_format.make_target_array([_['ip'] for _ in target_dicts])
+        for old_version in sorted(target_lists)[:-TARGET_LISTS_KEPT]:
+            del target_lists[old_version]
+        message['encoding'] = wire_format.ENCODING
+        message['version'] = version
+    await websocket.send(json.dumps(message))
     logging.debug(f"Sent target list to client {name}")
     return len(targets)
 
@@ -108,6 +189,8 @@ async def handle_auth_message(remote_addr: tuple, message: dict, websocket: Webs
             await websocket.close()
             return None
         clients[name] = websocket
+        if wire_format.ENCODING in message.get('encodings', []):
+            binary_clients.add(name)
         logging.info("Client from %s authenticated with name %s", remote_addr, name)
         await send_target_list(name, websocket)
     else:
@@ -123,6 +206,8 @@ def handle_client_disconnect(remote_addr: tuple, client_name: str) -> None:
         clients.pop(client_name)
     except KeyError:
         logging.debug("Could not pop client %s named %s from clients list - not in list", remote_addr, client_name)
+    binary_clients.discard(client_name)
+    client_target_lists.pop(client_name, None)
 
 
 async def handle_client(websocket: websockets.server.WebSocketServerProtocol, request_uri) -> None:
@@ -139,6 +224,14 @@ async def handle_client(websocket: websockets.server.WebSocketServerProtocol, re
                      remote_addr[1])
         while True:
             message_string = await websocket.recv()
+            if isinstance(message_string, bytes):
+                if not client_name:
+                    logging.error("Received binary frame from un-authed client %s", remote_addr)
+                    continue
+                message_ids = handle_binary_frame(remote_addr, client_name, message_string)
+                for ack in make_range_acks(message_ids):
+                    await websocket.send(json.dumps(ack))
+                continue
             try:
                 message = json.loads(message_string)
                 logging.debug("message from %s: %s", remote_addr[0], message)
@@ -151,7 +244,12 @@ async def handle_client(websocket: websockets.server.WebSocketServerProtocol, re
                 client_name = await handle_auth_message(remote_addr, message, websocket)
             elif not client_name:
                 logging.error("Received non-auth type message from un-authed client %s", remote_addr)
-            elif message['type'] == 'output':
+            elif message['type'] == 'batch':
+                message_ids = handle_batch_message(remote_addr, client_name, message)
+                for ack in make_range_acks(message_ids):
+                    await websocket.send(json.dumps(ack))
+            elif message['type'] in OUTPUT_MESSAGE_TYPES:
+                # a single message from a prober that does not send batches
                 message_id = handle_output_message(remote_addr, client_name, message)
                 response = json.dumps({'type': 'output_ack', 'status': 'enqueued', 'id': message_id})
                 await websocket.send(response)
@@ -161,6 +259,7 @@ async def handle_client(websocket: websockets.server.WebSocketServerProtocol, re
         logging.info("Connection from %s:%s closed: %s", remote_addr[0],
                      remote_addr[1], str(e))
     finally:
+        ws_compression.log_byte_counts(websocket, "from %s (%s)" % (client_name, remote_addr[0]))
         handle_client_disconnect(remote_addr, client_name)
 
 
@@ -234,9 +333,16 @@ def main():
     write_queue = queue.Queue()
     listen_ip = config.get_setting_string('ws_address')
     listen_port = int(config.get_setting_string('ws_port'))
-    server = websockets.serve(handle_client, listen_ip, listen_port)
+    extensions = ws_compression.server_extensions(
+        config.get_setting_string('ws_compression'),
+        int(config.get_setting_string('ws_compression_level')),
+        int(config.get_setting_string('ws_compression_window_bits')))
+    server = websockets.serve(handle_client, listen_ip, listen_port, compression=None,
+                              extensions=extensions)
     logging.info("Started listening on %s:%s", listen_ip, str(listen_port))
-    writer = Writer(write_queue)
+    batch_size = int(config.get_setting_string('writer_batch_size'))
+    flush_interval = float(config.get_setting_string('writer_flush_interval'))
+    writer = Writer(write_queue, batch_size=batch_size, flush_interval=flush_interval)
     writer.start()
     event_loop = asyncio.get_event_loop()
     event_loop.run_until_complete(server)
@@ -0,0 +1,157 @@
+"""
+Multi-process pinger for probers with many cores and many targets.
+
+The destinations are split across worker processes. Each worker runs its own
+Pinger with its own raw socket and its own ICMP identifier. The pinger's
+socket filter makes sure each worker only receives its own replies. Output
+messages from all workers are merged into one output queue.
+"""
+from typing import List, Tuple
+import multiprocessing
+import threading
+import logging
+import signal
+import queue
+import zlib
+import os
+
+from pinger import Pinger, MIN_TIMEOUT, MAX_TIMEOUT
+
+
+def worker_main(worker_number: int, own_id: int, control_queue, results_queue,
+                timeout, packet_size, interval, max_rate, min_timeout, max_timeout,
+                rcvbuf, sndbuf, log_level):
+    """ Entry point of a worker process.
+
+    Runs a Pinger thread and applies the commands from control_queue:
+        ('destinations', destinations, intervals, bursts)
+        ('stop',)
+    """
+    # Ctrl-C goes to the whole process group. Let the parent shut us down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(module)s:%(funcName)s# '
+                        + 'worker ' + str(worker_number) + ' %(message)s', level=log_level)
+    pinger = Pinger([], timeout, packet_size, output=results_queue, own_id=own_id,
+                    interval=interval, max_rate=max_rate, min_timeout=min_timeout,
+                    max_timeout=max_timeout, rcvbuf=rcvbuf, sndbuf=sndbuf)
+    pinger.worker = worker_number
+    pinger.start()
+    logging.info("Started pinger worker with id %i", own_id)
+    while pinger.is_alive():
+        try:
+            command = control_queue.get(timeout=1.0)
+        except queue.Empty:
+            continue
+        if command[0] == 'destinations':
+            pinger.set_destinations(command[1], command[2], command[3])
+            logging.debug("Worker has %i destinations", len(command[1]))
+        elif command[0] == 'stop':
+            break
+    pinger.stop()
+    pinger.join()
+    logging.info("Stopped pinger worker")
+
+
+class ShardedPinger(object):
+    """ Pings hosts from several worker processes and merges their output.
+
+    Has the same start(), stop() and set_destinations() interface as Pinger.
+    output must be a queue; results are put on it by a merging thread.
+    """
+
+    def __init__(self, destinations, workers=2, timeout=500, packet_size=55,
+                 output=None, interval=1.0, max_rate=0, min_timeout=MIN_TIMEOUT,
+                 max_timeout=MAX_TIMEOUT, rcvbuf=0, sndbuf=0):
+        self.workers = workers
+        self.timeout = timeout
+        self.packet_size = packet_size
+        self.output = output
+        self.interval = interval
+        self.max_rate = max_rate
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.keep_going = True
+        # spawn instead of fork. the prober has threads and an event loop by the time we start.
+        self.context = multiprocessing.get_context('spawn')
+        self.results_queue = self.context.Queue()
+        self.control_queues = [self.context.Queue() for _ in range(workers)]
+        self.processes = []
+        self.merge_thread = None
+        base_id = os.getpid() & 0xFFFF
+        self.own_ids = [(base_id + i + 1) & 0xFFFF for i in range(workers)]
+        self.shards = [[] for _ in range(workers)]  # destinations given to each worker
+        self.set_destinations(destinations)
+
+    def start(self):
+        for i in range(self.workers):
+            process = self.context.Process(
+                target=worker_main, name=f'pinger-worker-{i}', daemon=True,
+                args=(i, self.own_ids[i], self.control_queues[i], self.results_queue,
+                      self.timeout, self.packet_size, self.interval,
+                      self.max_rate / self.workers, self.min_timeout, self.max_timeout,
+                      self.rcvbuf, self.sndbuf, logging.getLogger().level))
+            process.start()
+            self.processes.append(process)
+        self.merge_thread = threading.Thread(target=self.merge_results, name='pinger-merge')
+        self.merge_thread.start()
+        logging.info("Started %i pinger workers", self.workers)
+
+    def stop(self):
+        self.keep_going = False
+        for control_queue in self.control_queues:
+            control_queue.put(('stop',))
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                logging.warning("Terminating pinger worker %s", process.name)
+                process.terminate()
+        logging.info("Stopped pinger workers")
+
+    def is_alive(self):
+        return any(_.is_alive() for _ in self.processes)
+
+    def merge_results(self):
+        """ Thread moving output messages from the workers to the output queue. """
+        while self.keep_going or not self.results_queue.empty():
+            try:
+                message = self.results_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.output.put_nowait(message)
+
+    def set_destinations(self, destinations: List, intervals: List[float] = None,
+                         bursts: List[Tuple[int, float]] = None):
+        """ Rebalance the destinations across the workers and send each its shard.
+
+        Destinations are assigned greedily to the worker with the lowest
+        packet rate so far, largest rate first. Ties are broken by a hash of
+        the destination so unchanged target lists give unchanged shards.
+        """
+        if intervals is None:
+            intervals = [self.interval] * len(destinations)
+        if bursts is None:
+            bursts = [None] * len(destinations)
+        settings = {}  # destination: (interval, burst) using the shortest interval
+        for destination, interval, burst in zip(destinations, intervals, bursts):
+            if destination not in settings or interval < settings[destination][0]:
+                settings[destination] = (interval, burst)
+        rates = {d: (burst[0] if burst else 1) / interval
+                 for d, (interval, burst) in settings.items()}
+        order = sorted(rates, key=lambda d: (-rates[d], zlib.crc32(d.encode()), d))
+        loads = [0.0] * self.workers
+        shards = [([], [], []) for _ in range(self.workers)]
+        for destination in order:
+            worker = loads.index(min(loads))
+            loads[worker] += rates[destination]
+            shards[worker][0].append(destination)
+            shards[worker][1].append(settings[destination][0])
+            shards[worker][2].append(settings[destination][1])
+        for worker, (shard_destinations, shard_intervals, shard_bursts) in enumerate(shards):
+            self.control_queues[worker].put(('destinations', shard_destinations, shard_intervals,
+                                             shard_bursts))
+        moved = sum(len(set(shards[i][0]) - set(self.shards[i])) for i in range(self.workers))
+        self.shards = [_[0] for _ in shards]
+        logging.debug("Sharded %i destinations across %i workers. %i new or moved.",
+                      len(order), self.workers, moved)
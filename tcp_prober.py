@@ -0,0 +1,78 @@
+"""
+TCP connect latency probe.
+
+Measures how long a TCP handshake takes to each target. Thousands of
+non-blocking connects are multiplexed on the prober's asyncio event loop; no
+thread is used per connection. A refused connection still measures the round
+trip to the host (the RST comes back in one), so it is reported with its
+latency and the error 'refused'.
+"""
+import asyncio
+import logging
+import socket
+import struct
+import errno
+import time
+import sys
+
+from async_prober import AsyncProberBase, split_target, DEFAULT_CONCURRENCY
+
+# close with a RST instead of a FIN so thousands of probes do not leave sockets in TIME_WAIT
+LINGER_RESET = struct.pack('ii', 1, 0)
+
+
+class TcpProber(AsyncProberBase):
+    """ Probes 'ip:port' targets with TCP connects on an asyncio event loop.
+
+    Results are (ip, port, receive_time, send_time, timeout, error) tuples.
+    receive_time is when the connect completed or was refused, or None if it
+    failed or timed out. error is None for an established connection and
+    otherwise 'timeout', 'refused' or the errno name of the failure. The
+    results are output in 'tcp_output' messages.
+    """
+    message_type = 'tcp_output'
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, output=sys.stdout, timeout=1000,
+                 interval=1.0, max_rate=0, concurrency=DEFAULT_CONCURRENCY):
+        super().__init__(loop, output, timeout, interval, max_rate, concurrency)
+        logging.debug("Initialized TcpProber. timeout: %i concurrency: %i", timeout, concurrency)
+
+    async def probe(self, target: str) -> tuple:
+        ip, port = split_target(target)
+        timeout = self.timeout / 1000.0
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_RESET)
+        receive_time = None
+        error = None
+        send_time = time.monotonic()
+        try:
+            await asyncio.wait_for(self.loop.sock_connect(sock, (ip, port)), timeout)
+            receive_time = time.monotonic()
+        except asyncio.TimeoutError:
+            error = 'timeout'
+        except ConnectionRefusedError:
+            receive_time = time.monotonic()
+            error = 'refused'
+        except OSError as e:
+            error = errno.errorcode.get(e.errno, str(e))
+        finally:
+            sock.close()
+        return ip, port, receive_time, send_time, timeout, error
+
+    def to_unix_time(self, result: tuple, offset: float) -> tuple:
+        ip, port, receive_time, send_time, timeout, error = result
+        return (ip, port, None if receive_time is None else receive_time + offset,
+                send_time + offset, timeout, error)
+
+    def send_time(self, result: tuple) -> float:
+        return result[3]
+
+    def format_result(self, result: tuple) -> str:
+        ip, port, receive_time, send_time, timeout, error = result
+        if receive_time is None:
+            return "no connection to {0}:{1} ({2})".format(ip, port, error)
+        millis = (receive_time - send_time) * 1000
+        if error:
+            return "connection to {0}:{1} {2} in {3:.1f} ms".format(ip, port, error, millis)
+        return "connected to {0}:{1} in {2:.1f} ms".format(ip, port, millis)
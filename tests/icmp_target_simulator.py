@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Simulates a network of hosts that answer ICMP echo requests (Linux only).
+
+Creates a TUN device and routes a virtual address range to it. Every echo
+request the kernel sends into the device is answered from the simulator
+after a latency drawn from the target's profile, or dropped with the
+profile's loss probability. With the default range (198.18.0.0/15, reserved
+for benchmarking by RFC 2544) up to 131070 responsive targets are available
+on any Linux box without a network. Must run as root:
+    sudo python3 tests/icmp_target_simulator.py --latency 20 --jitter 2 --loss 0.01
+
+Profiles for parts of the range are given with --profile, e.g.
+    --profile 198.18.1.0/24:latency=150,jitter=30,loss=0.05,distribution=exponential
+"""
+from typing import List, Optional, Tuple
+import ipaddress
+import subprocess
+import argparse
+import logging
+import select
+import struct
+import random
+import signal
+import fcntl
+import heapq
+import time
+import os
+
+TUNSETIFF = 0x400454ca
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+DEFAULT_DEVICE = 'pingsim0'
+DEFAULT_NETWORK = '198.18.0.0/15'
+DISTRIBUTIONS = ('fixed', 'uniform', 'normal', 'exponential')
+MAX_PACKET = 65535
+
+ICMP_ECHOREPLY = 0
+ICMP_ECHO = 8
+IP_PROTO_ICMP = 1
+
+
+class TargetProfile(object):
+    """ How the simulated hosts in part of the address range behave.
+
+    latency and jitter are milliseconds. For 'uniform' jitter is the half
+    width, for 'normal' the standard deviation and for 'exponential' the
+    mean of the delay added to latency. loss is a probability.
+    """
+
+    def __init__(self, latency: float = 10.0, jitter: float = 0.0, loss: float = 0.0,
+                 distribution: str = 'normal'):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("Unknown distribution: %s" % distribution)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.distribution = distribution
+
+    def __repr__(self):
+        return 'TargetProfile(latency={}, jitter={}, loss={}, distribution={!r})'.format(
+            self.latency, self.jitter, self.loss, self.distribution)
+
+    def sample_delay(self) -> Optional[float]:
+        """ The delay (seconds) before replying to one request or None to drop it. """
+        if self.loss and random.random() < self.loss:
+            return None
+        delay = self.latency
+        if self.jitter and self.distribution == 'uniform':
+            delay += random.uniform(-self.jitter, self.jitter)
+        elif self.jitter and self.distribution == 'normal':
+            delay += random.gauss(0.0, self.jitter)
+        elif self.jitter and self.distribution == 'exponential':
+            delay += random.expovariate(1.0 / self.jitter)
+        return max(delay, 0.0) / 1000.0
+
+    @staticmethod
+    def parse(text: str) -> Tuple[ipaddress.IPv4Network, 'TargetProfile']:
+        """ Parse 'network:key=value,...' as given to --profile. """
+        network, _, settings = text.partition(':')
+        kwargs = {}
+        for setting in filter(None, settings.split(',')):
+            key, _, value = setting.partition('=')
+            kwargs[key] = value if key == 'distribution' else float(value)
+        return ipaddress.IPv4Network(network), TargetProfile(**kwargs)
+
+
+def ones_complement_checksum(data) -> int:
+    if len(data) % 2:
+        data = bytes(data) + b'\x00'
+    total = sum(struct.unpack('!%iH' % (len(data) // 2), data))
+    while total > 0xffff:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def make_echo_reply(packet: bytes) -> Optional[bytes]:
+    """ Turn an IPv4 ICMP echo request into the matching echo reply. None for other packets. """
+    if len(packet) < 28 or packet[0] >> 4 != 4 or packet[9] != IP_PROTO_ICMP:
+        return None
+    header_length = (packet[0] & 0x0f) * 4
+    if packet[header_length] != ICMP_ECHO:
+        return None
+    reply = bytearray(packet)
+    reply[12:16], reply[16:20] = packet[16:20], packet[12:16]  # swap addresses
+    reply[8] = 64  # ttl
+    reply[10:12] = b'\x00\x00'
+    reply[10:12] = struct.pack('!H', ones_complement_checksum(reply[:header_length]))
+    reply[header_length] = ICMP_ECHOREPLY
+    reply[header_length + 2:header_length + 4] = b'\x00\x00'
+    icmp_checksum = ones_complement_checksum(reply[header_length:])
+    reply[header_length + 2:header_length + 4] = struct.pack('!H', icmp_checksum)
+    return bytes(reply)
+
+
+class TargetSimulator(object):
+    """ Answers the echo requests routed to a TUN device. """
+
+    def __init__(self, network: str = DEFAULT_NETWORK, device: str = DEFAULT_DEVICE,
+                 default_profile: TargetProfile = None,
+                 profiles: List[Tuple[ipaddress.IPv4Network, TargetProfile]] = None):
+        self.network = ipaddress.IPv4Network(network)
+        self.device = device
+        self.default_profile = default_profile or TargetProfile()
+        # most specific network first
+        self.profiles = sorted(profiles or [], key=lambda _: -_[0].prefixlen)
+        self.profile_cache = {}  # destination address bytes: profile
+        self.fd = None
+        self.keep_going = True
+        self.pending = []  # heap of (reply time, sequence, packet)
+        self.sequence = 0
+        self.request_count = 0
+        self.reply_count = 0
+        self.drop_count = 0
+
+    def open(self) -> None:
+        """ Create the TUN device and route the simulated network to it. """
+        self.fd = os.open('/dev/net/tun', os.O_RDWR)
+        ifr = struct.pack('16sH', self.device.encode(), IFF_TUN | IFF_NO_PI)
+        fcntl.ioctl(self.fd, TUNSETIFF, ifr)
+        os.set_blocking(self.fd, False)
+        subprocess.run(['ip', 'link', 'set', self.device, 'up'], check=True)
+        subprocess.run(['ip', 'route', 'replace', str(self.network), 'dev', self.device],
+                       check=True)
+        logging.info("Simulating %s on %s", self.network, self.device)
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)  # the kernel removes the device and its route
+            self.fd = None
+
+    def profile_for(self, address: bytes) -> TargetProfile:
+        profile = self.profile_cache.get(address)
+        if profile is None:
+            ip = ipaddress.IPv4Address(address)
+            profile = self.default_profile
+            for network, network_profile in self.profiles:
+                if ip in network:
+                    profile = network_profile
+                    break
+            self.profile_cache[address] = profile
+        return profile
+
+    def handle_packet(self, packet: bytes, now: float) -> None:
+        reply = make_echo_reply(packet)
+        if reply is None:
+            return
+        self.request_count += 1
+        delay = self.profile_for(packet[16:20]).sample_delay()
+        if delay is None:
+            self.drop_count += 1
+            return
+        self.sequence += 1
+        heapq.heappush(self.pending, (now + delay, self.sequence, reply))
+
+    def send_due(self, now: float) -> None:
+        pending = self.pending
+        while pending and pending[0][0] <= now:
+            reply = heapq.heappop(pending)[2]
+            try:
+                os.write(self.fd, reply)
+                self.reply_count += 1
+            except BlockingIOError:
+                self.drop_count += 1
+
+    def run(self, stats_interval: float = 10.0) -> None:
+        next_stats = time.monotonic() + stats_interval
+        while self.keep_going:
+            now = time.monotonic()
+            timeout = 1.0 if not self.pending else max(self.pending[0][0] - now, 0.0)
+            readable, _, _ = select.select([self.fd], [], [], min(timeout, 1.0))
+            now = time.monotonic()
+            if readable:
+                # drain the device, a bounded number of packets per wake-up
+                for _ in range(1024):
+                    try:
+                        packet = os.read(self.fd, MAX_PACKET)
+                    except BlockingIOError:
+                        break
+                    self.handle_packet(packet, now)
+            self.send_due(time.monotonic())
+            if now >= next_stats:
+                next_stats = now + stats_interval
+                logging.info("requests: %i replies: %i dropped: %i pending: %i",
+                             self.request_count, self.reply_count, self.drop_count,
+                             len(self.pending))
+
+    def stop(self, *args) -> None:
+        self.keep_going = False
+
+
+def parse_args():
+    description = "Answer ICMP echo requests for a simulated range of hosts"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-n', '--network', default=DEFAULT_NETWORK,
+                        help='Simulated address range. Default: ' + DEFAULT_NETWORK)
+    parser.add_argument('-d', '--device', default=DEFAULT_DEVICE,
+                        help='Name of the TUN device to create.')
+    parser.add_argument('--latency', type=float, default=10.0,
+                        help='Default latency in milliseconds.')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Default jitter in milliseconds.')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='Default probability of dropping a request.')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='normal',
+                        help='Default distribution of the jitter.')
+    parser.add_argument('--profile', action='append', default=[], type=TargetProfile.parse,
+                        help='network:latency=..,jitter=..,loss=..,distribution=.. '
+                             'for part of the range. May be repeated.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    default_profile = TargetProfile(args.latency, args.jitter, args.loss, args.distribution)
+    simulator = TargetSimulator(args.network, args.device, default_profile, args.profile)
+    signal.signal(signal.SIGINT, simulator.stop)
+    signal.signal(signal.SIGTERM, simulator.stop)
+    simulator.open()
+    try:
+        simulator.run()
+    finally:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    main()
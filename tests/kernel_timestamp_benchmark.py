@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Compare RTTs measured with kernel receive timestamps against userspace
+timestamps while the process is under synthetic CPU load.
+
+Pings loopback addresses so the real RTT is a few microseconds; anything
+more is measurement error. Must run as root from the repository root:
+    sudo python3 tests/kernel_timestamp_benchmark.py -t 4
+"""
+import argparse
+import threading
+import queue
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pinger import Pinger
+
+
+def parse_args():
+    description = "Benchmark kernel vs userspace receive timestamps under CPU load"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-t', '--load-threads', type=int, default=4,
+                        help='Number of busy threads competing for the GIL.')
+    parser.add_argument('-n', '--targets', type=int, default=50,
+                        help='Number of loopback targets (127.0.0.x).')
+    parser.add_argument('-s', '--seconds', type=int, default=10,
+                        help='Seconds to run each measurement.')
+    args = parser.parse_args()
+    return args
+
+
+def busy_loop(stop: threading.Event):
+    """ Burn CPU in Python so the pinger thread has to wait for the GIL. """
+    x = 0
+    while not stop.is_set():
+        for i in range(10000):
+            x += i * i
+
+
+def measure(kernel_timestamps, targets, seconds, load_threads):
+    """ Run a Pinger and return the list of RTTs (milliseconds). """
+    output = queue.Queue()
+    pinger = Pinger(targets, output=output)
+    pinger.use_kernel_timestamps = kernel_timestamps
+    stop = threading.Event()
+    threads = [threading.Thread(target=busy_loop, args=(stop,)) for _ in range(load_threads)]
+    for thread in threads:
+        thread.start()
+    pinger.start()
+    time.sleep(seconds)
+    pinger.stop()
+    pinger.join()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    rtts = []
+    while not output.empty():
+        message = output.get()
+        for ip, receive_time, send_time, timeout, kernel_drop in message['replies']:
+            if receive_time is not None:
+                rtts.append((receive_time - send_time) * 1000)
+    if kernel_timestamps and not pinger.kernel_timestamps:
+        print("Kernel timestamps are not available on this system.")
+    return rtts
+
+
+def summarize(name, rtts):
+    if not rtts:
+        print("{:<12} no replies".format(name))
+        return
+    rtts.sort()
+    count = len(rtts)
+    print("{:<12} replies: {:6d} min: {:.3f} median: {:.3f} p99: {:.3f} max: {:.3f} ms".format(
+        name, count, rtts[0], rtts[count // 2], rtts[int(count * 0.99)], rtts[-1]))
+
+
+def main():
+    args = parse_args()
+    targets = ['127.0.0.{}'.format(i) for i in range(1, args.targets + 1)]
+    print("Pinging {} loopback targets for {}s with {} load threads".format(
+        len(targets), args.seconds, args.load_threads))
+    summarize('userspace', measure(False, targets, args.seconds, args.load_threads))
+    summarize('kernel', measure(True, targets, args.seconds, args.load_threads))
+
+
+if __name__ == '__main__':
+    main()
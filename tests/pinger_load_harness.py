@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Load test of the pingers against simulated targets (Linux, root).
+
+Starts tests/icmp_target_simulator.py with a fixed latency and no jitter,
+then pings increasing numbers of its addresses with Pinger (or AsyncPinger)
+for a while each. For every target count reports the achieved echo requests
+per second against the configured rate, the loss seen, the RTT error
+(measured RTT minus the simulated latency) and the pinger process' CPU time
+per second per 1000 targets.
+    sudo python3 tests/pinger_load_harness.py -t 1000 10000 50000 -d 20
+"""
+import subprocess
+import statistics
+import ipaddress
+import argparse
+import asyncio
+import logging
+import queue
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pinger import Pinger
+from async_pinger import AsyncPinger
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icmp_target_simulator.py')
+
+
+def parse_args():
+    description = "Measure the pingers against simulated ICMP targets"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-t', '--targets', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Target counts to measure.')
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='Seconds to ping each target count.')
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help='Seconds between echo requests to each target.')
+    parser.add_argument('-l', '--latency', type=float, default=10.0,
+                        help='Simulated latency in milliseconds.')
+    parser.add_argument('-n', '--network', default='198.18.0.0/15',
+                        help='Simulated address range.')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='Pinger implementation to measure.')
+    parser.add_argument('--max-rate', type=float, default=0,
+                        help='Pinger max_rate (packets per second, 0 for no cap).')
+    args = parser.parse_args()
+    return args
+
+
+def make_targets(network, count):
+    hosts = ipaddress.IPv4Network(network).hosts()
+    targets = []
+    for host in hosts:
+        if len(targets) == count:
+            break
+        targets.append(str(host))
+    if len(targets) < count:
+        raise ValueError("%s holds fewer than %i targets" % (network, count))
+    return targets
+
+
+def collect(results):
+    """ Empty the results queue into a list of replies. """
+    replies = []
+    while True:
+        try:
+            message = results.get_nowait()
+        except (queue.Empty, asyncio.QueueEmpty):
+            return replies
+        replies.extend(message.get('replies', []))
+
+
+def run_thread(targets, args, results):
+    pinger = Pinger(targets, output=results, interval=args.interval, max_rate=args.max_rate)
+    pinger.start()
+    time.sleep(args.duration)
+    pinger.stop()
+    pinger.join()
+    return pinger
+
+
+def run_asyncio(targets, args, results):
+    loop = asyncio.new_event_loop()
+    pinger = AsyncPinger(targets, loop, output=results, interval=args.interval,
+                         max_rate=args.max_rate)
+    loop.call_soon(pinger.start)
+    loop.run_until_complete(asyncio.sleep(args.duration))
+    pinger.stop()
+    loop.close()
+    return pinger
+
+
+def measure(targets, args):
+    """ Ping targets for args.duration seconds and return a row of results. """
+    results = queue.Queue()
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    if args.engine == 'thread':
+        pinger = run_thread(targets, args, results)
+    else:
+        pinger = run_asyncio(targets, args, results)
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+    replies = collect(results)
+    latency = args.latency / 1000
+    errors = sorted((_[1] - _[2] - latency) * 1000 for _ in replies if _[1] is not None)
+    lost = sum(1 for _ in replies if _[1] is None)
+    row = {
+        'targets': len(targets),
+        'expected_pps': len(targets) / args.interval,
+        'achieved_pps': pinger.send_count / wall,
+        'loss': 100.0 * lost / len(replies) if replies else 100.0,
+        'error_median': statistics.median(errors) if errors else float('nan'),
+        'error_p99': errors[int(len(errors) * .99)] if errors else float('nan'),
+        'cpu_per_1k': cpu / wall / len(targets) * 1000,
+    }
+    return row
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.WARNING)
+    simulator = subprocess.Popen([sys.executable, SIMULATOR, '--network', args.network,
+                                  '--latency', str(args.latency), '--distribution', 'fixed'])
+    try:
+        time.sleep(1)  # let the simulator create its device and route
+        if simulator.poll() is not None:
+            sys.exit("Simulator exited with status %i" % simulator.returncode)
+        print("{:>8} {:>12} {:>12} {:>7} {:>12} {:>12} {:>12}".format(
+            'targets', 'expected pps', 'achieved pps', 'loss %', 'err p50 ms',
+            'err p99 ms', 'cpu/s per 1k'))
+        for count in args.targets:
+            row = measure(make_targets(args.network, count), args)
+            print("{targets:>8} {expected_pps:>12.0f} {achieved_pps:>12.0f} {loss:>7.2f} "
+                  "{error_median:>12.3f} {error_p99:>12.3f} {cpu_per_1k:>12.4f}".format(**row))
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of matching a round of ICMP echo replies.
+
+Compares the old receive loop (a new bytes object per recvfrom(), two
+header2dict() calls per packet and a list of pending hosts searched with
+`in` and remove()) with PingerBase.receive_pings(), which drains the socket
+into a reusable buffer and matches replies through the in-flight dict.
+Reports the cost of one round as the number of targets grows. Replies come
+from a fake socket, so no packets are sent and root is not needed.
+"""
+import argparse
+import socket
+import struct
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pinger import PingerBase, ICMP_ECHOREPLY
+
+
+class FakeSocket(object):
+    """ Stands in for the raw socket. Returns each queued packet once. """
+    def __init__(self, packets):
+        self.packets = packets
+        self.index = 0
+
+    def recvfrom(self, size):
+        packet = self.packets[self.index]
+        self.index += 1
+        return packet, (socket.inet_ntoa(packet[12:16]), 0)
+
+    def recv_into(self, buffer):
+        if self.index == len(self.packets):
+            raise BlockingIOError
+        packet = self.packets[self.index]
+        self.index += 1
+        buffer[:len(packet)] = packet
+        return len(packet)
+
+
+def parse_args():
+    description = "Benchmark matching a round of ICMP echo replies"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-t', '--targets', type=int, nargs='+',
+                        default=[100, 1000, 5000, 20000],
+                        help='Target counts to measure.')
+    parser.add_argument('-r', '--rounds', type=int, default=5,
+                        help='Rounds to average for each target count.')
+    args = parser.parse_args()
+    return args
+
+
+def make_targets(count):
+    return [socket.inet_ntoa(struct.pack('!I', 0x0A000001 + i)) for i in range(count)]
+
+
+def make_reply(source, packet_id, seq_number, packet_size=55):
+    """ An IPv4 packet holding an echo reply from source. Checksums are not checked. """
+    ip_header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + 8 + packet_size, 0, 0, 64, 1, 0,
+                            socket.inet_aton(source), socket.inet_aton('10.255.255.254'))
+    icmp_header = struct.pack('!BBHHH', ICMP_ECHOREPLY, 0, 0, packet_id, seq_number)
+    return ip_header + icmp_header + bytes(packet_size)
+
+
+def header2dict(names, struct_format, data):
+    """ The header parsing helper used by the old receive loop. """
+    unpacked_data = struct.unpack(struct_format, data)
+    return dict(zip(names, unpacked_data))
+
+
+def legacy_round(current_socket, destinations, own_id, seq_number):
+    """ The matching part of the receive loop from before the in-flight table. """
+    destinations_remaining = destinations[:]
+    replies = []
+    while destinations_remaining:
+        receive_time = time.time()
+        packet_data, address = current_socket.recvfrom(2048)
+        if address[0] in destinations_remaining:
+            icmp_header = header2dict(
+                names=["type", "code", "checksum", "packet_id", "seq_number"],
+                struct_format="!BBHHH", data=packet_data[20:28])
+            if icmp_header["packet_id"] == own_id and icmp_header["seq_number"] == seq_number:
+                ip_header = header2dict(
+                    names=["version", "type", "length", "id", "flags", "ttl", "protocol",
+                           "checksum", "src_ip", "dest_ip"],
+                    struct_format="!BBHHHBBHII", data=packet_data[:20])
+                ip = socket.inet_ntoa(struct.pack("!I", ip_header["src_ip"]))
+                replies.append((ip, receive_time))
+                destinations_remaining.remove(ip)
+    return replies
+
+
+def current_round(pinger, current_socket, destinations, seq_number):
+    """ Drain the fake socket through PingerBase.receive_pings(). """
+    send_time = time.monotonic()
+    for destination in destinations:
+        pinger.in_flight[(destination, pinger.own_id, seq_number)] = (send_time, pinger.timeout / 1000.0, None)
+    pinger.replies = []
+    while current_socket.index < len(current_socket.packets):
+        pinger.receive_pings(current_socket)
+    return pinger.replies
+
+
+def main():
+    args = parse_args()
+    own_id = 0x1234
+    print("{:>8} {:>14} {:>14} {:>9}".format('targets', 'legacy ms', 'drain ms', 'speedup'))
+    for count in args.targets:
+        destinations = make_targets(count)
+        # replies arrive in reverse order. the worst case for the pending list.
+        packets = [make_reply(_, own_id, 7) for _ in reversed(destinations)]
+        pinger = PingerBase([], own_id=own_id)
+        legacy = current = 0.0
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            replies = legacy_round(FakeSocket(packets), destinations, own_id, 7)
+            legacy += time.perf_counter() - start
+            assert len(replies) == count
+            start = time.perf_counter()
+            replies = current_round(pinger, FakeSocket(packets), destinations, 7)
+            current += time.perf_counter() - start
+            assert len(replies) == count and not pinger.in_flight
+        legacy = legacy / args.rounds * 1000
+        current = current / args.rounds * 1000
+        print("{:>8} {:>14.2f} {:>14.2f} {:>8.1f}x".format(count, legacy, current, legacy / current))
+
+
+if __name__ == '__main__':
+    main()
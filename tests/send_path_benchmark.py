@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of building ICMP echo requests.
+
+Compares the old per-packet build (padding loop, two header packs and the
+pure-Python checksum) with patching the precomputed template used by
+PingerBase.send_one_ping(). Also checks both produce identical packets for
+every sequence number. No packets are sent and root is not needed.
+"""
+import argparse
+import struct
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pinger import PingerBase, ICMP_ECHO, ECHO_PATCH
+
+
+class FakeSocket(object):
+    """ Stands in for the raw socket. Remembers the last packet 'sent'. """
+    def __init__(self):
+        self.packet = None
+
+    def sendto(self, packet, address):
+        self.packet = packet
+
+
+def parse_args():
+    description = "Benchmark building ICMP echo request packets"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Number of packets to build with each method.')
+    args = parser.parse_args()
+    return args
+
+
+def legacy_packet(pinger, seq_number):
+    """ The packet building code from before the template was introduced. """
+    checksum = 0
+    header = struct.pack("!BBHHH", ICMP_ECHO, 0, checksum, pinger.own_id, seq_number)
+    padBytes = []
+    startVal = 0x42
+    for i in range(startVal, startVal + (pinger.packet_size)):
+        padBytes += [(i & 0xff)]
+    data = bytes(padBytes)
+    checksum = pinger.calculate_checksum(header + data)
+    header = struct.pack("!BBHHH", ICMP_ECHO, 0, checksum, pinger.own_id, seq_number)
+    return header + data
+
+
+def template_packet(pinger, seq_number):
+    """ Same steps as PingerBase.send_one_ping() without the sendto(). """
+    checksum = pinger.packet_sum + seq_number
+    checksum = ~((checksum & 0xffff) + (checksum >> 16)) & 0xffff
+    ECHO_PATCH.pack_into(pinger.packet, 2, checksum, pinger.own_id, seq_number)
+    return pinger.packet
+
+
+def verify(pinger):
+    """ Check every sequence number gives the same packet both ways. """
+    for seq_number in range(65536):
+        if legacy_packet(pinger, seq_number) != bytes(template_packet(pinger, seq_number)):
+            print("Mismatch at sequence number", seq_number)
+            return False
+    return True
+
+
+def bench(name, function, pinger, number):
+    start = time.perf_counter()
+    for i in range(number):
+        function(pinger, i & 0xffff)
+    duration = time.perf_counter() - start
+    print("{:<10} {:8.3f} us/packet {:10.0f} packets/s".format(
+        name, duration / number * 1e6, number / duration))
+    return duration
+
+
+def main():
+    args = parse_args()
+    for packet_size in (55, 56):  # odd and even payload lengths
+        pinger = PingerBase([], packet_size=packet_size, own_id=0x1234)
+        print("Payload {} bytes. Packets identical for all sequence numbers: {}".format(
+            packet_size, verify(pinger)))
+    pinger = PingerBase([], own_id=0x1234)
+    legacy = bench('legacy', legacy_packet, pinger, args.number)
+    template = bench('template', template_packet, pinger, args.number)
+    socket = FakeSocket()
+    start = time.perf_counter()
+    for i in range(args.number):
+        pinger.send_one_ping(socket, '127.0.0.1', i & 0xffff)
+    duration = time.perf_counter() - start
+    print("{:<10} {:8.3f} us/packet (send_one_ping with a fake socket)".format(
+        'send', duration / args.number * 1e6))
+    print("Speedup: {:.1f}x".format(legacy / template))
+
+
+if __name__ == '__main__':
+    main()
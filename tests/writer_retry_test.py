@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Checks that the DB writer waits for its retry time after a failed write.
+
+While InfluxDB is down every write_points() call fails. The writer must
+block on its queue until retry_time instead of polling it in a busy loop.
+Needs the collector's Django settings like server.py, but no InfluxDB.
+    python3 tests/writer_retry_test.py
+"""
+import logging
+import queue
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import django_standalone  # before writer, which imports the Django models
+from writer import Writer
+
+RUN_SECONDS = 3.0
+FLUSH_INTERVAL = 0.5
+MAX_GETS = 20  # a busy loop makes hundreds of thousands of get() calls in RUN_SECONDS
+
+
+class CountingQueue(queue.Queue):
+    """ Queue that counts the get() calls. """
+
+    def __init__(self):
+        super().__init__()
+        self.gets = 0
+
+    def get(self, block=True, timeout=None):
+        self.gets += 1
+        return super().get(block, timeout)
+
+
+def failing_write_points(points):
+    raise ConnectionError("InfluxDB is down")
+
+
+def main():
+    logging.disable(logging.ERROR)  # the failed writes are expected
+    db_queue = CountingQueue()
+    writer = Writer(db_queue, flush_interval=FLUSH_INTERVAL)
+    writer.db.write_points = failing_write_points
+    writer.batch = [{'measurement': 'icmp-echo', 'tags': {}, 'fields': {}}]
+    writer.batch_start_time = time.time()
+    writer.start()
+    time.sleep(RUN_SECONDS)
+    writer.keep_going = False
+    writer.join()
+    print("get() calls: %i failed writes: %i pending points: %i" %
+          (db_queue.gets, writer.flush_failures, len(writer.batch)))
+    assert db_queue.gets <= MAX_GETS, "writer polled its queue in a busy loop"
+    # one failure per flush interval, plus the final flush at exit
+    assert writer.flush_failures <= RUN_SECONDS / FLUSH_INTERVAL + 2
+    assert len(writer.batch) == 1
+
+
+if __name__ == '__main__':
+    main()
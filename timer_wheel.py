@@ -0,0 +1,74 @@
+"""
+A hashed timer wheel for expiring large numbers of timers cheaply.
+"""
+from typing import Hashable, List, Optional
+import math
+
+
+class TimerWheel(object):
+    """ Hashed timer wheel. Each slot holds the timers expiring during one tick.
+
+    Adding a timer is O(1). Advancing the wheel only visits the slots for the
+    ticks that have passed. Timers further away than one revolution of the
+    wheel stay in their slot until the wheel comes around to the right
+    revolution. Timers cannot be cancelled; callers should ignore keys that
+    are no longer relevant when they expire.
+    """
+
+    def __init__(self, tick: float = 0.01, slots: int = 512, start_time: float = 0.0):
+        self.tick = tick  # seconds per slot
+        self.slots = [[] for _ in range(slots)]
+        self.current_tick = int(start_time / tick)
+        self.count = 0  # number of timers in the wheel
+
+    def __len__(self):
+        return self.count
+
+    def _tick_of(self, when: float) -> int:
+        return int(math.ceil(when / self.tick))
+
+    def add(self, when: float, key: Hashable) -> None:
+        """ Add a timer for key that expires at time when. """
+        tick = max(self._tick_of(when), self.current_tick)
+        self.slots[tick % len(self.slots)].append((tick, key))
+        self.count += 1
+
+    def advance(self, now: float) -> List[Hashable]:
+        """ Move the wheel forward to time now.
+
+        :return: the keys of all timers that expired, in expiry order
+        """
+        expired = []
+        now_tick = int(now / self.tick)
+        if now_tick < self.current_tick or not self.count:
+            self.current_tick = max(now_tick, self.current_tick)
+            return expired
+        # never visit a slot more than once per call
+        last_tick = min(now_tick, self.current_tick + len(self.slots) - 1)
+        for tick in range(self.current_tick, last_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            remaining = []
+            for entry in slot:
+                if entry[0] <= now_tick:
+                    expired.append(entry[1])
+                else:
+                    remaining.append(entry)
+            self.slots[tick % len(self.slots)] = remaining
+        self.count -= len(expired)
+        self.current_tick = now_tick
+        return expired
+
+    def next_expiry(self) -> Optional[float]:
+        """ Returns the time the next slot with timers in it is due or None if empty.
+
+        Timers more than one revolution away may make this earlier than the
+        real next expiry, which only costs an extra call to advance().
+        """
+        if not self.count:
+            return None
+        for tick in range(self.current_tick, self.current_tick + len(self.slots)):
+            if self.slots[tick % len(self.slots)]:
+                return tick * self.tick
+        return (self.current_tick + len(self.slots)) * self.tick
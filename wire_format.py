@@ -0,0 +1,176 @@
+"""
+Compact binary encoding of the prober's 'output' messages.
+
+JSON output messages repeat every target's dotted-quad address and float
+timestamps. In the binary encoding a target is referred to by its index in
+the target_list message the collector sent, times are microsecond offsets
+from a base time and latencies are fixed-width microsecond integers.
+
+The prober offers the encoding in its auth message. A collector that
+supports it answers with 'encoding': ENCODING and a 'version' in its
+target_list messages. Frames name the target list version they index so
+the collector can decode frames sent before the prober saw a new list.
+
+A frame holds consecutive output messages, all big-endian:
+    frame header: magic, format, flags, target list version, first message id,
+                  message count, base time (UNIX seconds)
+    per message:  send time offset from the base (microseconds), reply count,
+                  late reply count, then the replies and late replies
+    reply:        target index, send time offset from the message's send time
+                  (microseconds), latency (microseconds, NO_REPLY for a
+                  timeout), timeout (microseconds), flags
+    late reply:   target index, send time offset, latency
+"""
+from typing import Dict, List
+import struct
+
+import numpy
+
+ENCODING = 'binary1'  # name of this encoding in the auth and target_list messages
+MAGIC = b'PW'
+FORMAT_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sBBIQHd')
+MESSAGE_HEADER = struct.Struct('!qII')
+LATE_REPLY = struct.Struct('!IiI')
+REPLY_DTYPE = numpy.dtype([('index', '>u4'), ('send', '>i4'), ('latency', '>u4'),
+                           ('timeout', '>u4'), ('flags', 'u1')])
+LATE_REPLY_DTYPE = numpy.dtype([('index', '>u4'), ('send', '>i4'), ('latency', '>u4')])
+NO_REPLY = 0xFFFFFFFF  # latency of a timeout
+FLAG_KERNEL_DROP = 0x01
+MAX_MICROSECONDS = 0xFFFFFFFE  # latencies and timeouts are capped at this (about 71 minutes)
+
+
+class FrameError(ValueError):
+    """ A binary frame that can not be decoded. """
+
+
+def micros(seconds: float) -> int:
+    return min(max(int(round(seconds * 1e6)), 0), MAX_MICROSECONDS)
+
+
+def can_encode(message: dict, target_index: Dict[str, int]) -> bool:
+    """ True if message is an output message whose targets are all in target_index. """
+    if message.get('type') != 'output':
+        return False
+    return all(_[0] in target_index for _ in message['replies']) and \
+        all(_[0] in target_index for _ in message.get('late', []))
+
+
+def encode_frame(messages: List[dict], target_index: Dict[str, int], list_version: int,
+                 first_id: int) -> bytes:
+    """ Encode output messages with consecutive ids starting at first_id.
+
+    :param messages: output messages accepted by can_encode()
+    :param target_index: ip: index in the target_list message
+    :param list_version: the version of that target_list message
+    :param first_id: the id of the first message
+    """
+    base_time = min(_['send_time'] for _ in messages)
+    parts = [FRAME_HEADER.pack(MAGIC, FORMAT_VERSION, 0, list_version, first_id,
+                               len(messages), base_time)]
+    for message in messages:
+        send_time = message['send_time']
+        replies = message['replies']
+        late_replies = message.get('late', [])
+        parts.append(MESSAGE_HEADER.pack(int(round((send_time - base_time) * 1e6)),
+                                         len(replies), len(late_replies)))
+        if replies:
+            parts.append(encode_replies(replies, send_time, target_index))
+        for ip, receive_time, late_send_time in late_replies:
+            parts.append(LATE_REPLY.pack(target_index[ip],
+                                         int(round((late_send_time - send_time) * 1e6)),
+                                         micros(receive_time - late_send_time)))
+    return b''.join(parts)
+
+
+def encode_replies(replies: list, send_time: float, target_index: Dict[str, int]) -> bytes:
+    """ Pack (ip, receive_time, send_time, timeout, kernel_drop) replies with numpy. """
+    packed = numpy.empty(len(replies), REPLY_DTYPE)
+    packed['index'] = [target_index[_[0]] for _ in replies]
+    send_times = numpy.array([_[2] for _ in replies])
+    packed['send'] = numpy.rint((send_times - send_time) * 1e6)
+    receive_times = numpy.array([numpy.nan if _[1] is None else _[1] for _ in replies])
+    latencies = numpy.clip(numpy.rint((receive_times - send_times) * 1e6), 0, MAX_MICROSECONDS)
+    packed['latency'] = numpy.where(numpy.isnan(receive_times), NO_REPLY, latencies)
+    timeouts = numpy.array([_[3] or 0.0 for _ in replies])
+    packed['timeout'] = numpy.clip(numpy.rint(timeouts * 1e6), 0, MAX_MICROSECONDS)
+    packed['flags'] = [FLAG_KERNEL_DROP if len(_) > 4 and _[4] else 0 for _ in replies]
+    return packed.tobytes()
+
+
+def frame_list_version(data: bytes) -> int:
+    """ The target list version a frame's indexes refer to. """
+    if len(data) < FRAME_HEADER.size or data[:2] != MAGIC:
+        raise FrameError("Not a binary output frame")
+    return FRAME_HEADER.unpack_from(data)[3]
+
+
+def decode_frame(data: bytes, targets: numpy.ndarray) -> List[dict]:
+    """ Decode a frame into output messages like the JSON ones.
+
+    The replies of each message are unpacked with numpy in one go, as they
+    are packed.
+
+    :param targets: object array of the ips in the target_list the frame refers to
+    :return: list of output messages with their 'id's
+    """
+    try:
+        magic, format_version, flags, list_version, first_id, count, base_time = \
+            FRAME_HEADER.unpack_from(data)
+    except struct.error:
+        raise FrameError("Truncated frame header")
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise FrameError("Unknown frame format")
+    offset = FRAME_HEADER.size
+    messages = []
+    try:
+        for message_id in range(first_id, first_id + count):
+            send_offset, reply_count, late_count = MESSAGE_HEADER.unpack_from(data, offset)
+            offset += MESSAGE_HEADER.size
+            send_time = base_time + send_offset / 1e6
+            replies = numpy.frombuffer(data, REPLY_DTYPE, reply_count, offset)
+            offset += REPLY_DTYPE.itemsize * reply_count
+            late = numpy.frombuffer(data, LATE_REPLY_DTYPE, late_count, offset)
+            offset += LATE_REPLY_DTYPE.itemsize * late_count
+            message = {'type': 'output', 'id': message_id, 'send_time': send_time,
+                       'replies': decode_replies(replies, send_time, targets)}
+            if late_count:
+                message['late'] = decode_late_replies(late, send_time, targets)
+            messages.append(message)
+    except (struct.error, ValueError, IndexError) as e:
+        raise FrameError("Malformed frame: %s" % str(e))
+    return messages
+
+
+def decode_replies(replies: numpy.ndarray, send_time: float, targets: numpy.ndarray) -> list:
+    """ (ip, receive_time, send_time, timeout, kernel_drop) tuples from packed replies. """
+    ips = targets[replies['index']].tolist()
+    send_times = send_time + replies['send'] / 1e6
+    receive_times = (send_times + replies['latency'] / 1e6).tolist()
+    timeouts = (replies['timeout'] / 1e6).tolist()
+    no_reply = (replies['latency'] == NO_REPLY).tolist()
+    kernel_drops = ((replies['flags'] & FLAG_KERNEL_DROP) != 0).tolist()
+    return [(ip, None if lost else receive_time, reply_send_time, timeout, kernel_drop)
+            for ip, receive_time, reply_send_time, timeout, lost, kernel_drop
+            in zip(ips, receive_times, send_times.tolist(), timeouts, no_reply, kernel_drops)]
+
+
+def decode_late_replies(late: numpy.ndarray, send_time: float, targets: numpy.ndarray) -> list:
+    """ (ip, receive_time, send_time) tuples from packed late replies. """
+    send_times = send_time + late['send'] / 1e6
+    receive_times = send_times + late['latency'] / 1e6
+    return list(zip(targets[late['index']].tolist(), receive_times.tolist(),
+                    send_times.tolist()))
+
+
+def make_target_array(ips: List[str]) -> numpy.ndarray:
+    """ The object array decode_frame() looks target indexes up in. """
+    return numpy.array(ips, dtype=object)
+
+
+def make_target_index(ips: List[str]) -> Dict[str, int]:
+    """ ip: index of its first appearance in a target_list's targets. """
+    index = {}
+    for i, ip in enumerate(ips):
+        index.setdefault(ip, i)
+    return index
@@ -4,17 +4,41 @@ Contains Thread subclass for writing to DB
 import threading
 import logging
 import queue
+import time
 import env
 from database_influxdb import DatabaseInfluxDB
 
 
+DEFAULT_BATCH_SIZE = 5000  # flush when this many points are waiting
+DEFAULT_FLUSH_INTERVAL = 1.0  # flush when the oldest waiting point is this old (seconds)
+MAX_PENDING_BATCHES = 10  # keep at most this many batches worth of points after failed flushes
+STATS_LOG_INTERVAL = 60.0  # seconds between logging the writer statistics
+
+
 class Writer(threading.Thread):
-    def __init__(self, db_queue):
+    def __init__(self, db_queue, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
         threading.Thread.__init__(self)
         self.db_queue = db_queue
         db_params = env.get_influxdb_params()
         self.db = DatabaseInfluxDB(db_params)
         self.keep_going = True
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = batch_size * MAX_PENDING_BATCHES
+        self.batch = []  # points waiting to be written
+        self.batch_start_time = None  # when the oldest point in batch was added
+        self.retry_time = None  # after a failed write, no flush is due before this time
+
+        # statistics
+        self.flushes = 0
+        self.flush_failures = 0
+        self.points_written = 0
+        self.points_dropped = 0
+        self.last_flush_size = 0
+        self.last_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+        self.last_stats_time = time.time()
 
     def stop(self):
         logging.warning("Writer shutting down with %i messages in write queue",
@@ -22,29 +46,272 @@ class Writer(threading.Thread):
         self.keep_going = False
 
     def store_output(self, message):
-        """ Stores the ping results in the database
+        """ Adds the ping results to the batch of points waiting to be written
 
             message: {'send_time': 1234567890.1,
                       'remote_ip': '1.2.3.4',
                       'replies': [
-                       ('5.6.7.8', 1234567890.2)
+                       ('5.6.7.8', 1234567890.2, 1234567890.15, 0.05, False)
+                      ],
+                      'late': [  # optional
+                       ('5.6.7.9', 1234567891.7, 1234567890.1)
                       ]
                      }
+
+            Replies are (ip, receive_time, send_time, timeout, kernel_drop).
+            kernel_drop is True for timeouts that may be replies the prober's
+            kernel dropped. Older probers send (ip, receive_time, send_time,
+            timeout), (ip, receive_time, send_time) or (ip, receive_time) and
+            the message send_time is used instead.
+            Late replies are (ip, receive_time, send_time) for requests that
+            were already reported as timeouts in an earlier message.
         """
         send_time = message['send_time']
         remote_ip = message['remote_ip']
         prober_name = message['prober_name']
+        if not self.batch:
+            self.batch_start_time = time.time()
         for reply in message['replies']:
             target = reply[0]
             receive_time = reply[1]
-            self.db.record_poll_data(prober_name, target, send_time, receive_time)
+            reply_send_time = reply[2] if len(reply) > 2 else send_time
+            timeout = reply[3] if len(reply) > 3 else None
+            kernel_drop = len(reply) > 4 and reply[4]
+            point = self.db.make_poll_point(prober_name, target, reply_send_time, receive_time,
+                                            timeout=timeout, kernel_drop=kernel_drop)
+            self.batch.append(point)
+        for target, receive_time, late_send_time in message.get('late', []):
+            point = self.db.make_poll_point(prober_name, target, late_send_time,
+                                            receive_time, late=True)
+            self.batch.append(point)
+
+    def store_summary(self, message):
+        """ Adds the burst summaries to the batch of points waiting to be written
+
+            message: {'type': 'summary',
+                      'send_time': 1234567890.1,
+                      'summaries': [
+                       ('5.6.7.8', 1234567890.1, 5, 4, 0.011, 0.013, 0.017, 0.002)
+                      ]
+                     }
+
+            Summaries are (ip, send_time, sent, received, minimum, average,
+            maximum, jitter). The RTT values are seconds or None if nothing
+            replied.
+        """
+        prober_name = message['prober_name']
+        if not self.batch:
+            self.batch_start_time = time.time()
+        for summary in message['summaries']:
+            point = self.db.make_summary_point(prober_name, *summary)
+            self.batch.append(point)
+
+    def store_rollup(self, message):
+        """ Adds the per-target rollups to the batch of points waiting to be written
+
+            message: {'type': 'rollup',
+                      'send_time': 1234567860,  # start of the period
+                      'period': 60,
+                      'buckets': [1, 2, 5, ...],  # histogram bucket bounds (ms)
+                      'targets': [
+                       ['5.6.7.8', 60, 1, 0.011, 0.017, 0.767, 0.0099, [0, 0, 0, 3, 56, ...], 0]
+                      ]
+                     }
+
+            Targets are [ip, count, lost, minimum, maximum, total,
+            total_squares, histogram, kernel_dropped]. See rollup.TargetAggregate.
+        """
+        prober_name = message['prober_name']
+        if not self.batch:
+            self.batch_start_time = time.time()
+        for target in message['targets']:
+            point = self.db.make_rollup_point(prober_name, message['send_time'],
+                                              message['period'], message['buckets'], *target)
+            self.batch.append(point)
+
+    def store_tcp_output(self, message):
+        """ Adds TCP connect results to the batch of points waiting to be written
+
+            message: {'type': 'tcp_output',
+                      'send_time': 1234567890.1,
+                      'replies': [
+                       ('5.6.7.8', 443, 1234567890.2, 1234567890.15, 1.0, None)
+                      ]
+                     }
+
+            Replies are (ip, port, receive_time, send_time, timeout, error).
+            See tcp_prober.TcpProber.
+        """
+        prober_name = message['prober_name']
+        if not self.batch:
+            self.batch_start_time = time.time()
+        for reply in message['replies']:
+            self.batch.append(self.db.make_tcp_point(prober_name, *reply))
+
+    def store_dns_output(self, message):
+        """ Adds DNS query results to the batch of points waiting to be written
+
+            message: {'type': 'dns_output',
+                      'send_time': 1234567890.1,
+                      'replies': [
+                       ('5.6.7.8', 53, 'example.com', 1234567890.2, 1234567890.15, 1.0, 0, 1, None)
+                      ]
+                     }
+
+            Replies are (ip, port, query_name, receive_time, send_time, timeout,
+            rcode, answers, error). See dns_prober.DnsProber.
+        """
+        prober_name = message['prober_name']
+        if not self.batch:
+            self.batch_start_time = time.time()
+        for reply in message['replies']:
+            self.batch.append(self.db.make_dns_point(prober_name, *reply))
+
+    def store_prober_stats(self, message):
+        """ Adds a prober's self-instrumentation to the batch of points waiting to be written
+
+            message: {'type': 'prober_stats',
+                      'send_time': 1234567890.1,
+                      'period': 60.0,  # seconds covered by the message
+                      'worker': 0,  # pinger worker process of sharded probers
+                      'buckets': [0.1, 0.5, 1, ...],  # timing histogram bucket bounds (ms)
+                      'counters': {'sent': 6000, 'received': 5990, ...},
+                      'gauges': {'in_flight': 10, 'destinations': 100},
+                      'timings': {'send_round': {'count': 6000, 'total': 0.3, 'max': 0.002,
+                                                 'histogram': [5800, 200, 0, ...]}, ...}
+                     }
+
+            Counters are the increase over the period. See PingerBase.output_stats().
+        """
+        if not self.batch:
+            self.batch_start_time = time.time()
+        self.batch.append(self.db.make_prober_stats_point(message['prober_name'], message))
+
+    def store_connection_stats(self, message):
+        """ Adds a prober's websocket compression, queue and spool statistics to the batch of points waiting to be written
+
+            message: {'type': 'connection_stats',
+                      'send_time': 1234567890.1,
+                      'period': 60.0,  # seconds covered by the message
+                      'compression': 'deflate',  # 'none' if the connection is not compressed
+                      'level': 6,
+                      'window_bits': 15,
+                      'sent_bytes': 100000,  # before compression. only if compressed
+                      'sent_wire_bytes': 25000,  # after compression
+                      'received_bytes': 2000,
+                      'received_wire_bytes': 500,
+                      'queue_depth': 10,  # messages waiting in memory
+                      'queue_enqueued': 60,
+                      'queue_spilled': 0,  # moved to the spool because the queue was full
+                      'queue_dropped': 0,  # dropped because the queue was full
+                      'queue_blocked': 0,  # times the pinger waited for room
+                      'queue_blocked_seconds': 0.0,
+                      'spool_depth': 0,  # messages waiting on disk. only if spooling is enabled
+                      'spool_bytes': 0,
+                      'spool_spooled': 0,
+                      'spool_unspooled': 0,
+                      'spool_dropped': 0,  # messages dropped because the spool was full
+                      'spool_dropped_bytes': 0
+                     }
+
+            Byte counts and queue and spool counters are the increase over the
+            period and are counted by the prober.
+        """
+        if not self.batch:
+            self.batch_start_time = time.time()
+        self.batch.append(self.db.make_connection_stats_point(message['prober_name'], message))
+
+    def flush_due(self) -> bool:
+        """ Returns True if the batch is big enough or old enough to write.
+
+        After a failed write nothing is due until retry_time, however big the batch is.
+        """
+        if not self.batch:
+            return False
+        if self.retry_time is not None and time.time() < self.retry_time:
+            return False
+        if len(self.batch) >= self.batch_size:
+            return True
+        return time.time() - self.batch_start_time >= self.flush_interval
+
+    def flush(self):
+        """ Write the waiting points to the DB with one request.
+
+        If the write fails the points are kept for the next flush, up to
+        max_pending points. Beyond that the oldest points are dropped.
+        """
+        if not self.batch:
+            return
+        points = self.batch
+        start = time.time()
+        try:
+            self.db.write_points(points)
+        except Exception as e:
+            self.flush_failures += 1
+            logging.error("Failed to write %i points to InfluxDB: %s", len(points), str(e))
+            if len(points) > self.max_pending:
+                dropped = len(points) - self.max_pending
+                self.points_dropped += dropped
+                self.batch = points[dropped:]
+                logging.error("Dropped %i points after failed writes", dropped)
+            # wait a full flush_interval before retrying
+            self.retry_time = time.time() + self.flush_interval
+            return
+        self.retry_time = None
+        duration = time.time() - start
+        self.flushes += 1
+        self.points_written += len(points)
+        self.last_flush_size = len(points)
+        self.last_flush_duration = duration
+        self.max_flush_duration = max(self.max_flush_duration, duration)
+        self.batch = []
+        self.batch_start_time = None
+        logging.debug("Wrote %i points in %.3f seconds", len(points), duration)
+
+    def log_stats(self):
+        """ Log the writer statistics and reset the maximum flush duration. """
+        logging.info("Writer stats: flushes: %i failures: %i written: %i dropped: %i "
+                     "pending: %i last flush: %i points in %.3fs max flush: %.3fs queue: %i",
+                     self.flushes, self.flush_failures, self.points_written,
+                     self.points_dropped, len(self.batch), self.last_flush_size,
+                     self.last_flush_duration, self.max_flush_duration,
+                     self.db_queue.qsize())
+        self.max_flush_duration = 0.0
+        self.last_stats_time = time.time()
 
     def run(self):
-        logging.info("Started DB writer")
+        logging.info("Started DB writer. batch size: %i flush interval: %.2fs",
+                     self.batch_size, self.flush_interval)
         while self.keep_going:
+            if self.batch and self.retry_time is not None:
+                # the batch is overdue after a failed write. wait for the retry
+                timeout = min(max(self.retry_time - time.time(), 0.0), 0.5)
+            elif self.batch:
+                timeout = self.batch_start_time + self.flush_interval - time.time()
+                timeout = min(max(timeout, 0.0), 0.5)
+            else:
+                timeout = 0.5
             try:
-                message = self.db_queue.get(timeout=0.5)
+                message = self.db_queue.get(timeout=timeout)
+                logging.debug("writer queued message for writing")
+                if message.get('type') == 'summary':
+                    self.store_summary(message)
+                elif message.get('type') == 'rollup':
+                    self.store_rollup(message)
+                elif message.get('type') == 'prober_stats':
+                    self.store_prober_stats(message)
+                elif message.get('type') == 'connection_stats':
+                    self.store_connection_stats(message)
+                elif message.get('type') == 'tcp_output':
+                    self.store_tcp_output(message)
+                elif message.get('type') == 'dns_output':
+                    self.store_dns_output(message)
+                else:
+                    self.store_output(message)
             except queue.Empty:
-                continue
-            logging.debug("writer queued message for writing")
-            self.store_output(message)
+                pass
+            if self.flush_due():
+                self.flush()
+            if time.time() - self.last_stats_time >= STATS_LOG_INTERVAL:
+                self.log_stats()
+        self.flush()
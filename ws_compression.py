@@ -0,0 +1,124 @@
+"""
+Configurable permessage-deflate compression of prober websocket connections.
+
+The prober and the collector both build their websocket extensions here.
+The deflate extension negotiated for a connection is wrapped so it counts
+the bytes of each frame before and after compression; see get_byte_counts().
+"""
+from typing import Optional
+import logging
+
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory, \
+    ServerPerMessageDeflateFactory
+from websockets.extensions.base import Extension
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_DEFLATE = 'deflate'
+COMPRESSION_MODES = (COMPRESSION_NONE, COMPRESSION_DEFLATE)
+MEMORY_LEVEL = 5  # zlib memLevel. websockets uses 5 instead of zlib's 8 to save memory
+
+
+class ByteCounts(object):
+    """ Payload bytes of a connection's data frames before (raw) and after (wire) compression. """
+
+    def __init__(self):
+        self.sent_raw = 0
+        self.sent_wire = 0
+        self.received_raw = 0
+        self.received_wire = 0
+
+    def to_dict(self) -> dict:
+        return {'sent_bytes': self.sent_raw, 'sent_wire_bytes': self.sent_wire,
+                'received_bytes': self.received_raw, 'received_wire_bytes': self.received_wire}
+
+    def ratio(self) -> float:
+        """ Raw bytes per wire byte in both directions, or 1.0 if nothing was sent. """
+        wire = self.sent_wire + self.received_wire
+        return (self.sent_raw + self.received_raw) / wire if wire else 1.0
+
+
+class CountingExtension(Extension):
+    """ Passes frames through another extension and counts their bytes. """
+
+    def __init__(self, extension: Extension):
+        self.extension = extension
+        self.name = extension.name
+        self.counts = ByteCounts()
+
+    def __repr__(self):
+        return "CountingExtension(%r)" % self.extension
+
+    def decode(self, frame, **kwargs):
+        decoded = self.extension.decode(frame, **kwargs)
+        self.counts.received_wire += len(frame.data)
+        self.counts.received_raw += len(decoded.data)
+        return decoded
+
+    def encode(self, frame):
+        encoded = self.extension.encode(frame)
+        self.counts.sent_raw += len(frame.data)
+        self.counts.sent_wire += len(encoded.data)
+        return encoded
+
+
+class CountingClientDeflateFactory(ClientPerMessageDeflateFactory):
+    def process_response_params(self, params, accepted_extensions):
+        return CountingExtension(super().process_response_params(params, accepted_extensions))
+
+
+class CountingServerDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, CountingExtension(extension)
+
+
+def check_settings(compression: str, window_bits: int):
+    if compression not in COMPRESSION_MODES:
+        raise ValueError("Unknown websocket compression %s. Use one of: %s" %
+                         (compression, ', '.join(COMPRESSION_MODES)))
+    # zlib does not support raw deflate with an 8 bit window
+    if not 9 <= window_bits <= 15:
+        raise ValueError("Websocket compression window bits must be between 9 and 15")
+
+
+def client_extensions(compression: str, level: int, window_bits: int) -> Optional[list]:
+    """ The extensions argument of websockets.connect() for a compression setting.
+
+    :param compression: 'deflate' or 'none'
+    :param level: zlib compression level, 1 (fastest) to 9 (smallest)
+    :param window_bits: log2 of the compression window in both directions, 9 to 15.
+                        Smaller windows use less memory on both ends but compress less
+    """
+    check_settings(compression, window_bits)
+    if compression == COMPRESSION_NONE:
+        return None  # an empty list makes websockets send an empty extensions header
+    return [CountingClientDeflateFactory(
+        server_max_window_bits=window_bits, client_max_window_bits=window_bits,
+        compress_settings={'level': level, 'memLevel': MEMORY_LEVEL})]
+
+
+def server_extensions(compression: str, level: int, window_bits: int) -> Optional[list]:
+    """ The extensions argument of websockets.serve(). See client_extensions(). """
+    check_settings(compression, window_bits)
+    if compression == COMPRESSION_NONE:
+        return None
+    return [CountingServerDeflateFactory(
+        server_max_window_bits=window_bits, client_max_window_bits=window_bits,
+        compress_settings={'level': level, 'memLevel': MEMORY_LEVEL})]
+
+
+def get_byte_counts(websocket) -> Optional[ByteCounts]:
+    """ The byte counts of a connection, or None if it is not compressed. """
+    for extension in websocket.extensions:
+        if isinstance(extension, CountingExtension):
+            return extension.counts
+    return None
+
+
+def log_byte_counts(websocket, description: str):
+    counts = get_byte_counts(websocket)
+    if counts is None:
+        return
+    logging.info("Websocket %s compression ratio: %.2f sent: %i/%i received: %i/%i bytes "
+                 "(raw/compressed)", description, counts.ratio(), counts.sent_raw,
+                 counts.sent_wire, counts.received_raw, counts.received_wire)